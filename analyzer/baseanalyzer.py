@@ -31,7 +31,10 @@ class BaseAnalyzer(object):
         y_variable="duration",
         **kwargs,
     ):
-        # data preparation
+        # data preparation, features missing in the data (e.g. temp without weather data) are left out
+        if any(v not in self.d.columns for v in vars):
+            log.warning(f"features {[v for v in vars if v not in self.d.columns]} not in the data")
+            vars = [v for v in vars if v in self.d.columns]
         ds = self.d[vars]
         self.y_variable = y_variable
         num_cols = list(ds.columns[ds.dtypes.isin((int, float))])
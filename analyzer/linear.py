@@ -16,7 +16,7 @@ import pandas as pd
 import plotly.express as px # pyright: ignore
 from sklearn import linear_model
 
-from dash_app.app_data_functions import get_data_from_pickle_session
+from dash_app.app_data_functions import get_session_data, wait_for_weather
 from gpxfun.prepare_data import get_prepared_data
 
 # from sklearn.model_selection import cross_val_score, train_test_split#, cross_val_predict, GridSearchCV
@@ -190,7 +190,10 @@ def callback_linear(values, ids, storedflag, sessionid, cluster, y_variable):
     if None in kwargs.values():
         log.warning("callback linear called with missing arguments")
         return no_update
-    dr, _ = get_data_from_pickle_session(sessionid)
+    # the analyzers use the temperature
+    if not wait_for_weather(sessionid):
+        return "the weather data is not available yet"
+    dr = get_session_data(sessionid, clusters=cluster)
     dr = get_prepared_data(dr, cluster=cluster)
     a = eval(analyzerid)(dr)
     a.analyze(y_variable=y_variable, **kwargs)
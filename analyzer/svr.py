@@ -15,7 +15,7 @@ import pandas as pd
 from sklearn import svm
 from utils.utilities import safe_int_float_kwargs
 
-from dash_app.app_data_functions import get_data_from_pickle_session
+from dash_app.app_data_functions import get_session_data, wait_for_weather
 from gpxfun.prepare_data import get_prepared_data
 
 from .baseanalyzer import BaseAnalyzer
@@ -78,7 +78,10 @@ def callback_svr(values, ids, storedflag, sessionid, cluster, y_variable):
     if None in kwargs.values():
         log.error("callback svr called with missing arguments")
         return no_update
-    dr, _ = get_data_from_pickle_session(sessionid)
+    # the analyzers use the temperature
+    if not wait_for_weather(sessionid):
+        return "the weather data is not available yet"
+    dr = get_session_data(sessionid, clusters=cluster)
     dr = get_prepared_data(dr, cluster=cluster)
     a = AnalyzeSVR(dr)
     a.analyze(y_variable=y_variable, **kwargs)
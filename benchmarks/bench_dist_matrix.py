@@ -0,0 +1,56 @@
+"""
+Benchmark: distance matrix with one similaritymeasures call per pair of routes compared
+to the block computation of calc_dist_matrix, in the calling process and on a process pool
+
+usage: python -m benchmarks.bench_dist_matrix [number of routes] [number of processes]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+import similaritymeasures
+
+from gpxfun.calc_dist_matrix import calc_dist_matrix, dist_matrix_executor
+from gpxfun.resample_routes import N_SAMPLES
+
+
+def pairwise(routes: np.ndarray) -> np.ndarray:
+    """the pair loop calc_dist_matrix used before"""
+    n = len(routes)
+    dist = np.zeros((n, n))
+    for xi in range(n):
+        for yi in range(xi + 1, n):
+            dist[xi, yi] = dist[yi, xi] = similaritymeasures.mae(routes[xi], routes[yi])
+    return dist
+
+
+def bench(n: int = 300, workers: int = 4):
+    rng = np.random.default_rng(0)
+    routes = (np.array([8.6, 50.1]) + np.cumsum(rng.normal(scale=1e-4, size=(n, N_SAMPLES, 2)), axis=1)).astype(
+        np.float32
+    )
+    df = pd.DataFrame({"filename": [f"{i}.gpx" for i in range(n)]})
+    t = time.perf_counter()
+    expected = pairwise(routes)
+    t_pairs = time.perf_counter() - t
+    t = time.perf_counter()
+    dist = calc_dist_matrix(df, simmeasure="mae", routes=routes)
+    t_blocks = time.perf_counter() - t
+    print(f"{n} routes with {N_SAMPLES} points, max. abs. difference {np.abs(dist - expected).max():.2e}")
+    print(f"pairs : {t_pairs * 1000:9.1f} ms")
+    print(f"blocks: {t_blocks * 1000:9.1f} ms ({t_pairs / t_blocks:.1f}x)")
+    executor = dist_matrix_executor(workers)
+    if executor is None:
+        return
+    with executor:
+        # start the workers and import the modules before timing
+        calc_dist_matrix(df, simmeasure="mae", routes=routes, executor=executor)
+        t = time.perf_counter()
+        calc_dist_matrix(df, simmeasure="mae", routes=routes, executor=executor)
+        t_pool = time.perf_counter() - t
+    print(f"pool  : {t_pool * 1000:9.1f} ms ({t_pairs / t_pool:.1f}x, {workers} processes)")
+
+
+if __name__ == "__main__":
+    bench(*[int(x) for x in sys.argv[1:3]])
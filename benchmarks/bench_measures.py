@@ -0,0 +1,50 @@
+"""
+Benchmark: distance matrices with the discrete Frechet distance and the banded dynamic time
+warping compared to area_comp, with and without early abandoning at the pruning cutoff
+
+usage: python -m benchmarks.bench_measures [number of routes] [number of routes for area_comp]
+"""
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+from gpxfun.calc_dist_matrix import calc_dist_condensed, prune_cutoff
+from gpxfun.resample_routes import N_SAMPLES
+
+
+def timed(df: pd.DataFrame, routes: np.ndarray, simmeasure: str, cutoff=None) -> float:
+    """seconds per route pair"""
+    t = time.perf_counter()
+    calc_dist_condensed(df, simmeasure=simmeasure, routes=routes, cutoff=cutoff)
+    return (time.perf_counter() - t) / (len(df) * (len(df) - 1) // 2)
+
+
+def bench(n: int = 100, n_area: int = 12):
+    rng = np.random.default_rng(0)
+    # rides on four paths from the same start in different directions, the rides of a path
+    # differ by noise and sample phase
+    steps = rng.normal(scale=1e-4, size=(4, N_SAMPLES, 2)) + rng.normal(scale=5e-5, size=(4, 1, 2))
+    paths = np.array([8.6, 50.1]) + np.cumsum(steps, axis=1)
+    shifts = rng.integers(0, 10, n)
+    routes = np.stack(
+        [np.concatenate([p[s:], np.repeat(p[-1:], s, axis=0)]) for p, s in zip(paths[rng.integers(0, 4, n)], shifts)]
+    )
+    routes += rng.normal(scale=2e-5, size=routes.shape)
+    df = pd.DataFrame({"filename": [f"{i}.gpx" for i in range(n)]})
+    t_area = timed(df.iloc[:n_area], routes[:n_area], "area_comp")
+    print(f"{N_SAMPLES} points per route, ms per route pair")
+    print(f"area_comp: {t_area * 1000:8.2f} ({n_area} routes)")
+    for simmeasure in ("frechet", "dtw"):
+        t = timed(df, routes, simmeasure)
+        # the cutoff is computed once per startendcluster, not timed
+        t_pruned = timed(df, routes, simmeasure, prune_cutoff(routes, simmeasure))
+        print(
+            f"{simmeasure:9}: {t * 1000:8.2f} ({t_area / t:.0f}x), with early abandoning "
+            f"{t_pruned * 1000:.2f} ({t_area / t_pruned:.0f}x, {n} routes)"
+        )
+
+
+if __name__ == "__main__":
+    bench(*[int(x) for x in sys.argv[1:3]])
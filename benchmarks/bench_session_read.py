@@ -0,0 +1,74 @@
+"""
+Benchmark: read latency of a session stored as pickle files compared to the parquet session files
+
+usage: python -m benchmarks.bench_session_read [number of routes]
+"""
+from pathlib import Path
+import pickle
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+import pandas as pd
+
+from gpxfun.calc_dist_matrix import calc_dist_matrix_per_se_cluster
+from gpxfun.cluster_it import cluster_all
+from gpxfun.infer_start_end import infer_start_end
+from gpxfun.parse_gpx import read_gpx_file_list
+from gpxfun.prepare_data import mark_outliers_per_cluster
+from gpxfun.session_store import CLUSTERS_FILE, SESSION_FILE, read_most_imp_clusters, read_session, write_session
+from utils.utilities import getfilelist
+
+
+def make_session(n: int) -> tuple[pd.DataFrame, pd.DataFrame]:
+    """clustered data of the test files, repeated to n routes"""
+    df = read_gpx_file_list(getfilelist("tests/data", suffix="gpx", withpath=True), weather=False, workers=1)
+    df, se_clusters = infer_start_end(df)
+    df, cluster_inf = cluster_all(df, calc_dist_matrix_per_se_cluster(df), se_clusters)
+    df = mark_outliers_per_cluster(df)
+    df = pd.concat([df] * (n // len(df) + 1), ignore_index=True).head(n)
+    df["filename"] = [f"{i:06d}.gpx" for i in range(n)]
+    df["cluster"] = pd.Categorical([f"0_{i}" for i in np.random.default_rng(0).integers(0, 8, n)])
+    return df, cluster_inf
+
+
+def bench(n: int = 2000, number: int = 10):
+    df, cluster_inf = make_session(n)
+    folder = Path(tempfile.mkdtemp())
+    # the pickle session format, with the routes as lists of [lon, lat] lists
+    legacy = df.copy()
+    legacy["route_inter"] = [r.tolist() for r in legacy.route_inter]
+    with open(folder / "df.pickle", "wb") as f:
+        pickle.dump(legacy, f)
+    with open(folder / "most_imp_clusters.pickle", "wb") as f:
+        pickle.dump(cluster_inf, f)
+    write_session(folder, df.drop(columns="route_inter"), cluster_inf)
+
+    def read_pickles():
+        with open(folder / "df.pickle", "rb") as f:
+            pickle.load(f)
+        with open(folder / "most_imp_clusters.pickle", "rb") as f:
+            pickle.load(f)
+
+    cases = {
+        "pickle, everything": read_pickles,
+        "parquet, everything": lambda: (read_session(folder), read_most_imp_clusters(folder)),
+        "parquet, statisticstable": lambda: read_session(
+            folder, columns=["filename", "startdatetime", "startendcluster", "cluster"]
+        ),
+        "parquet, dropdown": lambda: read_most_imp_clusters(folder, columns=["startendcluster", "cluster"]),
+        "parquet, 2 clusters": lambda: read_session(folder, clusters=["0_1", "0_2"]),
+    }
+    size_pickle = sum((folder / f).stat().st_size for f in ("df.pickle", "most_imp_clusters.pickle"))
+    size_parquet = sum((folder / f).stat().st_size for f in (SESSION_FILE, CLUSTERS_FILE))
+    print(f"{n} routes, pickle {size_pickle / 1e6:.1f} MB, parquet {size_parquet / 1e6:.2f} MB")
+    t0 = None
+    for name, fun in cases.items():
+        t = timeit.timeit(fun, number=number) / number
+        t0 = t0 or t
+        print(f"{name:25}: {t * 1000:8.2f} ms ({t0 / t:.1f}x)")
+
+
+if __name__ == "__main__":
+    bench(*[int(x) for x in sys.argv[1:2]])
@@ -0,0 +1,47 @@
+"""
+Micro-benchmark: track metrics from gpxpy compared to gpxfun.track_metrics
+
+usage: python -m benchmarks.bench_track_metrics [folder with gpx files]
+"""
+import sys
+import timeit
+
+import gpxpy
+
+from gpxfun.parse_gpx import _read_track_gpxpy
+from gpxfun.track_metrics import track_metrics
+from utils.utilities import getfilelist
+
+
+def gpxpy_metrics(g):
+    points = g.get_points_data()
+    return (
+        g.length_3d(),
+        g.get_duration(),
+        g.get_moving_data().moving_time,
+        g.get_uphill_downhill(),
+        points[-1].point.distance_3d(points[0].point),
+    )
+
+
+def bench(folder: str = "tests/data", number: int = 20):
+    files = sorted(getfilelist(folder, suffix="gpx", withpath=True))
+    gpxs, arrays = [], []
+    for f in files:
+        with open(f) as fh:
+            gpxs.append(gpxpy.parse(fh))
+        arrays.append(_read_track_gpxpy(f))
+    npoints = sum(len(a["lat"]) for a in arrays)
+    t_gpxpy = timeit.timeit(lambda: [gpxpy_metrics(g) for g in gpxs], number=number) / number
+    t_numpy = timeit.timeit(
+        lambda: [track_metrics(a["lat"], a["lon"], a["ele"], a["time"], a["segment"]) for a in arrays],
+        number=number,
+    )
+    t_numpy /= number
+    print(f"{len(files)} files, {npoints} points")
+    print(f"gpxpy        : {t_gpxpy * 1000:8.2f} ms")
+    print(f"track_metrics: {t_numpy * 1000:8.2f} ms ({t_gpxpy / t_numpy:.1f}x)")
+
+
+if __name__ == "__main__":
+    bench(*sys.argv[1:2])
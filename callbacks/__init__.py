@@ -5,3 +5,4 @@ from .upload import upload
 from .violin import showhists, clickondata
 from .showmap import showmap
 from .choose_analyzer import update_analyzer_dropdown, choose_analyzer
+from .recut import recut, update_cluster_quantile_slider
@@ -0,0 +1,49 @@
+import logging
+
+from dash import Input, Output, State, callback, no_update
+
+from dash_app.app_data_functions import get_cluster_cut, recut_session
+
+log = logging.getLogger("gpxfun." + __name__)
+
+
+@callback(
+    Output("cluster_quantile_slider", "value"),
+    Output("cluster_quantile_slider", "disabled"),
+    Input("storedflag", "data"),
+    State("sessionid", "data"),
+    prevent_initial_call=True,
+)
+def update_cluster_quantile_slider(storedflag, sessionid):
+    """set the slider to the stored cut of the session, disabled for sessions which can't be recut"""
+    if storedflag == False:
+        return [no_update] * 2
+    cut = get_cluster_cut(sessionid)
+    if cut is None:
+        log.info(f"session {sessionid} has no linkages, the route clusters can't be recut")
+        return no_update, True
+    return cut["quantile"], False
+
+
+@callback(
+    Output("recutflag", "data"),
+    Input("cluster_quantile_slider", "value"),
+    State("storedflag", "data"),
+    State("sessionid", "data"),
+    State("recutflag", "data"),
+    prevent_initial_call=True,
+)
+def recut(quantile, storedflag, sessionid, recutflag):
+    """cut the route clusters of the session at the quantile of the slider, the dropdowns are updated by recutflag"""
+    if storedflag == False or quantile is None:
+        return no_update
+    cut = get_cluster_cut(sessionid)
+    # the slider was set to the stored cut
+    if cut is None or cut["quantile"] == quantile:
+        return no_update
+    try:
+        recut_session(sessionid, quantile, cut["min_routes_per_cluster"])
+    except ValueError as e:
+        log.warning(f"recut of session {sessionid} failed: {e}")
+        return no_update
+    return recutflag + 1
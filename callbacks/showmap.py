@@ -3,7 +3,7 @@ import logging
 from dash import Input, Output, State, callback, ctx, html, no_update
 import numpy as np
 
-from dash_app.app_data_functions import get_data_from_pickle_session
+from dash_app.app_data_functions import get_most_imp_clusters, get_routes_from_session, get_session_data
 from dash_app.plots import plotaroute
 from gpxfun.prepare_data import y_variables_dict
 
@@ -25,18 +25,20 @@ def showmap(storedflag, clusters, sessionid, y_variable):
     log.debug(str(ctx.triggered_id) + " " + str(clusters))
     if storedflag == False or clusters is None:
         return [no_update] * 2
-    dr, most_imp_clusters = get_data_from_pickle_session(sessionid)
-    dr = dr[dr.cluster.isin(clusters)]
+    dr = get_session_data(
+        sessionid, columns=list(dict.fromkeys(["filename", "cluster", "is_outlier", y_variable])), clusters=clusters
+    )
     if len(dr) < 1:
         return [no_update] * 2
-    mics = most_imp_clusters
+    mics = get_most_imp_clusters(sessionid, columns=["cluster", "start_lat", "start_lon", "ende_lat", "ende_lon"])
     mics = mics[mics.cluster.isin(clusters)]
-    mics = mics.drop(["cluster", "filename"], axis=1)
+    mics = mics.drop(["cluster"], axis=1)
     mics = mics.drop_duplicates()
     points = {}
     points["start"] = list(zip(mics.start_lat, mics.start_lon))
     points["end"] = list(zip(mics.ende_lat, mics.ende_lon))
-    fig = plotaroute(dr, groupfield="cluster", zoom=-1, title=None, specialpoints=points)
+    routes = get_routes_from_session(sessionid).routes_for(dr)
+    fig = plotaroute(dr, groupfield="cluster", zoom=-1, title=None, specialpoints=points, routes=routes)
     return fig, analyzerstats(dr, y_variable)
 
 
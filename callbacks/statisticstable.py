@@ -7,7 +7,7 @@ from dash_bootstrap_templates import load_figure_template
 import pandas as pd
 import plotly.express as px
 
-from dash_app.app_data_functions import get_data_from_pickle_session
+from dash_app.app_data_functions import get_session_data
 from dash_app.plots import TEMPLATE
 
 log = logging.getLogger("gpxfun." + __name__)
@@ -25,7 +25,7 @@ def statisticstable(storedflag, sessionid):
     log.debug(str(ctx.triggered_id))
     if storedflag == False:
         return [no_update]*2
-    dr, _ = get_data_from_pickle_session(sessionid)
+    dr = get_session_data(sessionid, columns=["filename", "startdatetime", "startendcluster", "cluster"])
     if len(dr) < 1:
         return [no_update]*2
     #     from geopy.geocoders import Nominatim
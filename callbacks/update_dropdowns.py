@@ -1,10 +1,10 @@
 import logging
-import pickle
-from pathlib import Path
 from utils.utilities import safe_int_list_cast
 
 from dash import Input, Output, State, callback, ctx, no_update
 
+from dash_app.app_data_functions import get_most_imp_clusters
+
 log = logging.getLogger("gpxfun." + __name__)
 
 
@@ -13,16 +13,16 @@ log = logging.getLogger("gpxfun." + __name__)
     Output("cluster_dropdown", "value"),
     Input("startend_cluster_dropdown", "value"),
     Input("storedflag", "data"),
+    Input("recutflag", "data"),
     State("sessionid", "data"),
     prevent_initial_call=True,
 )
-def update_cluster_dropdown(startendclusters, storedflag, sessionid):
+def update_cluster_dropdown(startendclusters, storedflag, _, sessionid):
     """Initialize the dropdown for the route cluster using startendcluster"""
     log.debug(str(ctx.triggered_id))
     if storedflag == False:
         return [no_update] * 2
-    with open(Path("sessions") / sessionid / "most_imp_clusters.pickle", "rb") as f:
-        most_imp_clusters = pickle.load(f)
+    most_imp_clusters = get_most_imp_clusters(sessionid, columns=["startendcluster", "cluster"])
     clusters = most_imp_clusters[most_imp_clusters.startendcluster.isin(safe_int_list_cast(startendclusters))].cluster
     cluster_dropdown_opts = {}
     for clu in list(clusters):
@@ -43,8 +43,7 @@ def update_startend_dropdown(storedflag, sessionid):
     log.debug("CALLBACK update_startend_dropdown: " + str(ctx.triggered_id))
     if storedflag == False:
         return [no_update] * 2
-    with open(Path("sessions") / sessionid / "most_imp_clusters.pickle", "rb") as f:
-        most_imp_clusters = pickle.load(f)
+    most_imp_clusters = get_most_imp_clusters(sessionid, columns=["startendcluster"])
     startendcluster_dropdown_opts = {}
     for cat in list(most_imp_clusters.startendcluster.cat.categories):
         startendcluster_dropdown_opts[cat] = "Start/end-combination " + str(cat)
@@ -5,7 +5,9 @@ from pathlib import Path
 from dash import Input, Output, State, callback, ctx, no_update
 from utils.utilities import getfilelist, convert_bytes
 
+from dash_app.app_data_functions import read_progress
 from dash_app.app_layout import MYCOLOR
+from gpxfun.session_store import SESSION_FILE
 
 log = logging.getLogger("gpxfun." + __name__)
 
@@ -47,7 +49,10 @@ def update_progessbar(_, sessionid, numberoffiles, picksessionid):
             False,
             no_update,
         )
-    filelist = getfilelist(Path("sessions") / sessionid, "gpx")
+    filelist = read_progress(Path("sessions") / sessionid)
+    if filelist is None:
+        # sessions parsed from the gpx files in the session folder
+        filelist = getfilelist(Path("sessions") / sessionid, "gpx")
     n = len(filelist)
     storedflag = n == 0
     # check if the parsing thread is finished, otherwise, remain in state "not stored"
@@ -59,7 +64,7 @@ def update_progessbar(_, sessionid, numberoffiles, picksessionid):
     # log.debug( f" numberoffiles={numberoffiles}, percentage={percentage}, storedflag={storedflag}")
     if storedflag:
         filesize = convert_bytes(
-            (Path("sessions") / sessionid / "df.pickle").stat().st_size
+            (Path("sessions") / sessionid / SESSION_FILE).stat().st_size
         )
         textarea = f"Finished parsing {numberoffiles} GPX files\n"
         textarea += f"Session id: {sessionid}\n"
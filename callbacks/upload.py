@@ -6,11 +6,32 @@ import threading
 from dash import Input, Output, State, callback, ctx, no_update
 from tqdm import tqdm
 
-from dash_app.app_data_functions import parse_and_cluster
+from dash_app.app_data_functions import parse_and_cluster, start_weather_stage, write_progress
+from gpxfun.gpx_sources import GPX_SUFFIXES, GpxBytes, archive_gpx, expand_gpx_sources, is_gpx_source
 
 
 log = logging.getLogger("gpxfun." + __name__)
 
+# keep gzip compressed copies of the uploaded files in sessions/<id>/archive
+ARCHIVE_UPLOADS = False
+
+
+def ingest_uploads(sessionid: str, sources: list, archive: bool = ARCHIVE_UPLOADS):
+    """
+    parse uploaded files held in memory, to be run in the parsing thread. The weather
+    data is fetched afterwards in its own thread, the session can be used before it arrives
+    """
+    if archive:
+        archive_gpx(sources, Path("sessions") / sessionid / "archive")
+    parse_and_cluster(
+        infolder=Path("sessions") / sessionid,
+        mypickle=Path("sessions") / sessionid / "df.pickle",
+        filelist=sources,
+        track_progress=True,
+        weather=False,
+    )
+    start_weather_stage(sessionid)
+
 
 @callback(
     Output("numberoffiles", "data"),
@@ -20,32 +41,29 @@ log = logging.getLogger("gpxfun." + __name__)
     prevent_initial_call=True,
 )
 def upload(contents, filenames, sessionid):
-    """upload gpx data to session folder and start parsing thread"""
+    """decode the uploaded gpx data and start the parsing thread, the files are not written to disk"""
     log.debug(str(ctx.triggered_id))
     if ctx.triggered_id == None:
         return no_update
     # create sessionid folder
     (Path("sessions") / sessionid).mkdir(parents=True, exist_ok=True)
-    # store alle files in a tmp session directory
-    for ii in tqdm(range(len(contents)), colour="#ffff00", desc="GPX -> session folder"):
+    sources = []
+    for ii in tqdm(range(len(contents)), colour="#ffff00", desc="decode GPX"):
         filename = filenames[ii]
-        if Path(filename).suffix != ".gpx":
-            log.warning(f"provided {filename}, which is not a gpx file")
+        if not is_gpx_source(filename):
+            log.warning(f"provided {filename}, which is not one of {', '.join(GPX_SUFFIXES)}")
             continue
-        cc = contents[ii]
-        _, content_string = cc.split(",")
-        strdata = base64.b64decode(content_string).decode("utf-8")
-        with open(Path("sessions") / sessionid / filename, "w") as f:
-            f.write(strdata)
-    log.debug(f"upload({sessionid}): number of files = {len(contents)}")
+        _, content_string = contents[ii].split(",")
+        sources.append(GpxBytes(filename, base64.b64decode(content_string)))
+    # the members of archives are counted as single files for the progress bar
+    sources = expand_gpx_sources(sources)
+    log.debug(f"upload({sessionid}): number of files = {len(contents)}, gpx files = {len(sources)}")
+    # before the thread starts, so that the progress bar never sees a finished session
+    write_progress(Path("sessions") / sessionid, [s.name for s in sources])
     mythread = threading.Thread(
-        target=parse_and_cluster,
+        target=ingest_uploads,
         name="read",
-        kwargs={
-            "infolder": Path("sessions") / sessionid,
-            "mypickle": Path("sessions") / sessionid / "df.pickle",
-            "delete": True,
-        },
+        args=(sessionid, sources),
     )
     mythread.start()
-    return len(contents)
+    return len(sources)
@@ -3,7 +3,7 @@ import logging
 
 from dash import Input, Output, State, callback, ctx, no_update
 
-from dash_app.app_data_functions import get_data_from_pickle_session
+from dash_app.app_data_functions import get_session_data
 from dash_app.plots import violin
 
 
@@ -24,8 +24,8 @@ def showhists(violinfactor, storedflag, clusters, sessionid, y_variable):
     log.debug(str(ctx.triggered_id))
     if storedflag == False or clusters is None:
         return no_update
-    dr, _ = get_data_from_pickle_session(sessionid)
-    dr = dr[dr.cluster.isin(clusters)]
+    columns = list(dict.fromkeys(["filename", "cluster", "is_outlier", y_variable, violinfactor]))
+    dr = get_session_data(sessionid, columns=columns, clusters=clusters)
     fig = violin(dr, violinfactor, y_variable)
     return fig
 
@@ -50,9 +50,9 @@ def clickondata(clickdata, clusters, storedflag, sessionid):
             # I don't know, why I need this, but the given clickdata is not a proper dict at first
             clickeddict = json.loads(json.dumps(clickdata))
             clicked_file = [x for x in clickeddict["points"][0]["customdata"] if str(x).endswith("gpx")][0]
-            dr, _ = get_data_from_pickle_session(sessionid)
+            dr = get_session_data(sessionid)
             clickedseries = dr[dr["filename"] == clicked_file].iloc[0]
-            clickedseries = clickedseries.drop(["route_inter"])
+            clickedseries = clickedseries.drop(["route_inter"], errors="ignore")
         except:
             log.error(f"clickdata is strange {clickdata} ")
             log.error(f"clickdata is strange {clickeddict} ")
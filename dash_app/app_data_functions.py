@@ -1,60 +1,338 @@
 """ 
-Function to handle the pickle data for each session 
+Function to handle the data for each session 
 to be used within the main dash app.py
 """
+import json
+import os
 from pathlib import Path
-import pickle
-from typing import Tuple
+import threading
+import time
+from typing import Optional, Tuple
 import logging
 
 import pandas as pd
 
 from gpxfun.calc_dist_matrix import calc_dist_matrix_per_se_cluster
-from gpxfun.cluster_it import cluster_all
+from gpxfun.cluster_it import (
+    CLUSTER_QUANTILE,
+    RECUT_MAX_QUANTILE,
+    SPARSE_MIN_ROUTES,
+    cluster_all,
+    cluster_combinations,
+    recut_clusters,
+)
+from gpxfun.cluster_model import (
+    START_END_COLUMNS,
+    ClusterModel,
+    stable_route_labels,
+    stable_startend_labels,
+    start_end_coords,
+)
+from gpxfun.dist_store import DistStore
 from gpxfun.infer_start_end import infer_start_end
-from gpxfun.parse_gpx import update_pickle_from_folder
+from gpxfun.ingest_index import CHANGED, NEW
+from gpxfun.gpx_sources import expand_gpx_sources, gpx_files_in, is_compressed
+from gpxfun.linkage_store import LinkageStore
+from gpxfun.parse_gpx import update_pickle_from_list
 from gpxfun.prepare_data import mark_outliers_per_cluster
+from gpxfun.route_index import RouteIndex
+from gpxfun.route_store import RouteStore
+from gpxfun.session_store import (
+    SESSION_FILE,
+    migrate_session,
+    read_most_imp_clusters,
+    read_session,
+    table_columns,
+    write_session,
+)
+from gpxfun.weather_stage import add_weather, mark_weather_running, weather_state
 
 log = logging.getLogger("gpxfun." + __name__)
 
+# list of the files of a session, which are not parsed yet
+PROGRESS_FILE = "progress.json"
+# seconds the analyzers wait for the weather stage of a session
+WEATHER_WAIT = 120
+# seconds between the checks of the weather state of a session
+WEATHER_POLL = 1.0
+# route clusters with fewer routes are merged to <startendcluster>_other
+MIN_ROUTES_PER_CLUSTER = 10
+
+
+def write_progress(folder: Path, remaining: list):
+    """write the names of the files that remain to be parsed"""
+    tmp = Path(folder) / (PROGRESS_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump({"remaining": remaining}, f)
+    os.replace(tmp, Path(folder) / PROGRESS_FILE)
+
+
+def read_progress(folder: Path) -> Optional[list]:
+    """names of the files that remain to be parsed, None if no progress is tracked for the folder"""
+    if not (Path(folder) / PROGRESS_FILE).is_file():
+        return None
+    with open(Path(folder) / PROGRESS_FILE) as f:
+        return json.load(f)["remaining"]
+
 
 def parse_and_cluster(
     infolder: str,
     mypickle: Path = Path("pickles/df.pickle"),
     delete: bool = False,
-    y_variable: str = "duration"
+    y_variable: str = "duration",
+    workers: Optional[int] = None,
+    filelist: Optional[list] = None,
+    track_progress: bool = False,
+    weather: bool = True,
+    incremental: bool = True,
 ) -> pd.DataFrame:
     """
     1. Parse the gpx data in a folder to a data frame
-    2. Get weather data from meteostat
-    3. Infer startend cluster (most common start end points) -> startendcluster column
-    4. Find the most common routes for each startendcluster -> cluster column
-    5. Save output data frame to pickle file
+    2. Infer startend cluster (most common start end points) -> startendcluster column
+    3. Find the most common routes for each startendcluster -> cluster column
+    4. Save output data frame and clusters to the parquet files of the session
+    5. Get weather data from meteostat, see weather_stage.add_weather
+    Steps 2 and 3 are replaced by assigning the parsed rides to the clusters of the
+    ClusterModel of the session, until the rides drift too far from the clusters
     :param infolder: input folder for gpx data
-    :param mypickle: Path of the pickle file to store the output
+    :param mypickle: Path of the pickle file with the parsed gpx data, the session
+            files are written to the same folder
     :param delete: True if the gpx files should be deleted after they are read
-    :return: DataFrame with the parsed and clustered results
+    :param workers: number of processes to parse the gpx files, default is the number of cores
+    :param filelist: list of gpx files to parse instead of the files in infolder, the
+            files can also be in memory, gzip compressed or zip archives, see gpxfun.gpx_sources
+    :param track_progress: write the files remaining to be parsed to the progress file
+            of the session, see read_progress
+    :param weather: get the weather data, False to leave it to start_weather_stage
+    :param incremental: assign the parsed rides to the existing clusters if possible,
+            False to cluster the session again
+    :return: DataFrame with the parsed and clustered results, without the weather data
+    """
+    if filelist is None:
+        filelist = gpx_files_in(infolder)
+    compressed = [f for f in filelist if isinstance(f, Path) and is_compressed(f)]
+    filelist = expand_gpx_sources(filelist)
+    progress = None
+    if track_progress:
+        folder = Path(mypickle).parents[0]
+        remaining = [f.name for f in filelist]
+        write_progress(folder, remaining)
+
+        def progress(name: str):
+            if name in remaining:
+                remaining.remove(name)
+            write_progress(folder, remaining)
+
+    df = update_pickle_from_list(
+        filelist, mypickle=mypickle, delete=delete, weather=False, workers=workers, progress=progress
+    )
+    if delete:
+        for f in compressed:
+            f.unlink()
+    folder = Path(mypickle).parents[0]
+    report = df.attrs["ingest_report"]
+    model = ClusterModel.load(folder) if incremental and (folder / SESSION_FILE).is_file() else None
+    clustered = None
+    if model is not None:
+        clustered = _assign_to_clusters(df, folder, model, report[NEW] + report[CHANGED], report[CHANGED], y_variable)
+    if clustered is None:
+        # the stored distances of the changed files are not valid anymore
+        changed = set(report[CHANGED]) | set([] if model is None else model.changed)
+        clustered = _cluster_session(df, folder, changed, y_variable)
+    df, cluster_inf = clustered
+    write_session(folder, df, cluster_inf)
+    if weather:
+        add_weather(Path(mypickle).parents[0])
+    return df
+
+
+def _cluster_session(df: pd.DataFrame, folder: Path, changed: set, y_variable: str) -> tuple:
     """
-    df = update_pickle_from_folder(infolder=infolder, mypickle=mypickle, delete=delete)
+    cluster all rides of a session and fit its ClusterModel, the labels of the clusters are
+    kept from the last clustering of the session where possible. The route clusters are cut
+    as in the last recut_session of the session
+    """
+    linkages = LinkageStore(folder)
+    cut = linkages.cut() or {"quantile": CLUSTER_QUANTILE, "min_routes_per_cluster": MIN_ROUTES_PER_CLUSTER}
+    old = None
+    if (folder / SESSION_FILE).is_file():
+        old = read_session(folder, columns=["filename", "startendcluster", "cluster"]).set_index("filename")
     df, se_clusters = infer_start_end(df)
-    dists = calc_dist_matrix_per_se_cluster(df, simmeasure="mae")
-    df, cluster_inf = cluster_all(df, dists, se_clusters, min_routes_per_cluster=10)
+    if old is not None:
+        df, se_clusters = stable_startend_labels(df, se_clusters, old.startendcluster)
+    dists = calc_dist_matrix_per_se_cluster(
+        df,
+        simmeasure="mae",
+        routes=RouteStore.open(folder),
+        store=DistStore(folder),
+        changed=changed,
+        max_routes=SPARSE_MIN_ROUTES,
+    )
+    index = RouteIndex.open(folder)
+    df, cluster_inf = cluster_all(
+        df,
+        dists,
+        se_clusters,
+        min_routes_per_cluster=cut["min_routes_per_cluster"],
+        index=index,
+        quantile=cut["quantile"],
+        linkages=linkages,
+    )
+    if old is not None:
+        renamed = stable_route_labels(df, old.cluster)
+        df["cluster"] = df.cluster.astype(str).map(renamed).astype("category")
+        cluster_inf["cluster"] = cluster_inf.cluster.astype(str).map(renamed)
     df = mark_outliers_per_cluster(df, cols=[y_variable])
-    log.debug(f"write df DataFrame to {mypickle}")
-    with open(mypickle, "wb") as f:
-        pickle.dump(df, f)
-    log.debug(f"write to {Path(mypickle).parents[0] / 'most_imp_clusters.pickle'}")
-    with open(Path(mypickle).parents[0] / "most_imp_clusters.pickle", "wb") as f:
-        pickle.dump(cluster_inf, f)
-    return df
+    ClusterModel.fit(df, se_clusters, index).save(folder)
+    return df, cluster_inf
+
+
+def _assign_to_clusters(
+    df: pd.DataFrame, folder: Path, model: ClusterModel, parsed: list, changed: list, y_variable: str
+) -> Optional[tuple]:
+    """
+    assign the parsed rides and rides without clusters to the clusters of the ClusterModel
+    :param changed: parsed files with a changed content, see ClusterModel.changed
+    :return: DataFrame and cluster infos as _cluster_session, None if the session has to be clustered again
+    """
+    labels = read_session(folder, columns=["filename", "startendcluster", "cluster"]).set_index("filename")
+    new = df[df.filename.isin(set(parsed)) | ~df.filename.isin(labels.index)]
+    assigned = model.assign(new, RouteIndex.open(folder).sketches_for(new.filename)).set_index("filename")
+    if model.needs_recluster():
+        log.info(f"cluster {folder} again, the rides drifted from the clusters: {model.drift()}")
+        return None
+    log.info(f"{len(new)} rides assigned to the clusters of {folder}, drift {model.drift()}")
+    labels = pd.concat([labels.drop(index=assigned.index, errors="ignore"), assigned[["startendcluster", "cluster"]]])
+    se_clusters = model.startend_table()
+    categories = {str(x): x for x in se_clusters.startendcluster.cat.categories}
+    d = pd.concat([df.drop(columns=START_END_COLUMNS, errors="ignore"), start_end_coords(df)], axis=1)
+    d["startendcluster"] = pd.Categorical(
+        d.filename.map(labels.startendcluster.astype(str)).map(categories),
+        categories=se_clusters.startendcluster.cat.categories,
+    )
+    d["cluster"] = d.filename.map(labels.cluster.astype(str)).astype("category")
+    d = mark_outliers_per_cluster(d, cols=[y_variable])
+    model.changed = sorted(set(model.changed) | set(changed))
+    model.save(folder)
+    return d, cluster_combinations(d, se_clusters)
+
+
+def recut_session(
+    sessionid: str, quantile: float = CLUSTER_QUANTILE, min_routes_per_cluster: Optional[int] = MIN_ROUTES_PER_CLUSTER
+) -> pd.DataFrame:
+    """
+    cut the route clusters of a session at another quantile of the route distances from the
+    stored linkages, without computing distances (see cluster_it.recut_clusters). The labels
+    are kept where possible, rides added after the clustering are assigned with the refitted
+    ClusterModel
+    :return: the session data with the new cluster column
+    :raises ValueError: if the session has no stored linkages, e.g. clustered before they were
+            stored or only with calc_cluster_sparse, or the quantile is above RECUT_MAX_QUANTILE
+    """
+    if quantile > RECUT_MAX_QUANTILE:
+        raise ValueError(f"quantile {quantile} above {RECUT_MAX_QUANTILE}, the far route distances are pruned")
+    folder = _session_folder(sessionid)
+    linkages = LinkageStore(folder)
+    if len(linkages.clusters()) == 0:
+        raise ValueError(f"session {sessionid} has no linkages to recut, cluster it again first")
+    d = read_session(folder, columns=table_columns(folder / SESSION_FILE))
+    se_clusters = read_most_imp_clusters(folder).drop(columns=["cluster", "filename"])
+    se_clusters = se_clusters.drop_duplicates("startendcluster").reset_index(drop=True)
+    old = d.set_index("filename").cluster
+    d = recut_clusters(d, linkages, quantile, min_routes_per_cluster)
+    cut = d.cluster.notna()
+    d.loc[cut, "cluster"] = d.cluster[cut].map(stable_route_labels(d[cut], old))
+    d = pd.concat([d.drop(columns=START_END_COLUMNS, errors="ignore"), start_end_coords(d)], axis=1)
+    index = RouteIndex.open(folder)
+    previous = ClusterModel.load(folder)
+    model = ClusterModel.fit(d[cut], se_clusters, index)
+    model.changed = [] if previous is None else previous.changed
+    if not cut.all():
+        d.loc[~cut, "cluster"] = model.assign(d[~cut], index.sketches_for(d.filename[~cut])).cluster.to_numpy()
+    model.save(folder)
+    d["cluster"] = d.cluster.astype("category")
+    linkages.save_cut(quantile, min_routes_per_cluster)
+    write_session(folder, d, cluster_combinations(d, se_clusters))
+    return d
+
+
+def get_cluster_cut(sessionid: str) -> Optional[dict]:
+    """
+    quantile and min_routes_per_cluster of the route clusters of a session, see recut_session
+    None if the session can't be recut
+    """
+    linkages = LinkageStore(_session_folder(sessionid))
+    if len(linkages.clusters()) == 0:
+        return None
+    return linkages.cut() or {"quantile": CLUSTER_QUANTILE, "min_routes_per_cluster": MIN_ROUTES_PER_CLUSTER}
+
+
+def start_weather_stage(sessionid: str) -> threading.Thread:
+    """get the weather data of a session in the background thread "weather", see wait_for_weather"""
+    folder = Path("sessions") / sessionid
+    # before the thread starts, so that wait_for_weather never sees a missing weather stage
+    mark_weather_running(folder)
+    thread = threading.Thread(target=add_weather, name="weather", args=(folder,))
+    thread.start()
+    return thread
+
+
+def wait_for_weather(sessionid: str, timeout: float = WEATHER_WAIT) -> bool:
+    """
+    wait until the weather data of a session is written, False if the weather stage is still
+    running after timeout. The state is read from the session folder (see weather_stage.weather_state),
+    so the weather stage may run in another process of the app. The weather stage is started
+    for sessions with routes without weather data. If its queries fail again, True is returned
+    and the routes are used without the weather data they miss
+    """
+    folder = Path("sessions") / sessionid
+    deadline = time.monotonic() + timeout
+    state = weather_state(folder)
+    if state in ("missing", "partial"):
+        log.info(f"weather data of session {sessionid} is {state}, start the weather stage")
+        start_weather_stage(sessionid)
+        state = "running"
+    if state == "running":
+        log.info(f"wait for the weather data of session {sessionid}")
+    while state == "running" and time.monotonic() < deadline:
+        time.sleep(WEATHER_POLL)
+        state = weather_state(folder)
+    return state in ("ready", "partial")
+
+
+def _session_folder(sessionid: str) -> Path:
+    folder = Path("sessions") / sessionid
+    # sessions stored as pickle files before the parquet format existed
+    migrate_session(folder)
+    if not (folder / SESSION_FILE).is_file():
+        raise ValueError(f"session file {folder / SESSION_FILE} doesn't exist!")
+    return folder
+
+
+def get_session_data(
+    sessionid: str, columns: Optional[list] = None, clusters: Optional[list] = None
+) -> pd.DataFrame:
+    """
+    Read the clustered data of a session
+    :param columns: only read these columns, all columns if None
+    :param clusters: only read the rows of these route clusters, all rows if None
+    """
+    return read_session(_session_folder(sessionid), columns=columns, clusters=clusters)
+
+
+def get_most_imp_clusters(sessionid: str, columns: Optional[list] = None) -> pd.DataFrame:
+    """Read the start/end and route clusters of a session"""
+    return read_most_imp_clusters(_session_folder(sessionid), columns=columns)
 
 
 def get_data_from_pickle_session(sessionid: str) -> Tuple[pd.DataFrame, pd.DataFrame]:
-    picklefn = Path("sessions") / sessionid / "df.pickle"
-    if not picklefn.is_file():
-        raise ValueError(f"pickle file {picklefn} doesn't exist!")
-    with open(picklefn, "rb") as f:
-        df = pickle.load(f)
-    with open(Path("sessions") / sessionid / "most_imp_clusters.pickle", "rb") as f:
-        most_imp_clusters = pickle.load(f)
-    return df, most_imp_clusters
+    """All data and clusters of a session, see get_session_data for reading only a part"""
+    return get_session_data(sessionid), get_most_imp_clusters(sessionid)
+
+
+def get_routes_from_session(sessionid: str) -> RouteStore:
+    """RouteStore with the resampled routes of a session"""
+    routes = RouteStore.open(Path("sessions") / sessionid)
+    if len(routes) == 0:
+        raise ValueError(f"no routes stored for session {sessionid}")
+    return routes
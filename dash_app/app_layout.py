@@ -8,6 +8,7 @@ from dash import dash_table, dcc, html
 import dash_bootstrap_components as dbc
 
 from .plots import blank_fig
+from gpxfun.cluster_it import CLUSTER_QUANTILE, RECUT_MAX_QUANTILE
 from gpxfun.prepare_data import y_variables_dict
 from utils.utilities import getdirlist
 from analyzer.baseanalyzer import varformatdict
@@ -40,6 +41,7 @@ def get_loadstuff():
     uploadfield = dcc.Upload(
         id="upload-data",
         children=dbc.Button("Upload gpx files"),
+        accept=".gpx,.gz,.zip",
         multiple=True,
         style={"margin-right":"10px"}
     )
@@ -94,6 +96,20 @@ def get_loadstuff():
         value=list(y_variables_dict.keys())[0],
         id="target_variable_dropdown",
     )
+    cluster_quantile_slider = html.Div(
+        [
+            html.Small("Route cluster threshold (quantile of the route distances)"),
+            dcc.Slider(
+                min=0.05,
+                max=RECUT_MAX_QUANTILE,
+                step=0.05,
+                value=CLUSTER_QUANTILE,
+                marks={x / 10: f"{x / 10:.1f}" for x in range(1, 7)},
+                id="cluster_quantile_slider",
+            ),
+        ],
+        style={"margin-bottom": "5px"},
+    )
     opts = getsessionids()
     picksessionid = dcc.Dropdown(
         options=opts,
@@ -107,7 +123,9 @@ def get_loadstuff():
     dropdowncard = dbc.Card(
         [
             dbc.CardHeader("Select routes to analyze"),
-            dbc.CardBody([startend_cluster_dropdown, cluster_dropdown, target_variable_dropdown]),
+            dbc.CardBody(
+                [startend_cluster_dropdown, cluster_dropdown, cluster_quantile_slider, target_variable_dropdown]
+            ),
         ]
     )
     loadcard = dbc.Card(
@@ -275,6 +293,7 @@ def serve_layout():
             dcc.Store(data=False, id="storedflag"),
             dcc.Store(data=sessionid, id="sessionid"),
             dcc.Store(data=0, id="numberoffiles"),
+            dcc.Store(data=0, id="recutflag"),
         ],
         fluid=True,
         className="dbc",
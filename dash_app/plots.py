@@ -6,6 +6,7 @@ import logging
 from typing import Optional
 
 from dash_bootstrap_templates import load_figure_template
+import numpy as np
 import pandas as pd
 import plotly.express as px
 import plotly.graph_objects as go
@@ -23,6 +24,7 @@ def prepareplotdata(
     route,
     groupfield: Optional[str] = None,
     routevar: str = "route_inter",
+    routes: Optional[np.ndarray] = None,
 ):
     """
     prepare data for plotaroute function and convert the routevar column
@@ -33,6 +35,9 @@ def prepareplotdata(
     :type groupfield: str
     :param routevar: column name containing in route DataFrame containing the routes
     :type routevar: str
+    :param routes: array of shape (len(route), n_samples, 2) with the routes of the rows,
+                e.g. from the RouteStore of the session, used instead of the routevar column
+    :type routes: numpy.ndarray
     :returns: a pandas DataFrame with columns lon and lat, containing the
                 longitudes and latitudes of the routes to plot
                 to be used by plotaroute function
@@ -40,16 +45,18 @@ def prepareplotdata(
     """
     if groupfield is not None:
         assert type(route) == pd.DataFrame
-        outputdf = (
-            route.groupby(["filename"], group_keys=True)
-            .apply(lambda r: pd.DataFrame(r.iloc[0][routevar], columns=["lon", "lat"]))
-            .reset_index(drop=False)
-            .drop("level_1", axis=1)
-        )
-        outputdf = outputdf.merge(
-            route.loc[:, list(set(["filename", groupfield]))],
-            on="filename",
+        if routes is None:
+            routes = np.stack(route[routevar])
+        n_samples = routes.shape[1]
+        outputdf = pd.DataFrame(
+            {
+                "filename": np.repeat(route.filename.to_numpy(), n_samples),
+                "lon": routes[:, :, 0].ravel(),
+                "lat": routes[:, :, 1].ravel(),
+            }
         )
+        if groupfield != "filename":
+            outputdf[groupfield] = np.repeat(route[groupfield].to_numpy(), n_samples)
     else:
         assert type(route) == list
         outputdf = pd.DataFrame(route, columns=["lon", "lat"])
@@ -63,6 +70,7 @@ def plotaroute(
     routevar: str = "route_inter",
     title: Optional[str] = "",
     specialpoints: Optional[dict] = None,
+    routes: Optional[np.ndarray] = None,
 ):
     """
     plot a given route from a given route
@@ -83,8 +91,10 @@ def plotaroute(
             as markers on the map
             the dictionary labels are used to label the point
     :type specialpoints: dict
+    :param routes: routes of the rows of route, see prepareplotdata
+    :type routes: numpy.ndarray
     """
-    y = prepareplotdata(route, groupfield, routevar=routevar)
+    y = prepareplotdata(route, groupfield, routevar=routevar, routes=routes)
     load_figure_template(TEMPLATE)
     if zoom == -1:
         calczoom = 12
@@ -1,16 +1,62 @@
 """
 Provides functions to calculate distance matrices with different measures
 """
+from concurrent.futures import Executor, ProcessPoolExecutor, as_completed, wait
 from math import sqrt
 import logging
+import multiprocessing
+from multiprocessing import shared_memory
+import os
+import threading
+from typing import Callable, Optional
 
 import numpy as np
 import pandas as pd
+from scipy.spatial.distance import squareform
 import similaritymeasures
 from tqdm import tqdm
 
+from .cluster_it import RECUT_MAX_QUANTILE
+from .dist_store import DistStore
+from .route_store import RouteStore
+
 log = logging.getLogger("gpxfun." + __name__)
 
+# measures computed for blocks of route pairs at once: the mean of this function of the
+# differences of the route points, same as similaritymeasures.mae and .mse
+BLOCK_MEASURES = {"mae": np.abs, "mse": np.square}
+# number of route point differences held in memory per block (4 MB), small enough for the cpu cache
+BLOCK_ELEMENTS = 2**19
+# measures computed by dynamic programming over the point pairs of a Sakoe-Chiba band,
+# for many route pairs at once: discrete Frechet distance and dynamic time warping
+DP_MEASURES = ("frechet", "dtw")
+# half width of the band as fraction of the number of route points
+BAND_FRACTION = 0.1
+# number of route pairs computed together by dp_distances
+DP_PAIRS = 512
+# number of anti-diagonals between the checks of the early abandoning
+ABANDON_EVERY = 16
+# number of routes per side of the tiles of the distance matrix, which are computed by one task
+TILE_ROUTES = {"mae": 256, "mse": 256, "area_comp": 16, "frechet": 64, "dtw": 64}
+# stored distances are updated if at least this fraction of the routes of a startendcluster
+# is known, otherwise they are computed from scratch
+REUSE_MIN_FRACTION = 0.5
+# number of segments of the route means, which give the lower bounds of mae and mse
+PRUNE_SEGMENTS = 32
+# number of route pairs sampled for the cut-off of the pruning, the pruning is skipped
+# for startendclusters with fewer pairs
+PRUNE_SAMPLE = 2000
+# pairs are pruned if their lower bound is above this multiple of the cluster cut-off
+# estimated from the sample, see cluster_it.RECUT_MAX_QUANTILE
+PRUNE_CUTOFF_FACTOR = 2.0
+# blocks of route pairs with more than this fraction of pairs below the cutoff are computed
+# completely, gathering the pairs costs more than computing the pruned ones
+PRUNE_DENSE = 0.5
+
+
+class DistMatrixCancelled(Exception):
+    """the computation of a distance matrix was cancelled"""
+
 
 def area_comp(x: list, y: list):
     return convert_to_np_and_compare(x, y, similaritymeasures.area_between_two_curves)
@@ -24,51 +70,528 @@ def mse(x: list, y: list):
     return convert_to_np_and_compare(x, y, similaritymeasures.mse)
 
 
+def frechet(x: list, y: list, window: Optional[int] = None):
+    return dp_distances(np.asarray(x)[None], np.asarray(y)[None], "frechet", window)[0][0]
+
+
+def dtw(x: list, y: list, window: Optional[int] = None):
+    return dp_distances(np.asarray(x)[None], np.asarray(y)[None], "dtw", window)[0][0]
+
+
 def convert_to_np_and_compare(x: list, y: list, simmeasure):
-    xx = np.array([np.array(xx) for xx in x])
-    yy = np.array([np.array(xx) for xx in y])
-    return simmeasure(xx, yy)
+    return simmeasure(np.asarray(x), np.asarray(y))
 
 
 def euclidean(x, y):
     return sqrt((x[0] - y[0]) ** 2 + (x[1] - y[1]) ** 2)
 
 
-def calc_dist_matrix(
+# similarity measures of two routes given as arrays of (lon, lat) points
+SMEASURES = {"mae": mae, "mse": mse, "area_comp": area_comp, "frechet": frechet, "dtw": dtw}
+
+
+def dp_distances(
+    x: np.ndarray,
+    y: np.ndarray,
+    simmeasure: str = "frechet",
+    window: Optional[int] = None,
+    threshold: Optional[float] = None,
+) -> tuple[np.ndarray, np.ndarray]:
+    """
+    discrete Frechet distances or dynamic time warping distances (sum of the point distances
+    of the warping path divided by the number of points) of the route pairs x[p], y[p]. Only
+    the point pairs (i, j) with |i - j| <= window are compared. The cells of the dynamic
+    programming are computed per anti-diagonal i + j for all route pairs at once
+    Every warping path passes one of two successive anti-diagonals and its cost doesn't
+    decrease along the path, so a pair is abandoned when the minimum of the last two
+    anti-diagonals is above threshold, the minimum is a lower bound of its distance. This is
+    checked every ABANDON_EVERY anti-diagonals
+    :param x: array of shape (number of pairs, n_points, 2)
+    :param y: array of the same shape as x
+    :param window: half width of the Sakoe-Chiba band, default is BAND_FRACTION of n_points
+            (at least 1, at most n_points - 1, which compares all point pairs)
+    :return: distances of the pairs, lower bounds for the abandoned pairs, and the mask of the
+            abandoned pairs
+    """
+    if simmeasure not in DP_MEASURES:
+        raise ValueError(f"dp_distances: simmeasure {simmeasure} unknown")
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    assert x.shape == y.shape and x.ndim == 3, "dp_distances: pairs of routes with the same number of points"
+    n_pairs, n = x.shape[:2]
+    w = min(n - 1, max(1, int(BAND_FRACTION * n)) if window is None else window)
+    # dtw compares the sum of the path with the threshold
+    scale = 1.0 if simmeasure == "frechet" else float(n)
+    limit = np.inf if threshold is None else threshold * scale
+    result = np.full(n_pairs, np.inf)
+    abandoned = np.zeros(n_pairs, dtype=bool)
+    active = np.arange(n_pairs)
+    # x with the points in reverse order, the points i of an anti-diagonal are a slice of it
+    x_rev, y = np.ascontiguousarray(x[:, ::-1].transpose(2, 0, 1)), np.ascontiguousarray(y.transpose(2, 0, 1))
+    # cells of the anti-diagonals k, k - 1 and k - 2, indexed by j - i + w + 1 with a border of inf.
+    # Cells outside of the range of an anti-diagonal are never written and stay inf
+    cells, prev1, prev2 = (np.full((n_pairs, 2 * w + 3), np.inf) for _ in range(3))
+    for k in range(2 * n - 1):
+        d_lo, d_hi = max(-w, -k, k - 2 * (n - 1)), min(w, k, 2 * (n - 1) - k)
+        d_lo += (d_lo - k) % 2
+        m = (d_hi - d_lo) // 2 + 1
+        r, j = n - 1 - (k - d_lo) // 2, (k + d_lo) // 2
+        dx = x_rev[0, :, r : r + m] - y[0, :, j : j + m]
+        dy = x_rev[1, :, r : r + m] - y[1, :, j : j + m]
+        cost = np.sqrt(dx * dx + dy * dy)
+        col = slice(d_lo + w + 1, d_lo + w + 1 + 2 * m, 2)
+        if k == 0:
+            cells[:, col] = cost
+        else:
+            best = np.minimum(prev1[:, col.start - 1 : col.stop - 1 : 2], prev1[:, col.start + 1 : col.stop + 1 : 2])
+            np.minimum(best, prev2[:, col], out=best)
+            if simmeasure == "frechet":
+                np.maximum(cost, best, out=cells[:, col])
+            else:
+                np.add(cost, best, out=cells[:, col])
+        cells, prev1, prev2 = prev2, cells, prev1
+        if threshold is not None and k > 0 and k % ABANDON_EVERY == 0:
+            lower = np.minimum(prev1[:, col].min(axis=1), prev2[:, prev_col].min(axis=1))
+            stop = lower > limit
+            if stop.any():
+                result[active[stop]] = lower[stop] / scale
+                abandoned[active[stop]] = True
+                keep = ~stop
+                active, x_rev, y = active[keep], x_rev[:, keep], y[:, keep]
+                cells, prev1, prev2 = cells[keep], prev1[keep], prev2[keep]
+                if len(active) == 0:
+                    break
+        prev_col = col
+    if len(active) > 0:
+        result[active] = prev1[:, w + 1] / scale
+    return result, abandoned
+
+
+def _row_start(n: int, i: int) -> int:
+    """position of the distance (i, j) in the condensed vector of n routes is _row_start(n, i) + j"""
+    return i * n - i * (i + 1) // 2 - i - 1
+
+
+def segment_bounds(routes: np.ndarray, simmeasure: str) -> np.ndarray:
+    """
+    means of the (lon, lat) values of PRUNE_SEGMENTS segments of each route, weighted such that
+    the sum of the measure of their differences is a lower bound of mae or mse of two routes:
+    the mean of the absolute (squared) differences of a segment is at least the absolute
+    (squared) difference of the means
+    :param routes: array of shape (number of routes, 2 * n_samples) with the (lon, lat) values
+    :return: array of shape (number of routes, 2 * PRUNE_SEGMENTS)
+    """
+    points = routes.reshape(len(routes), -1, 2)
+    n_samples = points.shape[1]
+    starts = np.linspace(0, n_samples, min(PRUNE_SEGMENTS, n_samples) + 1).astype(int)[:-1]
+    lengths = np.diff(np.append(starts, n_samples))[:, None]
+    means = np.add.reduceat(points, starts, axis=1) / lengths
+    weights = lengths / (2 * n_samples)
+    return (means * (weights if simmeasure == "mae" else np.sqrt(weights))).reshape(len(routes), -1)
+
+
+def _fill_tile(
+    routes: np.ndarray,
+    out: np.ndarray,
+    simmeasure: str,
+    rows: tuple,
+    cols: tuple,
+    bounds: Optional[np.ndarray] = None,
+    cutoff: Optional[float] = None,
+) -> int:
+    """
+    distances of the routes in the range rows to the routes in the range cols, only the
+    pairs above the diagonal are computed. mae and mse are computed for square
+    blocks of route pairs with broadcasting
+    :param routes: array of shape (number of routes, 2 * n_samples) with the (lon, lat) values
+    :param out: condensed distance vector, see scipy.spatial.distance.squareform
+    :param bounds: segment_bounds of the routes, pairs with a lower bound above cutoff get the
+            lower bound instead of the distance. frechet and dtw are abandoned above the cutoff
+    :return: number of pruned pairs
+    """
+    n = len(routes)
+    pruned = 0
+    if simmeasure in BLOCK_MEASURES:
+        measure = BLOCK_MEASURES[simmeasure]
+        size = max(1, int(sqrt(BLOCK_ELEMENTS / routes.shape[1])))
+        buffer = np.empty((size, size, routes.shape[1]))
+        for i in range(rows[0], rows[1], size):
+            for j in range(max(i, cols[0]), cols[1], size):
+                x, y = routes[i : min(i + size, rows[1])], routes[j : min(j + size, cols[1])]
+                near = None
+                if cutoff is not None:
+                    lower = measure(bounds[i : i + len(x), None] - bounds[None, j : j + len(y)]).sum(axis=-1)
+                    upper = np.arange(i, i + len(x))[:, None] < np.arange(j, j + len(y))[None, :]
+                    near = np.nonzero(upper & (lower <= cutoff))
+                    pruned += int(upper.sum()) - len(near[0])
+                if near is None or len(near[0]) > PRUNE_DENSE * upper.size:
+                    diff = buffer[: len(x), : len(y)]
+                    np.subtract(x[:, None], y[None, :], out=diff)
+                    measure(diff, out=diff)
+                    dist = diff.sum(axis=-1) / routes.shape[1]
+                    if near is not None:
+                        dist[lower > cutoff] = lower[lower > cutoff]
+                else:
+                    # the exact measure only for the pairs with a lower bound below the cutoff
+                    dist = lower
+                    diff = buffer.reshape(-1, routes.shape[1])[: len(near[0])]
+                    np.subtract(x[near[0]], y[near[1]], out=diff)
+                    measure(diff, out=diff)
+                    dist[near] = diff.sum(axis=-1) / routes.shape[1]
+                for a in range(len(x)):
+                    first = max(j, i + a + 1)
+                    if first < j + len(y):
+                        k = _row_start(n, i + a) + first
+                        out[k : k + j + len(y) - first] = dist[a, first - j :]
+    elif simmeasure in DP_MEASURES:
+        pairs = [(xi, yi) for xi in range(rows[0], rows[1]) for yi in range(max(xi + 1, cols[0]), cols[1])]
+        points = routes.reshape(n, -1, 2)
+        for k in range(0, len(pairs), DP_PAIRS):
+            a, b = np.array(pairs[k : k + DP_PAIRS]).T
+            dist, abandoned = dp_distances(points[a], points[b], simmeasure, threshold=cutoff)
+            out[a * n - a * (a + 1) // 2 - a - 1 + b] = dist
+            pruned += int(abandoned.sum())
+    else:
+        sim_fun = SMEASURES[simmeasure]
+        for xi in range(rows[0], rows[1]):
+            for yi in range(max(xi + 1, cols[0]), cols[1]):
+                out[_row_start(n, xi) + yi] = sim_fun(routes[xi].reshape(-1, 2), routes[yi].reshape(-1, 2))
+    return pruned
+
+
+def _open_shared(spec: tuple) -> tuple[Optional[shared_memory.SharedMemory], np.ndarray]:
+    """
+    array described by spec, ("shm", name, shape, dtype) for shared memory or
+    ("file", path, offset, shape, dtype) for a memory mapped file
+    """
+    if spec[0] == "file":
+        _, path, offset, shape, dtype = spec
+        return None, np.memmap(path, dtype=dtype, mode="r+", offset=offset, shape=shape)
+    _, name, shape, dtype = spec
+    # the workers share the resource tracker of the creating process, which removes the shared memory
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+
+def _fill_shared_tile(
+    routes_spec: tuple,
+    out_spec: tuple,
+    simmeasure: str,
+    rows: tuple,
+    cols: tuple,
+    bounds_spec: Optional[tuple] = None,
+    cutoff: Optional[float] = None,
+) -> int:
+    """_fill_tile on the arrays in shared memory or memory mapped files, run in the worker processes"""
+    shm_routes, routes = _open_shared(routes_spec)
+    shm_out, out = _open_shared(out_spec)
+    shm_bounds, bounds = (None, None) if bounds_spec is None else _open_shared(bounds_spec)
+    try:
+        pruned = _fill_tile(routes, out, simmeasure, rows, cols, bounds, cutoff)
+        if isinstance(out, np.memmap):
+            out.flush()
+        return pruned
+    finally:
+        del routes, out, bounds
+        for shm in (shm_routes, shm_out, shm_bounds):
+            if shm is not None:
+                shm.close()
+
+
+def _shared_copy(a: np.ndarray) -> tuple[shared_memory.SharedMemory, np.ndarray]:
+    shm = shared_memory.SharedMemory(create=True, size=max(1, a.nbytes))
+    shared = np.ndarray(a.shape, dtype=a.dtype, buffer=shm.buf)
+    shared[:] = a
+    return shm, shared
+
+
+def dist_matrix_executor(workers: Optional[int] = None) -> Optional[ProcessPoolExecutor]:
+    """process pool for calc_dist_matrix, None for workers=1"""
+    workers = os.cpu_count() or 1 if workers is None else workers
+    if workers <= 1:
+        return None
+    # spawn instead of fork, the dash app calls this from a thread
+    return ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+
+
+def calc_dist_condensed(
     df: pd.DataFrame,
     simmeasure: str = "mae",
     compvar: str = "route_inter",
+    routes: Optional[np.ndarray] = None,
+    executor: Optional[Executor] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+    cancel: Optional[threading.Event] = None,
+    out: Optional[np.ndarray] = None,
+    first_new: int = 0,
+    cutoff: Optional[float] = None,
 ) -> np.ndarray:
-    distance_mat = np.full((len(df), len(df)), -9999.0)
-    smeasures = {"mae": mae, "mse": mse, "area_comp": area_comp}
-    sim_fun = smeasures.get(simmeasure)
-    if sim_fun is None:
+    """
+    distances between all routes of df as condensed vector, the upper triangle of the
+    distance matrix, see scipy.spatial.distance.squareform
+    The upper triangle is split into tiles of TILE_ROUTES routes, which are computed
+    on a process pool if an executor is given. The routes and the distances are kept in
+    shared memory or a memory mapped file, the tasks only get their names
+    :param compvar: column of df with the routes, if routes is not given
+    :param routes: array of shape (len(df), n_samples, 2) with the routes of the rows of df,
+            e.g. from RouteStore.routes_for
+    :param executor: process pool, see dist_matrix_executor, the tiles are computed in the
+            calling process if None
+    :param progress: function called with the number of tiles done and the number of tiles
+    :param cancel: the computation stops with DistMatrixCancelled when this event is set
+    :param out: array for the distances, e.g. a memory map of DistStore.create, default is
+            a new float32 array
+    :param first_new: only compute the distances to the routes from this position on,
+            the distances between the routes before it are already in out
+    :param cutoff: pairs with a lower bound of mae or mse above the cutoff are recorded as far:
+            they get the lower bound instead of the distance, see segment_bounds and
+            prune_cutoff. frechet and dtw are abandoned above the cutoff with a lower bound, see
+            dp_distances. None computes all distances exactly, no pruning for area_comp
+    """
+    if simmeasure not in SMEASURES:
         raise ValueError(f"calc_dist_matrix: simmeasure {simmeasure} unknown")
-    matrix_indices = [(xi, yi) for xi in range(len(df)) for yi in range(len(df))]
-    for mindex in tqdm(matrix_indices, colour="#00ffff", desc="calc dist matrix"):
-        xi, yi = mindex
-        if yi > xi:
-            distance_mat[xi, yi] = sim_fun(df.iloc[xi][compvar], df.iloc[yi][compvar])
-            distance_mat[yi, xi] = distance_mat[xi, yi]
-        elif yi == xi:
-            distance_mat[xi, yi] = 0
-    return distance_mat
+    n = len(df)
+    if out is None:
+        out = np.zeros(n * (n - 1) // 2, dtype=np.float32)
+    assert out.shape == (n * (n - 1) // 2,)
+    if n < 2 or first_new >= n:
+        return out
+    if routes is None:
+        routes = np.stack(df[compvar])
+    # one row of (lon, lat) values per route
+    routes = np.asarray(routes, dtype=np.float64).reshape(n, -1)
+    bounds = None
+    if cutoff is not None and simmeasure in BLOCK_MEASURES:
+        bounds = segment_bounds(routes, simmeasure)
+    elif simmeasure not in DP_MEASURES:
+        cutoff = None
+    size = TILE_ROUTES[simmeasure]
+    cols = [(j, min(j + size, n)) for j in range(first_new, n, size)]
+    tiles = [((i, min(i + size, n)), c) for i in range(0, n, size) for c in cols if i < c[1] - 1]
+    pbar = tqdm(total=len(tiles), colour="#00ffff", desc="calc dist matrix", disable=len(tiles) < 2)
+
+    pruned = 0
+
+    def tile_done(done: int, tile_pruned: int):
+        nonlocal pruned
+        pruned += tile_pruned
+        pbar.update(1)
+        if progress is not None:
+            progress(done, len(tiles))
+        if cancel is not None and cancel.is_set():
+            raise DistMatrixCancelled(f"distance matrix of {n} routes cancelled after {done} of {len(tiles)} tiles")
+        if done == len(tiles) and cutoff is not None:
+            log.info(f"{pruned} route pairs with a lower bound above {cutoff:.3g} recorded as far")
+
+    if executor is None or len(tiles) == 1:
+        with pbar:
+            for done, (rows, cols) in enumerate(tiles, 1):
+                tile_done(done, _fill_tile(routes, out, simmeasure, rows, cols, bounds, cutoff))
+        return out
+    shm_routes, _ = _shared_copy(routes)
+    routes_spec = ("shm", shm_routes.name, routes.shape, routes.dtype.str)
+    shm_out, shm_bounds, bounds_spec = None, None, None
+    if bounds is not None:
+        shm_bounds, _ = _shared_copy(bounds)
+        bounds_spec = ("shm", shm_bounds.name, bounds.shape, bounds.dtype.str)
+    if isinstance(out, np.memmap) and out.filename is not None:
+        # the workers write to the file
+        out.flush()
+        out_spec = ("file", out.filename, out.offset, out.shape, out.dtype.str)
+    else:
+        shm_out, shared_out = _shared_copy(out)
+        out_spec = ("shm", shm_out.name, out.shape, out.dtype.str)
+    futures = [
+        executor.submit(_fill_shared_tile, routes_spec, out_spec, simmeasure, rows, cols, bounds_spec, cutoff)
+        for rows, cols in tiles
+    ]
+    try:
+        with pbar:
+            for done, future in enumerate(as_completed(futures), 1):
+                tile_done(done, future.result())
+        if shm_out is not None:
+            out[:] = shared_out
+        return out
+    finally:
+        # the running tasks still use the shared memory
+        for future in futures:
+            future.cancel()
+        wait(futures)
+        if shm_out is not None:
+            del shared_out
+        for shm in (shm_routes, shm_out, shm_bounds):
+            if shm is not None:
+                shm.close()
+                shm.unlink()
+
+
+def prune_cutoff(routes: np.ndarray, simmeasure: str = "mae", seed: int = 0) -> Optional[float]:
+    """
+    cutoff for calc_dist_condensed: PRUNE_CUTOFF_FACTOR times the RECUT_MAX_QUANTILE of the
+    distances of PRUNE_SAMPLE random pairs of routes, the pairs pruned with it are well
+    above the cut-off of the clustering, also of the recuts of the stored linkages (see
+    cluster_it.recut_clusters). None if there are fewer pairs or no lower bound
+    :param routes: array of shape (number of routes, n_samples, 2)
+    """
+    n = len(routes)
+    if (simmeasure not in BLOCK_MEASURES and simmeasure not in DP_MEASURES) or n * (n - 1) // 2 <= PRUNE_SAMPLE:
+        return None
+    routes = np.asarray(routes, dtype=np.float64).reshape(n, -1)
+    rng = np.random.default_rng(seed)
+    x, y = rng.integers(0, n, size=(2, PRUNE_SAMPLE))
+    x, y = x[x != y], y[x != y]
+    if simmeasure in DP_MEASURES:
+        points = routes.reshape(n, -1, 2)
+        sample = np.concatenate(
+            [
+                dp_distances(points[x[k : k + DP_PAIRS]], points[y[k : k + DP_PAIRS]], simmeasure)[0]
+                for k in range(0, len(x), DP_PAIRS)
+            ]
+        )
+    else:
+        chunk = max(1, BLOCK_ELEMENTS // routes.shape[1])
+        sample = np.concatenate(
+            [
+                BLOCK_MEASURES[simmeasure](routes[x[k : k + chunk]] - routes[y[k : k + chunk]]).mean(axis=1)
+                for k in range(0, len(x), chunk)
+            ]
+        )
+    return PRUNE_CUTOFF_FACTOR * float(np.quantile(sample, RECUT_MAX_QUANTILE))
 
 
+def _copy_distances(old: np.ndarray, n_old: int, positions: np.ndarray, out: np.ndarray, n: int):
+    """
+    copy the distances between the routes at positions of the condensed vector old to the
+    first len(positions) routes of the condensed vector out
+    """
+    positions = np.asarray(positions, dtype=np.int64)
+    for a in range(len(positions) - 1):
+        k = _row_start(n, a) + a + 1
+        out[k : k + len(positions) - a - 1] = old[_row_start(n_old, positions[a]) + positions[a + 1 :]]
+
+
+def calc_dist_matrix(
+    df: pd.DataFrame,
+    simmeasure: str = "mae",
+    compvar: str = "route_inter",
+    routes: Optional[np.ndarray] = None,
+    executor: Optional[Executor] = None,
+    progress: Optional[Callable[[int, int], None]] = None,
+    cancel: Optional[threading.Event] = None,
+    cutoff: Optional[float] = None,
+) -> np.ndarray:
+    """
+    symmetric float64 matrix of the distances between all routes of df, see
+    calc_dist_condensed for the parameters
+    """
+    n = len(df)
+    condensed = calc_dist_condensed(
+        df,
+        simmeasure=simmeasure,
+        compvar=compvar,
+        routes=routes,
+        executor=executor,
+        progress=progress,
+        cancel=cancel,
+        out=np.zeros(n * (n - 1) // 2),
+        cutoff=cutoff,
+    )
+    return squareform(condensed) if n > 0 else np.zeros((0, 0))
 
 
-def calc_dist_matrix_per_se_cluster(d: pd.DataFrame, simmeasure: str = "mae") -> dict:
+def calc_dist_matrix_per_se_cluster(
+    d: pd.DataFrame,
+    simmeasure: str = "mae",
+    routes: Optional[RouteStore] = None,
+    workers: Optional[int] = None,
+    cancel: Optional[threading.Event] = None,
+    store: Optional[DistStore] = None,
+    changed: Optional[set] = None,
+    exact: bool = False,
+    max_routes: Optional[int] = None,
+) -> dict:
     """
-    Look for the given pickle file and update it with the distance
-    matrix if necessary, i.e. if the updated flag is set
-    :return : dictionary with the distance matrix and the indices (column filename) for each startendcluster
+    condensed float32 distance vectors of the routes of each startendcluster
+    With a DistStore, the stored distances of a startendcluster are reused: only the
+    distances to routes that are new in the startendcluster are computed. The distances
+    are computed from scratch if less than REUSE_MIN_FRACTION of the routes are known,
+    e.g. because the startendclusters have changed
+    :param routes: RouteStore with the routes of d, if d has no route_inter column
+    :param workers: number of processes for the distance matrices, default is the number of
+            cores. The process pool is only started if a matrix has more than one tile
+    :param cancel: stop with DistMatrixCancelled when this event is set, see calc_dist_matrix
+    :param store: DistStore of the session, the distances are written to its memory mapped
+            files instead of held in memory
+    :param changed: filenames of routes that have changed since the distances were stored
+    :param exact: compute all distances exactly, by default pairs with a lower bound well above
+            the cut-off of the clustering are pruned, see prune_cutoff. Stored distances are
+            updated with the cutoff they were pruned with
+    :param max_routes: startendclusters with more routes get no distances (None), they are
+            clustered with cluster_it.calc_cluster_sparse
+    :return : dictionary with the condensed distances and the indices (column filename) for each
+            startendcluster, see cluster_it.calc_cluster_from_dist. With a store, the routes
+            of a startendcluster are in the stored order followed by the new routes
     """
     dists = {}
+    changed = set() if changed is None else set(changed)
     startendclusters = list(d.startendcluster.cat.categories)
     log.debug(f"distance mat clusters: {' '.join([str(x) for x in startendclusters])}")
-    for a in startendclusters:
-        log.info(f"distance matrix for routes in startendcluster {a}")
-        dsub = d[d.startendcluster == a]
-        dists[str(a) + "_filenamen"] = list(dsub.loc[:, "filename"])
-        dists[a] = calc_dist_matrix(dsub, simmeasure=simmeasure)
+    sizes = d.startendcluster.value_counts()
+    if max_routes is not None:
+        sizes = sizes[sizes <= max_routes]
+    largest = sizes.max() if len(sizes) > 0 else 0
+    executor = dist_matrix_executor(workers) if largest > TILE_ROUTES.get(simmeasure, largest) else None
+    try:
+        for a in startendclusters:
+            dsub = d[d.startendcluster == a]
+            filenames = list(dsub.loc[:, "filename"])
+            if max_routes is not None and len(dsub) > max_routes:
+                log.info(f"no distance matrix for the {len(dsub)} routes in startendcluster {a}")
+                dists[str(a) + "_filenamen"], dists[a] = filenames, None
+                continue
+            stored = None if store is None else store.get(a, simmeasure, exact=exact)
+            if stored is not None:
+                present = set(filenames) - changed
+                keep = [(i, fn) for i, fn in enumerate(stored[0]) if fn in present]
+                if len(keep) < REUSE_MIN_FRACTION * len(filenames):
+                    stored = None
+            if stored is not None and [fn for _, fn in keep] == stored[0] == filenames:
+                log.info(f"distance matrix for routes in startendcluster {a} unchanged")
+                dists[str(a) + "_filenamen"], dists[a] = stored
+                continue
+            out = None if store is None else store.create(a, len(dsub))
+            first_new = 0
+            if stored is not None:
+                known = [fn for _, fn in keep]
+                added = set(filenames) - set(known)
+                filenames = known + [fn for fn in filenames if fn in added]
+                dsub = dsub.set_index("filename", drop=False).loc[filenames]
+                _copy_distances(stored[1], len(stored[0]), [i for i, _ in keep], out, len(filenames))
+                first_new = len(known)
+            log.info(f"distance matrix for {len(dsub) - first_new} of {len(dsub)} routes in startendcluster {a}")
+            dists[str(a) + "_filenamen"] = filenames
+            sub_routes = np.stack(dsub.route_inter) if routes is None else routes.routes_for(dsub)
+            cutoff = None
+            if not exact:
+                cutoff = store.cutoff(a) if stored is not None else None
+                cutoff = prune_cutoff(sub_routes, simmeasure) if cutoff is None else cutoff
+            dists[a] = calc_dist_condensed(
+                dsub,
+                simmeasure=simmeasure,
+                routes=sub_routes,
+                executor=executor,
+                cancel=cancel,
+                out=out,
+                first_new=first_new,
+                cutoff=cutoff,
+            )
+            if store is not None:
+                if isinstance(dists[a], np.memmap):
+                    dists[a].flush()
+                store.save(a, filenames, simmeasure, cutoff)
+                dists[a] = store.get(a)[1]
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    if store is not None:
+        store.remove_other([a for a in startendclusters if dists[a] is not None])
     return dists
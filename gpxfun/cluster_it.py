@@ -7,30 +7,114 @@ import numpy as np
 import pandas as pd
 from typing import Optional
 from scipy.cluster.hierarchy import average, fcluster
+from scipy.spatial import KDTree
 from scipy.spatial.distance import squareform
 from sklearn.metrics.pairwise import pairwise_distances
 import logging
 
+from .linkage_store import DIST_QUANTILES, LinkageStore
+from .route_index import RouteIndex
+
 log = logging.getLogger("gpxfun." + __name__)
 
+# the clusters of routes are cut at this quantile of their distances
+CLUSTER_QUANTILE = 0.3
+# largest quantile the stored linkages can be recut at, see recut_clusters. The pruned
+# distances are exact up to this quantile, see calc_dist_matrix.prune_cutoff
+RECUT_MAX_QUANTILE = 0.6
+# startendclusters with more routes are clustered on a sparse graph of the route sketches
+# instead of a distance matrix, see calc_cluster_sparse
+SPARSE_MIN_ROUTES = 3000
+# routes with at least this many routes (themselves included) within eps are core routes of DBSCAN
+SPARSE_MIN_SAMPLES = 5
+# eps is this multiple of the median distance of the routes to their SPARSE_MIN_SAMPLES-th neighbour
+SPARSE_EPS_FACTOR = 2.0
+# minimal eps in km, the sketches of repeated rides can be identical
+SPARSE_MIN_EPS = 0.01
+
 
 def calc_cluster_from_dist(
     distm,
     indices: list,
     clusterlabel: str = "cluster",
     min_routes_per_cluster: Optional[int] = None,
+    quantile: float = CLUSTER_QUANTILE,
 ):
     """
     From a distance matrix distm, calculate the clusters
     returns a pd.DataFrame with a cluster label for each index in indices
     cluster labels get suffix given in clusterlabel
-    :param distm: distance matrix must be of shape (len(indices),len(indices))
+    :param distm: distance matrix must be of shape (len(indices),len(indices)), or the
+            condensed distances (upper triangle) of calc_dist_matrix.calc_dist_condensed
+    :param quantile: the dendrogram is cut at this quantile of the distances
     """
-    # confusing: squareform transforms to upperdiagmatrix when called on a square matrix
     log.debug(f"calc_cluster_from_dist {distm.shape}")
-    updiagm = squareform(distm)
-    Z = average(updiagm)
-    cluster_labels = fcluster(Z, np.quantile(updiagm, 0.3), criterion="distance")
+    Z, quantiles = linkage_from_dist(distm)
+    return cut_linkage(Z, quantiles, indices, clusterlabel, min_routes_per_cluster, quantile)
+
+
+def linkage_from_dist(distm) -> tuple[np.ndarray, np.ndarray]:
+    """average linkage of a distance matrix and its distances at DIST_QUANTILES, see calc_cluster_from_dist"""
+    # confusing: squareform transforms to upperdiagmatrix when called on a square matrix
+    updiagm = distm if np.ndim(distm) == 1 else squareform(distm)
+    return average(updiagm), np.quantile(updiagm, DIST_QUANTILES)
+
+
+def cut_linkage(
+    Z: np.ndarray,
+    quantiles: np.ndarray,
+    indices: list,
+    clusterlabel: str = "cluster",
+    min_routes_per_cluster: Optional[int] = None,
+    quantile: float = CLUSTER_QUANTILE,
+) -> pd.DataFrame:
+    """
+    clusters of the dendrogram of linkage_from_dist cut at a quantile of the distances, the
+    distance of the quantile is interpolated between DIST_QUANTILES
+    :return: see calc_cluster_from_dist
+    """
+    cluster_labels = fcluster(Z, np.interp(quantile, DIST_QUANTILES, quantiles), criterion="distance")
+    return _label_clusters(indices, cluster_labels, clusterlabel, min_routes_per_cluster)
+
+
+def calc_cluster_sparse(
+    sketches: np.ndarray,
+    indices: list,
+    clusterlabel: str = "cluster",
+    min_routes_per_cluster: Optional[int] = None,
+    eps: Optional[float] = None,
+) -> pd.DataFrame:
+    """
+    clusters of routes from the route sketches within eps of each other (see
+    route_index.route_sketches) with DBSCAN on a KDTree, without a distance matrix of all pairs.
+    Routes which aren't density reachable from a core route are in <clusterlabel>_other
+    :param sketches: array of shape (len(indices), 2 * SKETCH_POINTS), e.g. from RouteIndex.sketches_for
+    :param eps: distance of the sketches in km, default is SPARSE_EPS_FACTOR times the median
+            distance to the SPARSE_MIN_SAMPLES-th neighbour, at least SPARSE_MIN_EPS
+    :return: see calc_cluster_from_dist
+    """
+    if eps is None:
+        knn, _ = KDTree(sketches).query(sketches, k=min(SPARSE_MIN_SAMPLES, len(sketches)))
+        eps = SPARSE_EPS_FACTOR * float(np.median(np.reshape(knn, (len(sketches), -1))[:, -1]))
+    eps = max(eps, SPARSE_MIN_EPS)
+    log.debug(f"calc_cluster_sparse {len(sketches)} routes, eps {eps:.3g} km")
+    cluster_labels = DBSCAN(
+        eps=eps, min_samples=SPARSE_MIN_SAMPLES, metric="euclidean", algorithm="kd_tree"
+    ).fit_predict(sketches)
+    noise = cluster_labels == -1
+    indices = np.asarray(indices, dtype=object)
+    dfcluster = pd.DataFrame({"filename": indices[noise], "cluster": f"{clusterlabel}_other"}, index=indices[noise])
+    if not noise.all():
+        clustered = _label_clusters(list(indices[~noise]), cluster_labels[~noise], clusterlabel, min_routes_per_cluster)
+        dfcluster = pd.concat([clustered, dfcluster])
+    dfcluster.index.name = "filename"
+    return dfcluster.loc[list(indices)]
+
+
+def _label_clusters(
+    indices: list, cluster_labels: np.ndarray, clusterlabel: str, min_routes_per_cluster: Optional[int]
+) -> pd.DataFrame:
+    """cluster labels ordered by the size of the cluster, see calc_cluster_from_dist"""
     # reorder cluster labels according to size of cluster
     dfcluster = pd.DataFrame(
         zip(indices, cluster_labels),
@@ -66,31 +150,89 @@ def cluster_all(
     dists: dict,
     se_clusters: pd.DataFrame,
     min_routes_per_cluster: Optional[int] = None,
+    index: Optional[RouteIndex] = None,
+    quantile: float = CLUSTER_QUANTILE,
+    linkages: Optional[LinkageStore] = None,
 ):
-    """Cluster routes grouped by custom locations and write to disk"""
+    """
+    Cluster routes grouped by custom locations and write to disk
+    startendclusters with more than SPARSE_MIN_ROUTES routes, or without distances
+    (see calc_dist_matrix.calc_dist_matrix_per_se_cluster), are clustered with calc_cluster_sparse
+    :param index: RouteIndex with the routes of d, needed for the sparse clustering
+    :param quantile: the dendrograms are cut at this quantile of the distances, see calc_cluster_from_dist
+    :param linkages: store for the linkages of the startendclusters with distances, see recut_clusters
+    """
     log.info(f"cluster_all {len(d)} routes in {len(se_clusters)} startendclusters")
     d["cluster"] = ""
     d.index = d.filename
+    linked = []
     for a in list(se_clusters.startendcluster.cat.categories):
-        dfcluster = calc_cluster_from_dist(
-            dists[a],
-            dists[str(a) + "_filenamen"],
-            clusterlabel=str(a),
-            min_routes_per_cluster=min_routes_per_cluster,
-        )
+        filenames = dists[str(a) + "_filenamen"]
+        if dists.get(a) is None or (index is not None and len(filenames) > SPARSE_MIN_ROUTES):
+            if index is None:
+                raise ValueError(f"cluster_all: no distances for startendcluster {a} and no route index")
+            dfcluster = calc_cluster_sparse(
+                index.sketches_for(filenames),
+                filenames,
+                clusterlabel=str(a),
+                min_routes_per_cluster=min_routes_per_cluster,
+            )
+        else:
+            Z, quantiles = linkage_from_dist(dists[a])
+            if linkages is not None:
+                linkages.save(a, filenames, Z, quantiles)
+                linked.append(a)
+            dfcluster = cut_linkage(Z, quantiles, filenames, str(a), min_routes_per_cluster, quantile)
         assert d.columns.duplicated().any() == False
         try:
             d.update(dfcluster, join="left")
         except:
             breakpoint()
+    if linkages is not None:
+        linkages.remove_other(linked)
+        linkages.save_cut(quantile, min_routes_per_cluster)
     d = d.reset_index(drop=True)
-    clustercombis = d.groupby(["startendcluster", "cluster"])["filename"].count().reset_index()
+    d["cluster"] = d.cluster.astype("category")
+    return d, cluster_combinations(d, se_clusters)
+
+
+def recut_clusters(
+    d: pd.DataFrame,
+    linkages: LinkageStore,
+    quantile: float = CLUSTER_QUANTILE,
+    min_routes_per_cluster: Optional[int] = None,
+) -> pd.DataFrame:
+    """
+    cut the stored linkages of the startendclusters of cluster_all at another quantile of
+    the distances, without the distances. Rides of startendclusters without a linkage keep
+    their cluster, rides of the other startendclusters which aren't in the linkage (e.g.
+    assigned with a ClusterModel after the clustering) get no cluster (NaN)
+    :param d: DataFrame with the columns filename, startendcluster and cluster
+    :param quantile: quantile of the distances, the cuts of pruned distances (see
+            calc_dist_matrix.prune_cutoff) are exact up to RECUT_MAX_QUANTILE
+    """
+    d = d.copy()
+    d["cluster"] = d.cluster.astype(object)
+    for a in d.startendcluster.astype(str).unique():
+        stored = linkages.get(a)
+        if stored is None:
+            continue
+        filenames, Z, quantiles = stored
+        dfcluster = cut_linkage(Z, quantiles, filenames, a, min_routes_per_cluster, quantile)
+        rides = d.startendcluster.astype(str) == a
+        d.loc[rides, "cluster"] = d.filename[rides].map(dfcluster.cluster)
+    log.info(f"recut {len(d)} routes at quantile {quantile}, {d.cluster.nunique()} route clusters")
+    return d
+
+
+def cluster_combinations(d: pd.DataFrame, se_clusters: pd.DataFrame) -> pd.DataFrame:
+    """number of routes of each route cluster with the infos of its startendcluster"""
+    clustercombis = d.groupby(["startendcluster", "cluster"], observed=False)["filename"].count().reset_index()
     clustercombis = clustercombis[clustercombis.filename > 0]
     clustercombis = se_clusters.merge(clustercombis, on="startendcluster")
     clustercombis.startendcluster.astype("category")
     clustercombis.cluster.astype("category")
-    d["cluster"] = d.cluster.astype("category")
-    return d, clustercombis
+    return clustercombis
 
 
 def cluster_it(distm, filenamen: list, clusterlabel: str = "cluster") -> pd.DataFrame:
@@ -0,0 +1,271 @@
+"""
+Model of the start/end clusters and route clusters of a session, to assign new rides to the
+existing clusters without clustering the session again: the center and radius of each
+start/end cluster and the medoid and radius of each route cluster in the sketches of the
+RouteIndex. Labels of a new clustering are matched to the labels of the old one, see match_labels
+"""
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+from gpxpy.geo import Location
+import numpy as np
+import pandas as pd
+
+from .route_index import KM_PER_DEGREE, RouteIndex
+
+log = logging.getLogger("gpxfun." + __name__)
+
+CLUSTER_MODEL_FILE = "cluster_model.json"
+# quantile of the distances of the rides of a cluster to its center or medoid used as radius
+MODEL_RADIUS_QUANTILE = 0.95
+# minimal radius around the start and end points of a start/end cluster, as in infer_start_end
+SE_MIN_RADIUS_KM = 0.15
+# minimal radius around the medoid of a route cluster
+ROUTE_MIN_RADIUS_KM = 0.1
+# the session is clustered again when the rides added since the last clustering exceed this
+# fraction of the rides of the last clustering
+DRIFT_MAX_ADDED = 0.5
+# or when the fraction of added rides outside of the route clusters exceeds the fraction
+# of the last clustering by this, evaluated from DRIFT_MIN_RIDES added rides on
+DRIFT_MAX_UNASSIGNED = 0.2
+DRIFT_MIN_RIDES = 10
+
+START_END_COLUMNS = ["start_lat", "start_lon", "ende_lat", "ende_lon"]
+
+
+def start_end_coords(d: pd.DataFrame) -> pd.DataFrame:
+    """the columns START_END_COLUMNS from the start and ende Locations, as in infer_start_end"""
+    return pd.DataFrame(
+        {
+            "start_lat": [x.latitude for x in d.start],
+            "start_lon": [x.longitude for x in d.start],
+            "ende_lat": [x.latitude for x in d.ende],
+            "ende_lon": [x.longitude for x in d.ende],
+        },
+        index=d.index,
+    )
+
+
+def _km(lat: np.ndarray, lon: np.ndarray, lat0: float, lon0: float) -> np.ndarray:
+    """approximate distance in km of points to a point nearby"""
+    return KM_PER_DEGREE * np.hypot(np.asarray(lat) - lat0, (np.asarray(lon) - lon0) * np.cos(np.radians(lat0)))
+
+
+def unassigned(cluster: pd.Series) -> pd.Series:
+    """True for rides which aren't in a route cluster, see cluster_it.calc_cluster_from_dist"""
+    return cluster.astype(str).str.endswith("_other")
+
+
+def match_labels(old: pd.Series, new: pd.Series) -> dict:
+    """
+    mapping of labels of a new clustering to the labels of an old clustering, both indexed by
+    filename. The pairs of a new and an old label with the most common rides are matched first,
+    new labels without common rides with a free old label aren't in the mapping
+    """
+    common = old.index.intersection(new.index)
+    if len(common) == 0:
+        return {}
+    counts = pd.crosstab(new[common].astype(str), old[common].astype(str)).stack()
+    mapping, used = {}, set()
+    for (n, o), count in counts[counts > 0].sort_values(ascending=False, kind="stable").items():
+        if n not in mapping and o not in used:
+            mapping[n] = o
+            used.add(o)
+    return mapping
+
+
+def stable_startend_labels(d: pd.DataFrame, se_clusters: pd.DataFrame, old: pd.Series) -> tuple:
+    """
+    rename the startendclusters of a new clustering to the labels of the old clustering, new
+    startendclusters get numbers after the old ones
+    :param old: startendcluster of the last clustering indexed by filename
+    :return: d and se_clusters with the renamed startendclusters
+    """
+    new = d.set_index("filename").startendcluster
+    mapping = match_labels(old[old.astype(str) != "other"], new[new.astype(str) != "other"])
+    numbers = [int(x) for x in list(old.astype(str).unique()) if x.isdigit()]
+    fresh = max(numbers, default=-1) + 1
+    renamed = {}
+    for label in d.startendcluster.cat.categories:
+        if str(label) == "other":
+            renamed[label] = label
+        elif str(label) in mapping:
+            renamed[label] = int(mapping[str(label)])
+        else:
+            renamed[label], fresh = fresh, fresh + 1
+    d = d.copy()
+    d["startendcluster"] = d.startendcluster.cat.rename_categories(renamed)
+    se_clusters = se_clusters.copy()
+    se_clusters["startendcluster"] = se_clusters.startendcluster.map(renamed).astype("category")
+    return d, se_clusters
+
+
+def stable_route_labels(d: pd.DataFrame, old: pd.Series) -> dict:
+    """
+    mapping of the route clusters of a new clustering to the labels of the old clustering,
+    new route clusters get numbers after the old ones of their startendcluster
+    :param old: cluster of the last clustering indexed by filename
+    """
+    new = d.set_index("filename").cluster
+    mapping = match_labels(old[~unassigned(old)], new[~unassigned(new)])
+    taken = set(old.astype(str)) | set(mapping.values())
+    renamed = {}
+    for label in new.astype(str).unique():
+        if label.endswith("_other"):
+            renamed[label] = label
+        elif label in mapping:
+            renamed[label] = mapping[label]
+        else:
+            se = label.rsplit("_", 1)[0]
+            k = 0
+            while f"{se}_{k}" in taken:
+                k += 1
+            renamed[label] = f"{se}_{k}"
+            taken.add(renamed[label])
+    return renamed
+
+
+class ClusterModel(object):
+    """
+    Centers and radii of the start/end clusters and medoids and radii of the route clusters
+    of a session in cluster_model.json, with the number of rides assigned since the clustering
+    """
+
+    def __init__(
+        self,
+        startend: list[dict],
+        routes: list[dict],
+        n_rides: int,
+        unassigned_fraction: float,
+        added: int = 0,
+        added_unassigned: int = 0,
+        changed: Optional[list] = None,
+    ):
+        """
+        :param startend: startendcluster, START_END_COLUMNS and radius_km of each startendcluster
+        :param routes: startendcluster, cluster, medoid filename, sketch and radius_km of each route cluster
+        :param changed: files which have changed since the clustering, their stored distances aren't valid
+        """
+        self.startend = startend
+        self.routes = routes
+        self.n_rides = n_rides
+        self.unassigned_fraction = unassigned_fraction
+        self.added = added
+        self.added_unassigned = added_unassigned
+        self.changed = [] if changed is None else changed
+
+    @classmethod
+    def fit(cls, d: pd.DataFrame, se_clusters: pd.DataFrame, index: RouteIndex) -> "ClusterModel":
+        """
+        model of a clustered session
+        :param d: DataFrame with the columns filename, START_END_COLUMNS, startendcluster and cluster
+        :param se_clusters: centers of the startendclusters, see infer_start_end
+        :param index: RouteIndex with the routes of d
+        """
+        startend = []
+        for row in se_clusters.itertuples():
+            label = "other" if str(row.startendcluster) == "other" else int(row.startendcluster)
+            rides = d[d.startendcluster.astype(str) == str(row.startendcluster)]
+            dist = np.maximum(
+                _km(rides.start_lat, rides.start_lon, row.start_lat, row.start_lon),
+                _km(rides.ende_lat, rides.ende_lon, row.ende_lat, row.ende_lon),
+            )
+            radius = max(SE_MIN_RADIUS_KM, float(np.quantile(dist, MODEL_RADIUS_QUANTILE))) if len(dist) else 0.0
+            startend.append(
+                {"startendcluster": label, "radius_km": radius}
+                | {c: float(getattr(row, c)) for c in START_END_COLUMNS}
+            )
+        routes = []
+        for (se, cluster), rides in d[~unassigned(d.cluster)].groupby(
+            [d.startendcluster.astype(str), d.cluster.astype(str)]
+        ):
+            sketches = index.sketches_for(rides.filename)
+            # the ride closest to the mean sketch of the cluster
+            medoid = np.argmin(((sketches - sketches.mean(axis=0)) ** 2).sum(axis=1))
+            dist = np.sqrt(((sketches - sketches[medoid]) ** 2).sum(axis=1))
+            routes.append(
+                {
+                    "startendcluster": se,
+                    "cluster": cluster,
+                    "medoid": str(rides.filename.iloc[medoid]),
+                    "sketch": sketches[medoid].tolist(),
+                    "radius_km": max(ROUTE_MIN_RADIUS_KM, float(np.quantile(dist, MODEL_RADIUS_QUANTILE))),
+                }
+            )
+        log.info(f"cluster model of {len(startend)} startendclusters and {len(routes)} route clusters")
+        return cls(startend, routes, len(d), float(unassigned(d.cluster).mean()) if len(d) else 0.0)
+
+    @classmethod
+    def load(cls, folder: Path) -> Optional["ClusterModel"]:
+        """model of a session folder, None if the session has none"""
+        path = Path(folder) / CLUSTER_MODEL_FILE
+        if not path.is_file():
+            return None
+        with open(path) as f:
+            return cls(**json.load(f))
+
+    def save(self, folder: Path):
+        tmp = Path(folder) / (CLUSTER_MODEL_FILE + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump(self.__dict__, f)
+        os.replace(tmp, Path(folder) / CLUSTER_MODEL_FILE)
+
+    def assign(self, d: pd.DataFrame, sketches: np.ndarray) -> pd.DataFrame:
+        """
+        assign rides to the nearest startendcluster with the start and end point within its
+        radius, "other" otherwise, and to the route cluster of the startendcluster with the
+        nearest medoid within its radius, "<startendcluster>_other" otherwise
+        :param d: DataFrame with the columns filename, start and ende
+        :param sketches: sketches of the routes of d, see RouteIndex.sketches_for
+        :return: DataFrame with the columns filename, START_END_COLUMNS, startendcluster and cluster
+        """
+        result = pd.concat([d[["filename"]], start_end_coords(d)], axis=1)
+        se = np.full(len(d), "other", dtype=object)
+        best = np.full(len(d), np.inf)
+        for c in self.startend:
+            if str(c["startendcluster"]) == "other":
+                continue
+            dist = np.maximum(
+                _km(result.start_lat, result.start_lon, c["start_lat"], c["start_lon"]),
+                _km(result.ende_lat, result.ende_lon, c["ende_lat"], c["ende_lon"]),
+            )
+            closer = (dist <= c["radius_km"]) & (dist < best)
+            se[closer], best[closer] = c["startendcluster"], dist[closer]
+        cluster = np.array([f"{x}_other" for x in se], dtype=object)
+        best = np.full(len(d), np.inf)
+        for c in self.routes:
+            dist = np.sqrt(((sketches - np.array(c["sketch"])) ** 2).sum(axis=1))
+            closer = (se.astype(str) == c["startendcluster"]) & (dist <= c["radius_km"]) & (dist < best)
+            cluster[closer], best[closer] = c["cluster"], dist[closer]
+        result["startendcluster"], result["cluster"] = se, cluster
+        self.added += len(d)
+        self.added_unassigned += int(unassigned(result.cluster).sum())
+        return result
+
+    def drift(self) -> dict:
+        """
+        added: rides assigned since the clustering as fraction of the rides of the clustering
+        unassigned: fraction of the assigned rides outside of the route clusters compared to the clustering
+        """
+        return {
+            "added": self.added / max(self.n_rides, 1),
+            "unassigned": self.added_unassigned / max(self.added, 1) - self.unassigned_fraction,
+        }
+
+    def needs_recluster(self) -> bool:
+        """True if the assigned rides drifted too far from the clustering, see DRIFT_MAX_ADDED"""
+        drift = self.drift()
+        return drift["added"] > DRIFT_MAX_ADDED or (
+            self.added >= DRIFT_MIN_RIDES and drift["unassigned"] > DRIFT_MAX_UNASSIGNED
+        )
+
+    def startend_table(self) -> pd.DataFrame:
+        """the startendclusters as returned by infer_start_end"""
+        se_clusters = pd.DataFrame(self.startend).drop(columns="radius_km")
+        se_clusters["startendcluster"] = se_clusters.startendcluster.astype("category")
+        se_clusters["start"] = [Location(a, b, None) for a, b in zip(se_clusters.start_lat, se_clusters.start_lon)]
+        se_clusters["ende"] = [Location(a, b, None) for a, b in zip(se_clusters.ende_lat, se_clusters.ende_lon)]
+        return se_clusters
@@ -0,0 +1,49 @@
+"""
+Calendar features of the local start times of the routes, derived for a whole column at once
+"""
+import logging
+
+import pandas as pd
+
+from utils.utilities import season_of_dates
+
+log = logging.getLogger("gpxfun." + __name__)
+
+WEEKDAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday", "Saturday", "Sunday"]
+
+
+def local_wall_time(dts: pd.Series) -> pd.Series:
+    """
+    naive local datetimes of timezone aware datetimes
+    :param dts: Series with dtype datetime64[ns, tz] or an object Series with
+            timestamps of different timezones, see timezones.localize_datetimes
+    """
+    if isinstance(dts.dtype, pd.DatetimeTZDtype):
+        return dts.dt.tz_localize(None)
+    local = pd.Series(pd.NaT, index=dts.index, dtype="datetime64[ns]")
+    tzs = pd.Series([None if pd.isna(x) else str(x.tzinfo) for x in dts], index=dts.index)
+    for tz in tzs.dropna().unique():
+        mask = tzs == tz
+        local[mask] = pd.to_datetime(dts[mask], utc=True).dt.tz_convert(tz).dt.tz_localize(None)
+    return local
+
+
+def date_features(dts: pd.Series) -> pd.DataFrame:
+    """
+    calendar features of local start datetimes
+    :param dts: timezone aware start datetimes, see local_wall_time
+    :return: DataFrame with the columns date, starttime, starttimefloat, month, weekday, season
+    """
+    local = local_wall_time(dts)
+    log.debug(f"date features of {len(local)} datetimes")
+    return pd.DataFrame(
+        {
+            "date": local.dt.date,
+            "starttime": local.dt.time,
+            "starttimefloat": local.dt.hour + local.dt.minute / 60.0,
+            "month": local.dt.month,
+            "weekday": local.dt.day_name(),
+            "season": season_of_dates(local),
+        },
+        index=dts.index,
+    )
@@ -0,0 +1,104 @@
+"""
+Distance matrices of the start/end clusters of a session as condensed float32 vectors
+(the upper triangle, see scipy.spatial.distance.squareform) in memory mapped files
+"""
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+log = logging.getLogger("gpxfun." + __name__)
+
+DISTS_FOLDER = "dists"
+
+
+def condensed_length(n: int) -> int:
+    """length of the condensed distance vector of n routes"""
+    return n * (n - 1) // 2
+
+
+class DistStore(object):
+    """
+    condensed distance vector of each start/end cluster in dists/<cluster>.f32, the filenames
+    of the routes in the order of the matrix, the similarity measure and the cutoff of the
+    pruning in dists/<cluster>.json
+    """
+
+    def __init__(self, folder: Path):
+        """:param folder: session folder"""
+        self.folder = Path(folder) / DISTS_FOLDER
+
+    def _files(self, cluster) -> tuple[Path, Path]:
+        return self.folder / f"{cluster}.f32", self.folder / f"{cluster}.json"
+
+    def create(self, cluster, n: int) -> np.ndarray:
+        """
+        writable memory map for the distances of n routes, the distances are only found
+        by get after they are committed with save
+        """
+        self.folder.mkdir(parents=True, exist_ok=True)
+        data, _ = self._files(cluster)
+        tmp = data.with_suffix(".tmp")
+        if condensed_length(n) == 0:
+            tmp.write_bytes(b"")
+            return np.zeros(0, dtype=np.float32)
+        return np.memmap(tmp, dtype=np.float32, mode="w+", shape=(condensed_length(n),))
+
+    def _meta(self, cluster) -> Optional[dict]:
+        _, index = self._files(cluster)
+        if not index.is_file():
+            return None
+        with open(index) as f:
+            return json.load(f)
+
+    def save(self, cluster, filenames: list, simmeasure: str, cutoff: Optional[float] = None):
+        """
+        commit the distances written to the memory map of create
+        :param cutoff: distances above the cutoff may be lower bounds, see calc_dist_matrix.calc_dist_condensed
+        """
+        data, index = self._files(cluster)
+        os.replace(data.with_suffix(".tmp"), data)
+        tmp = index.with_suffix(".json.tmp")
+        with open(tmp, "w") as f:
+            json.dump({"simmeasure": simmeasure, "cutoff": cutoff, "filenames": [str(x) for x in filenames]}, f)
+        os.replace(tmp, index)
+        log.debug(f"distances of {len(filenames)} routes of startendcluster {cluster} saved")
+
+    def get(
+        self, cluster, simmeasure: Optional[str] = None, exact: bool = False
+    ) -> Optional[tuple[list, np.ndarray]]:
+        """
+        filenames and read only memory map of the condensed distances of a start/end cluster
+        None if there are none, or only for another similarity measure
+        :param exact: None if the distances were pruned
+        """
+        data, _ = self._files(cluster)
+        meta = self._meta(cluster)
+        if meta is None:
+            return None
+        if simmeasure is not None and meta["simmeasure"] != simmeasure:
+            return None
+        if exact and meta.get("cutoff") is not None:
+            return None
+        n = condensed_length(len(meta["filenames"]))
+        if n == 0:
+            return meta["filenames"], np.zeros(0, dtype=np.float32)
+        return meta["filenames"], np.memmap(data, dtype=np.float32, mode="r", shape=(n,))
+
+    def cutoff(self, cluster) -> Optional[float]:
+        """cutoff of the pruning of the stored distances, None if they are exact or not stored"""
+        meta = self._meta(cluster)
+        return None if meta is None else meta.get("cutoff")
+
+    def remove_other(self, clusters: list):
+        """remove the distances of start/end clusters, which are not in clusters"""
+        if not self.folder.is_dir():
+            return
+        names = {str(x) for x in clusters}
+        for f in self.folder.iterdir():
+            if f.suffix in (".f32", ".json") and f.stem not in names:
+                log.debug(f"remove {f}, startendcluster {f.stem} doesn't exist anymore")
+                f.unlink()
@@ -1,18 +1,38 @@
+from concurrent.futures import ThreadPoolExecutor
 import datetime
+import time
 
 import meteostat
+import numpy as np
 import pandas as pd
 # import pytz
 import logging
+from typing import Optional
 from tqdm import tqdm
 # from gpxpy.geo import Location
 
+from .weather_cache import HOUR_NS, WEATHER_COLUMNS, WeatherCache, get_weather_cache, to_hours
+
 log = logging.getLogger("gpxfun." + __name__)
 
+# size of the location cells in degrees (about 10 km), the rides starting in a cell
+# share one meteostat query per year and the records in the weather cache
+WEATHER_CELL_DEGREES = 0.1
+# the weather of a ride is the first hourly record within this time after the start
+WEATHER_TOLERANCE = pd.Timedelta(hours=1, minutes=1)
+# number of concurrent meteostat queries
+WEATHER_WORKERS = 8
+# a failed query is repeated after WEATHER_BACKOFF, 2 * WEATHER_BACKOFF, ... seconds
+WEATHER_RETRIES = 3
+WEATHER_BACKOFF = 1.0
+
 
-def get_weather(d: pd.DataFrame, dt_col: str = "startdatetime", loc_col: str = "start") -> pd.DataFrame:
+def get_weather(
+    d: pd.DataFrame, dt_col: str = "startdatetime", loc_col: str = "start", cache: Optional[WeatherCache] = None
+) -> pd.DataFrame:
     """
     Get weather data from meteostat and attach it to the DataFrame
+    The rows are fetched together, see get_weather_batch
     :param d: pandas DataFrame with date and location data
     :type d: pandas.DataFrame
     :param dt_col: column name of d containing the datetime data
@@ -20,55 +40,180 @@ def get_weather(d: pd.DataFrame, dt_col: str = "startdatetime", loc_col: str = "
     :type dt_col: str
     :param loc_col: column name of d containing the location data. Elements in
             this column most have longitude and latitude and elevation attributes
+    :param cache: weather cache, default is get_weather_cache(). In offline mode the
+            rows without cached weather have no time and NaN values
     """
-    awd = pd.DataFrame()
-    for index, row in (
-        pbar := tqdm(
-            d.iterrows(),
-            colour="#ffcc44",
-            desc="get weather",
-            total=d.shape[0],
-        )
-    ):  # pyright: ignore
-        pbar.set_postfix_str(row[dt_col])  # pyright: ignore
-        dt = row[dt_col].replace(tzinfo=None)  # pyright: ignore
-        wd = meteostat.Hourly(
-            meteostat.Point(
-                row[loc_col].latitude,
-                row[loc_col].longitude,
-                row[loc_col].elevation,  # pyright: ignore
-            ),
-            dt,
-            dt + datetime.timedelta(hours=1),
-            row[dt_col].tzinfo.zone,  # pyright: ignore
-        ).fetch()
-        wd = wd.head(1).reset_index().rename(index={0: index})
-        awd = pd.concat([awd, wd])
-    return pd.merge(d, awd, how="left", left_index=True, right_index=True)
-
-
-def get_weather_dict(dt: datetime.datetime, lat: float, lon: float, ele: float) -> dict:
+    locs = d[loc_col]
+    wd = get_weather_batch(
+        d[dt_col],
+        [x.latitude for x in locs],
+        [x.longitude for x in locs],
+        [np.nan if x.elevation is None else x.elevation for x in locs],
+        cache=cache,
+    )
+    # local time like meteostat.Hourly with the timezone of each row
+    wd["time"] = _to_local(wd.time, d[dt_col])
+    return pd.merge(d, wd, how="left", left_index=True, right_index=True)
+
+
+def get_weather_dict(
+    dt: datetime.datetime, lat: float, lon: float, ele: float, cache: Optional[WeatherCache] = None
+) -> dict:
     """
     gets the weather data from meteostat for a datetime and a latitude
+    an empty dict if there is no weather data, e.g. in offline mode without cached data
     """
     log.debug(f"dt={dt}, lat={lat}, lon={lon}, ele={ele}")
-    if dt.tzinfo == None:
-        timez = "Europe/Berlin"
-        log.warning(f"No timezone included in datetime variable {dt}, defaulting to CET")
-    else:
-        timez = str(dt.tzinfo)
-    dt_dummy = dt.replace(tzinfo=None)
-    wd = meteostat.Hourly(
-        meteostat.Point(lat, lon, int(ele)),
-        dt_dummy,
-        dt_dummy + datetime.timedelta(hours=1, minutes=1),
-        timez,
-    ).fetch()
-    d = dict()
-    if len(wd) > 0:
-        d = wd.iloc[0].to_dict()
-    else:
+    wd = get_weather_batch(pd.Series([dt], dtype=object), [lat], [lon], [ele], cache=cache).iloc[0]
+    if pd.isna(wd["time"]):
         log.warning(f"could not find weather data")
-    return d
+        return dict()
+    return wd[WEATHER_COLUMNS].to_dict()
+
+
+def _to_utc(dts: pd.Series) -> pd.Series:
+    """
+    naive UTC datetimes of timezone aware datetimes, naive datetimes are taken as
+    Europe/Berlin wall time (the later time of ambiguous and shifted forward over
+    nonexistent wall times at the DST changes)
+    """
+    if isinstance(dts.dtype, pd.DatetimeTZDtype):
+        return dts.dt.tz_convert("UTC").dt.tz_localize(None)
+    utc = []
+    for dt in dts:
+        if dt.tzinfo is None:
+            log.warning(f"No timezone included in datetime variable {dt}, defaulting to CET")
+            dt = pd.Timestamp(dt).tz_localize("Europe/Berlin", ambiguous=False, nonexistent="shift_forward")
+        utc.append(pd.Timestamp(dt).tz_convert("UTC").tz_localize(None))
+    return pd.Series(utc, index=dts.index, dtype="datetime64[ns]")
+
+
+def _to_local(utc: pd.Series, dts: pd.Series) -> pd.Series:
+    """naive UTC datetimes in the timezones of the timezone aware datetimes dts"""
+    if isinstance(dts.dtype, pd.DatetimeTZDtype):
+        return utc.dt.tz_localize("UTC").dt.tz_convert(dts.dt.tz)
+    tzs = pd.Series(["Europe/Berlin" if x.tzinfo is None else str(x.tzinfo) for x in dts], index=dts.index)
+    parts = [utc[tzs == tz].dt.tz_localize("UTC").dt.tz_convert(tz) for tz in tzs.unique()]
+    if len(parts) == 1:
+        return parts[0]
+    # like a column of datetimes with different timezones
+    return pd.concat([x.astype(object) for x in parts]).reindex(dts.index)
+
+
+def _fetch_hourly(lat: float, lon: float, ele: float, start: datetime.datetime, end: datetime.datetime):
+    """
+    hourly weather records with UTC times in the column time
+    :return: DataFrame with the column time and the WEATHER_COLUMNS, None if the query
+            still fails after WEATHER_RETRIES retries
+    """
+    for attempt in range(WEATHER_RETRIES + 1):
+        try:
+            wd = meteostat.Hourly(
+                meteostat.Point(lat, lon, None if np.isnan(ele) else int(ele)), start, end
+            ).fetch()
+            break
+        except Exception as e:
+            msg = f"could not get weather data for lat={lat:.2f}, lon={lon:.2f}: {type(e).__name__}: {e}"
+            if attempt == WEATHER_RETRIES:
+                log.error(msg)
+                return None
+            log.warning(f"{msg}, retry {attempt + 1} of {WEATHER_RETRIES}")
+            time.sleep(WEATHER_BACKOFF * 2**attempt)
+    wd = wd.reindex(columns=WEATHER_COLUMNS).astype("float64")
+    wd.index = pd.DatetimeIndex(wd.index, name="time")
+    return wd.reset_index()
+
+
+def _cached_hourly(ilat: int, ilon: int, ele: float, first_hour: int, last_hour: int, cache: WeatherCache):
+    """
+    hourly records of a location cell from the cache, the hours missing in the cache are
+    queried from meteostat first, unless the cache is offline
+    :return: DataFrame with the column time (UTC) and the WEATHER_COLUMNS
+    """
+    missing = cache.missing_hours(ilat, ilon, first_hour, last_hour)
+    if len(missing) > 0 and not cache.offline:
+        # one query for the whole gap, the cached hours in between are refreshed
+        hourly = _fetch_hourly(
+            (ilat + 0.5) * WEATHER_CELL_DEGREES,
+            (ilon + 0.5) * WEATHER_CELL_DEGREES,
+            ele,
+            pd.Timestamp(missing[0] * HOUR_NS).to_pydatetime(),
+            pd.Timestamp(missing[-1] * HOUR_NS).to_pydatetime(),
+        )
+        if hourly is not None:
+            cache.put(ilat, ilon, hourly, missing[0], missing[-1])
+    return cache.get(ilat, ilon, first_hour, last_hour)
 
 
+def get_weather_batch(
+    dts: pd.Series, lats, lons, eles=None, cache: Optional[WeatherCache] = None, workers: int = WEATHER_WORKERS
+) -> pd.DataFrame:
+    """
+    Weather data for many rides with one meteostat query per location cell and year
+    The rides of a cell share the weather of the cell center, each ride gets the first
+    hourly record after its start. The records are cached, only the hours missing in
+    the cache are queried, up to workers queries at the same time
+    :param dts: timezone aware start datetimes of the rides
+    :param lats: array-like with latitudes of the start points
+    :param lons: array-like with longitudes of the start points
+    :param eles: array-like with elevations of the start points, nan if unknown
+    :param cache: weather cache, default is get_weather_cache()
+    :param workers: number of threads for the queries
+    :return: DataFrame with the index of dts, the column time (UTC) and the WEATHER_COLUMNS,
+            NaT and NaN for rides without weather data, e.g. in offline mode without cached data
+    """
+    cache = get_weather_cache() if cache is None else cache
+    rides = pd.DataFrame(
+        {
+            "utc": _to_utc(dts).to_numpy(),
+            "ilat": np.floor(np.asarray(lats, dtype=np.float64) / WEATHER_CELL_DEGREES).astype(np.int64),
+            "ilon": np.floor(np.asarray(lons, dtype=np.float64) / WEATHER_CELL_DEGREES).astype(np.int64),
+            "ele": np.full(len(dts), np.nan) if eles is None else np.asarray(eles, dtype=np.float64),
+        }
+    )
+    # rides with the same location cell and start share the weather data
+    keys = rides[["ilat", "ilon", "utc", "ele"]].drop_duplicates(["ilat", "ilon", "utc"])
+    groups = keys.groupby(["ilat", "ilon", keys.utc.dt.year])
+    log.info(f"weather data for {len(rides)} rides ({len(keys)} different) with {groups.ngroups} queries")
+
+    def hourly_of_group(group) -> pd.DataFrame:
+        (ilat, ilon, _), g = group
+        hourly = _cached_hourly(
+            ilat,
+            ilon,
+            g.ele.median(),
+            to_hours([g.utc.min().ceil("h")])[0],
+            to_hours([g.utc.max() + WEATHER_TOLERANCE])[0],
+            cache,
+        )
+        return hourly.assign(ilat=ilat, ilon=ilon)
+
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, groups.ngroups))) as executor:
+        parts = list(
+            tqdm(
+                executor.map(hourly_of_group, groups),
+                colour="#ffcc44",
+                desc="get weather",
+                total=groups.ngroups,
+                disable=groups.ngroups < 2,
+            )
+        )
+    columns = ["time"] + WEATHER_COLUMNS
+    if len(parts) == 0:
+        return pd.DataFrame(columns=columns, index=dts.index)
+    # the queries of two years of a cell overlap at the turn of the year
+    hourly = pd.concat(parts, ignore_index=True).drop_duplicates(["ilat", "ilon", "time"])
+    keys = pd.merge_asof(
+        keys.sort_values("utc"),
+        hourly.astype({"time": "datetime64[ns]"}).sort_values("time"),
+        left_on="utc",
+        right_on="time",
+        by=["ilat", "ilon"],
+        direction="forward",
+        tolerance=WEATHER_TOLERANCE,
+    )
+    weather = rides.merge(keys.drop(columns="ele"), on=["ilat", "ilon", "utc"], how="left")[columns]
+    if cache.offline and weather.time.isna().any():
+        log.warning(f"offline: no cached weather data for {weather.time.isna().sum()} of {len(weather)} rides")
+    weather.index = dts.index
+    return weather
@@ -0,0 +1,162 @@
+"""
+Gpx files that are not (or not only) files on disk, e.g. uploads kept in memory,
+gzip compressed gpx files and members of zip archives.
+The classes can be used in place of Path objects in the file lists of parse_gpx
+"""
+import gzip
+import io
+import logging
+from pathlib import Path
+import struct
+from typing import BinaryIO
+import zipfile
+
+from utils.utilities import getfilelist
+
+log = logging.getLogger("gpxfun." + __name__)
+
+# suffixes of the files that contain gpx data
+GPX_SUFFIXES = (".gpx", ".gpx.gz", ".zip")
+# gzip header without file name and mtime, followed by a raw deflate stream
+GZIP_HEADER = b"\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"
+
+
+class GpxBytes(object):
+    """content of a gpx file in memory, e.g. a decoded upload"""
+
+    def __init__(self, name: str, data: bytes):
+        self.name = name
+        self.data = data
+
+    @property
+    def suffix(self) -> str:
+        return Path(self.name).suffix
+
+    def open(self) -> BinaryIO:
+        return io.BytesIO(self.data)
+
+    def read_bytes(self) -> bytes:
+        return self.data
+
+    def __str__(self) -> str:
+        return self.name
+
+    def __repr__(self) -> str:
+        return f"GpxBytes({self.name!r}, {len(self.data)} bytes)"
+
+
+class GzipGpx(object):
+    """gzip compressed gpx file, on disk or in memory, it is decompressed while it is parsed"""
+
+    def __init__(self, source):
+        """:param source: Path or GpxBytes of the .gpx.gz file"""
+        self.source = source
+        self.name = source.name[: -len(".gz")]
+
+    @property
+    def suffix(self) -> str:
+        return Path(self.name).suffix
+
+    def open(self) -> BinaryIO:
+        if isinstance(self.source, Path):
+            return gzip.open(self.source, "rb")
+        return gzip.GzipFile(fileobj=self.source.open())
+
+    def read_bytes(self) -> bytes:
+        with self.open() as f:
+            return f.read()
+
+    def __str__(self) -> str:
+        return self.name
+
+    def __repr__(self) -> str:
+        return f"GzipGpx({self.source!r})"
+
+
+def open_gpx(source) -> BinaryIO:
+    """binary file handle of a gpx file given as Path or as one of the classes of this module"""
+    if isinstance(source, (str, Path)):
+        return open(source, "rb")
+    return source.open()
+
+
+def archive_gpx(sources: list, folder: Path):
+    """store gzip compressed copies of the gpx files in a folder, compressed files are copied as they are"""
+    folder = Path(folder)
+    folder.mkdir(parents=True, exist_ok=True)
+    for s in sources:
+        if is_compressed(s):
+            (folder / s.name).write_bytes(s.read_bytes())
+            continue
+        with open_gpx(s) as fin, gzip.open(folder / (s.name + ".gz"), "wb") as fout:
+            fout.write(fin.read())
+    log.debug(f"archived {len(sources)} gpx files in {folder}")
+
+
+def is_gpx_source(name: str) -> bool:
+    """True if a file name has one of the GPX_SUFFIXES"""
+    return str(name).lower().endswith(GPX_SUFFIXES)
+
+
+def _zip_members(source) -> list:
+    """
+    gpx files of a zip archive. Deflated members are not decompressed here, the raw
+    deflate stream is wrapped as gzip data, which is decompressed while it is parsed.
+    Members are named by their file name, members with the same file name in different
+    folders by their path with "_" instead of "/"
+    """
+    members = []
+    with open_gpx(source) as fh, zipfile.ZipFile(fh) as zf:
+        infos = [i for i in zf.infolist() if not i.is_dir() and i.filename.lower().endswith(".gpx")]
+        names = [Path(i.filename).name for i in infos]
+        for info, name in zip(infos, names):
+            if names.count(name) > 1:
+                name = info.filename.strip("/").replace("/", "_")
+            if info.compress_type == zipfile.ZIP_DEFLATED and not info.flag_bits & 0x1:
+                # local file header: 30 bytes, file name and extra field lengths at offset 26
+                fh.seek(info.header_offset)
+                namelength, extralength = struct.unpack("<HH", fh.read(30)[26:30])
+                fh.seek(info.header_offset + 30 + namelength + extralength)
+                data = GZIP_HEADER + fh.read(info.compress_size)
+                data += struct.pack("<LL", info.CRC, info.file_size & 0xFFFFFFFF)
+                members.append(GzipGpx(GpxBytes(name + ".gz", data)))
+            else:
+                members.append(GpxBytes(name, zf.read(info)))
+    log.debug(f"{len(members)} gpx files in {source.name}")
+    return members
+
+
+def is_archive(source) -> bool:
+    return source.name.lower().endswith(".zip")
+
+
+def is_compressed(source) -> bool:
+    """True for .gpx.gz files and zip archives, before they are expanded by expand_gpx_sources"""
+    return not isinstance(source, GzipGpx) and source.name.lower().endswith(GPX_SUFFIXES[1:])
+
+
+def expand_gpx_sources(files: list) -> list:
+    """
+    replace compressed files and archives in a file list by the gpx files they contain,
+    nothing is extracted to disk. Other files are passed through unchanged
+    :param files: list of Path, GpxBytes, GzipGpx objects
+    :return: list of gpx files in the classes of this module or Path objects
+    """
+    expanded = []
+    for f in files:
+        name = f.name.lower()
+        if name.endswith(".gpx.gz") and not isinstance(f, GzipGpx):
+            expanded.append(GzipGpx(f))
+        elif is_archive(f):
+            try:
+                expanded += _zip_members(f)
+            except zipfile.BadZipFile as e:
+                log.error(f"could not read {f.name}: {e}")
+        else:
+            expanded.append(f)
+    return expanded
+
+
+def gpx_files_in(folder: Path) -> list:
+    """the gpx files of a folder and its subfolders, including compressed files and archives"""
+    return [f for suffix in GPX_SUFFIXES for f in getfilelist(folder, suffix=suffix[1:], withpath=True)]
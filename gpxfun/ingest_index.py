@@ -0,0 +1,118 @@
+"""
+Persistent index of the gpx files that are already parsed into a pickle file.
+Files are identified by the hash of their content, size and mtime are kept
+for a cheap check whether a known file is unchanged
+"""
+import hashlib
+import json
+import logging
+from pathlib import Path
+from typing import Callable, Optional
+
+log = logging.getLogger("gpxfun." + __name__)
+
+NEW = "new"
+CHANGED = "changed"
+SKIPPED = "skipped"
+# files with the name of another file of the same batch, they are not parsed
+REJECTED = "rejected"
+
+
+def content_hash(data: bytes) -> str:
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+class IngestIndex(object):
+    """Index of parsed files: filename -> hash, size, mtime and hash -> filename"""
+
+    def __init__(self, path: Path):
+        self.path = Path(path)
+        self.files: dict[str, dict] = {}
+        self.hashes: dict[str, str] = {}
+        self._pending: dict[str, dict] = {}
+        self._pending_hashes: set[str] = set()
+
+    @classmethod
+    def load(cls, path: Path) -> "IngestIndex":
+        """load the index from a json file, an empty index if the file doesn't exist"""
+        index = cls(path)
+        if index.path.is_file():
+            with open(index.path) as f:
+                index.files = json.load(f)["files"]
+            index.hashes = {v["hash"]: k for k, v in index.files.items()}
+        log.debug(f"ingest index {path} with {len(index.files)} files")
+        return index
+
+    def save(self):
+        self.path.parents[0].mkdir(parents=True, exist_ok=True)
+        with open(self.path, "w") as f:
+            json.dump({"files": self.files}, f)
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self.files
+
+    def __len__(self) -> int:
+        return len(self.files)
+
+    def check(self, name: str, size: int, mtime: Optional[float], content: Callable[[], bytes]) -> str:
+        """
+        Classify a file as NEW, CHANGED or SKIPPED (unchanged or a duplicate of a known file),
+        REJECTED if a file with the same name is pending to be registered
+        The content is only read, if size and mtime differ from the index entry
+        :param name: file name, the key of the index
+        :param content: function returning the content of the file
+        """
+        if name in self._pending:
+            log.warning(f"{name} is already pending, files with the same name are rejected")
+            return REJECTED
+        entry = self.files.get(name)
+        if entry is not None and mtime is not None and (entry["size"], entry["mtime"]) == (size, mtime):
+            return SKIPPED
+        digest = content_hash(content())
+        if digest in self.hashes or digest in self._pending_hashes:
+            if entry is not None and entry["hash"] == digest:
+                entry["mtime"] = mtime
+            return SKIPPED
+        self._pending[name] = dict(hash=digest, size=size, mtime=mtime)
+        self._pending_hashes.add(digest)
+        return NEW if entry is None else CHANGED
+
+    def classify(self, filelist: list) -> dict[str, list]:
+        """
+        Classify a list of files on disk, in memory or in archives (see gpx_sources)
+        Only the first of the files with the same name is classified, the others are REJECTED
+        :return: dictionary with lists of the files for NEW, CHANGED, SKIPPED and REJECTED files
+        """
+        report = {NEW: [], CHANGED: [], SKIPPED: [], REJECTED: []}
+        names = set()
+        for f in filelist:
+            if f.name in names:
+                log.warning(f"{f.name} is in the batch more than once, only the first is used")
+                report[REJECTED].append(f)
+                continue
+            names.add(f.name)
+            if isinstance(f, Path):
+                st = f.stat()
+                report[self.check(f.name, st.st_size, st.st_mtime, f.read_bytes)].append(f)
+            else:
+                # no mtime for files in memory or in archives, they are always hashed
+                data = f.read_bytes()
+                report[self.check(f.name, len(data), None, lambda: data)].append(f)
+        log.info(", ".join(f"{len(v)} {k}" for k, v in report.items()))
+        return report
+
+    def register(self, names: list):
+        """
+        add files classified by check to the index, i.e. after they are parsed successfully
+        names which are not pending, e.g. registered already, are ignored
+        """
+        for name in names:
+            entry = self._pending.pop(name, None)
+            if entry is None:
+                continue
+            self._pending_hashes.discard(entry["hash"])
+            old = self.files.get(name)
+            if old is not None and self.hashes.get(old["hash"]) == name:
+                del self.hashes[old["hash"]]
+            self.files[name] = entry
+            self.hashes[entry["hash"]] = name
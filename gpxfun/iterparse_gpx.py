@@ -0,0 +1,96 @@
+"""
+Fast path to read gpx files: the trackpoints are streamed with iterparse
+directly into numpy arrays, without building the gpxpy object graph
+"""
+from array import array
+import datetime
+import logging
+import math
+from xml.etree.ElementTree import ParseError, iterparse
+
+import numpy as np
+
+log = logging.getLogger("gpxfun." + __name__)
+
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class ExoticGpxError(ValueError):
+    """The fast reader cannot handle this gpx file, read it with gpxpy instead"""
+
+
+def _localname(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def _parse_time(text: str) -> int:
+    """parse a gpx timestamp to nanoseconds since epoch (UTC)"""
+    try:
+        dt = datetime.datetime.fromisoformat(text.strip())
+    except ValueError:
+        raise ExoticGpxError(f"time format not supported: {text}")
+    if dt.tzinfo is None:
+        raise ExoticGpxError(f"time without timezone: {text}")
+    return (dt - EPOCH) // datetime.timedelta(microseconds=1) * 1000
+
+
+def read_gpx_arrays(source) -> dict:
+    """
+    Stream the trackpoints of a gpx file into contiguous arrays
+    :param source: file name or binary/text file handle of the gpx file
+    :return: dictionary with the float64 arrays lat, lon, ele (nan, if missing),
+            the int64 array time (nanoseconds since epoch, UTC), the int32 array
+            segment with a running number of the track segment for each point
+            and keywords of the file (None, if not given)
+    :raises ExoticGpxError: if the file contains anything the fast path cannot deal with
+    """
+    lat, lon, ele, time, segment = array("d"), array("d"), array("d"), array("q"), array("i")
+    keywords = None
+    nseg = -1
+    path = []
+    try:
+        for event, elem in iterparse(source, events=("start", "end")):
+            name = _localname(elem.tag)
+            if event == "start":
+                path.append(name)
+                if name == "trkseg":
+                    nseg += 1
+                continue
+            path.pop()
+            if name == "trkpt":
+                if len(path) < 2 or path[-1] != "trkseg":
+                    raise ExoticGpxError("trkpt outside of a track segment")
+                t = None
+                e = math.nan
+                for child in elem:
+                    childname = _localname(child.tag)
+                    if childname == "time" and child.text:
+                        t = _parse_time(child.text)
+                    elif childname == "ele" and child.text:
+                        e = float(child.text)
+                if t is None:
+                    raise ExoticGpxError("trackpoint without time")
+                lat.append(float(elem.attrib["lat"]))
+                lon.append(float(elem.attrib["lon"]))
+                ele.append(e)
+                time.append(t)
+                segment.append(nseg)
+                elem.clear()
+            elif name == "keywords" and path[-1:] in (["metadata"], ["gpx"]):
+                keywords = elem.text
+            elif name in ("trk", "rte", "wpt"):
+                elem.clear()
+    except ParseError as e:
+        raise ExoticGpxError(f"xml parse error: {e}")
+    except KeyError as e:
+        raise ExoticGpxError(f"trackpoint without attribute {e}")
+    if len(lat) < 2:
+        raise ExoticGpxError(f"only {len(lat)} trackpoints")
+    return dict(
+        lat=np.frombuffer(lat, dtype=np.float64),
+        lon=np.frombuffer(lon, dtype=np.float64),
+        ele=np.frombuffer(ele, dtype=np.float64),
+        time=np.frombuffer(time, dtype=np.int64),
+        segment=np.frombuffer(segment, dtype=np.int32),
+        keywords=keywords,
+    )
@@ -0,0 +1,79 @@
+"""
+Linkage matrices of the route clusterings of the start/end clusters of a session, to cut the
+dendrograms at another threshold without the distances, see cluster_it.recut_clusters
+"""
+import io
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+log = logging.getLogger("gpxfun." + __name__)
+
+LINKAGE_FOLDER = "linkage"
+# quantile and minimal cluster size of the last cut of the session
+CUT_FILE = "cut.json"
+# quantiles of the distances stored with a linkage, cuts at other quantiles are interpolated
+DIST_QUANTILES = np.linspace(0, 1, 101)
+
+
+class LinkageStore(object):
+    """
+    linkage matrix Z (see scipy.cluster.hierarchy.average), the filenames of the routes in the
+    order of Z and the distances at DIST_QUANTILES of each start/end cluster in linkage/<cluster>.npz
+    """
+
+    def __init__(self, folder: Path):
+        """:param folder: session folder"""
+        self.folder = Path(folder) / LINKAGE_FOLDER
+
+    def _file(self, cluster) -> Path:
+        return self.folder / f"{cluster}.npz"
+
+    def save(self, cluster, filenames: list, Z: np.ndarray, quantiles: np.ndarray):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        buffer = io.BytesIO()
+        np.savez(buffer, filenames=np.array([str(x) for x in filenames], dtype=str), Z=Z, quantiles=quantiles)
+        tmp = self._file(cluster).with_suffix(".tmp")
+        tmp.write_bytes(buffer.getvalue())
+        os.replace(tmp, self._file(cluster))
+        log.debug(f"linkage of {len(filenames)} routes of startendcluster {cluster} saved")
+
+    def get(self, cluster) -> Optional[tuple[list, np.ndarray, np.ndarray]]:
+        """filenames, linkage matrix and distance quantiles of a start/end cluster, None if there are none"""
+        if not self._file(cluster).is_file():
+            return None
+        with np.load(self._file(cluster)) as f:
+            return [str(x) for x in f["filenames"]], f["Z"], f["quantiles"]
+
+    def clusters(self) -> list[str]:
+        """start/end clusters with a stored linkage"""
+        return [] if not self.folder.is_dir() else sorted(f.stem for f in self.folder.glob("*.npz"))
+
+    def remove_other(self, clusters: list):
+        """remove the linkages of start/end clusters, which are not in clusters"""
+        if not self.folder.is_dir():
+            return
+        names = {str(x) for x in clusters}
+        for f in self.folder.glob("*.npz"):
+            if f.stem not in names:
+                log.debug(f"remove {f}, startendcluster {f.stem} has no linkage anymore")
+                f.unlink()
+
+    def save_cut(self, quantile: float, min_routes_per_cluster: Optional[int]):
+        """remember the cut of the route clusters, see cut"""
+        self.folder.mkdir(parents=True, exist_ok=True)
+        tmp = self.folder / (CUT_FILE + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"quantile": quantile, "min_routes_per_cluster": min_routes_per_cluster}, f)
+        os.replace(tmp, self.folder / CUT_FILE)
+
+    def cut(self) -> Optional[dict]:
+        """quantile and min_routes_per_cluster of the last cut, None if the session has none"""
+        if not (self.folder / CUT_FILE).is_file():
+            return None
+        with open(self.folder / CUT_FILE) as f:
+            return json.load(f)
@@ -1,130 +1,238 @@
 """
 All functions used to import, parse gpx files
 """
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+from itertools import repeat
+import multiprocessing
+import os
 from pathlib import Path
 import pickle
 import logging
+from typing import Callable, Optional
 
 import gpxpy
 import gpxpy.geo
 import gpxpy.gpx
 import numpy as np
 import pandas as pd
-from scipy.interpolate import UnivariateSpline, interp1d
 import pytz
 
-from utils.utilities import getfilelist, season_of_date
 from tqdm import tqdm
-from timezonefinder import TimezoneFinder
-from .get_weather import get_weather_dict
+from .date_features import WEEKDAYS, date_features
+from .get_weather import WEATHER_COLUMNS, get_weather_batch
+from .gpx_sources import GPX_SUFFIXES, expand_gpx_sources, gpx_files_in, is_compressed, open_gpx
+from .ingest_index import CHANGED, NEW, REJECTED, SKIPPED, IngestIndex
+from .iterparse_gpx import EPOCH, ExoticGpxError, read_gpx_arrays
+from .resample_routes import resample_routes
+from .route_index import NEAR_DUPLICATES, RouteIndex
+from .route_store import RouteStore
+from .timezones import localize_datetimes, timezone_at
+from .track_metrics import NO_TIME, track_metrics
 
 log = logging.getLogger("gpxfun."+__name__)
 
 
-def interpolateroutes(r: list) -> list:
-    """
-    interpolates and smoothes a route
-    :param r: list of (lat,lon) tuples containing the route
-    :type r: list
-    """
-    points = np.array([np.array(xx) for xx in r])
-    _, idx = np.unique(points, axis=0, return_index=True)
-    points = points[np.sort(idx)]
-    distance = np.cumsum(np.sqrt(np.sum(np.diff(points, axis=0) ** 2, axis=1)))
-    # these are some magic numbers that work best for cycle distances
-    s = distance[-1] / 10000.0
-    distance = np.insert(distance, 0, 0) / distance[-1]
-    alpha = np.linspace(0, 1, 1000)
-    # smooth the curve
-    splines = [UnivariateSpline(distance, coords, s=s) for coords in points.T]
-    points = np.vstack([spl(alpha) for spl in splines]).T
-    # interpolate to get exactly 1000 points per curve
-    distance = np.cumsum(np.sqrt(np.sum(np.diff(points, axis=0) ** 2, axis=1)))
-    distance = np.insert(distance, 0, 0) / distance[-1]
-    interpolator = interp1d(distance, points, kind="linear", axis=0)
-    points = interpolator(alpha)
-    points = [list(x) for x in list(points)]
-    return points
-
-
-def read_gpx_file(filename: Path, filehandle=None, weather: bool = True) -> dict:
+GPX_BACKENDS = ("iterparse", "gpxpy")
+
+
+def _read_track_gpxpy(filename: Path, filehandle=None) -> dict:
+    """read the points of one gpx file with gpxpy into the arrays of read_gpx_arrays"""
+    if filehandle is None:
+        with open(filename) as fh:
+            g = gpxpy.parse(fh)
+    else:
+        g = gpxpy.parse(filehandle)
+    points = [(si, x) for si, seg in enumerate(s for t in g.tracks for s in t.segments) for x in seg.points]
+    if len(points) == 0:
+        raise ValueError(f"no track points in {filename.name}")
+    totime = lambda dt: (dt if dt.tzinfo else dt.astimezone()) - EPOCH
+    return dict(
+        lat=np.array([x.latitude for _, x in points], dtype=np.float64),
+        lon=np.array([x.longitude for _, x in points], dtype=np.float64),
+        ele=np.array([np.nan if x.elevation is None else x.elevation for _, x in points], dtype=np.float64),
+        time=np.array(
+            [NO_TIME if x.time is None else totime(x.time) // timedelta(microseconds=1) * 1000 for _, x in points],
+            dtype=np.int64,
+        ),
+        segment=np.array([si for si, _ in points], dtype=np.int32),
+        keywords=g.keywords,
+    )
+
+
+def read_gpx_file(
+    filename: Path,
+    filehandle=None,
+    weather: bool = True,
+    backend: str = "iterparse",
+    localize: bool = True,
+    resample: bool = True,
+) -> dict:
     """read one gpxfile
     :param filename: Path containing the gpx file
     :type filename: Path
     :param filehandle: Optional file handle. If given, the data is read from the file
                         handle instead of the file given in filename
+    :param backend: "iterparse" streams the trackpoints into numpy arrays and falls
+                        back to gpxpy for files it cannot handle, "gpxpy" always uses gpxpy
+    :param localize: if False, startdatetime is returned in UTC and the fields derived
+                        from the local time (date, starttime, season, ...) are left out,
+                        so that a caller can localize many files at once
+    :param resample: if False, route_inter contains the raw (lon, lat) points, so that
+                        a caller can resample many routes at once with resample_routes
     :return: dictionary with the results of the parsing
     :rtype: dict
     """
-    log.debug(f"read {filename} {'with' if weather else 'without'} weather data")
+    log.debug(f"read {filename} {'with' if weather else 'without'} weather data ({backend})")
+    if backend not in GPX_BACKENDS:
+        raise ValueError(f"read_gpx_file: backend {backend} unknown, expected one of {GPX_BACKENDS}")
+    arrays = None
+    if backend == "iterparse":
+        try:
+            arrays = read_gpx_arrays(filename if filehandle is None else filehandle)
+        except ExoticGpxError as e:
+            log.info(f"{filename.name}: {e}, read with gpxpy")
+            if filehandle is not None:
+                filehandle.seek(0)
+    if arrays is None:
+        arrays = _read_track_gpxpy(filename, filehandle)
+    lat, lon, ele, time = arrays["lat"], arrays["lon"], arrays["ele"], arrays["time"]
+    m = track_metrics(lat, lon, ele, time, arrays["segment"])
+    location = lambda i: gpxpy.geo.Location(float(lat[i]), float(lon[i]), None if np.isnan(ele[i]) else float(ele[i]))
     p = {}
     p["filename"] = filename.name
-    if filehandle is None:
-        with open(filename) as fh:
-            g = gpxpy.parse(fh)
+    p["distance"] = m["distance"]
+    p["duration"] = m["duration"] / 60
+    p["moving_duration"] = m["moving_time"] / 60
+    p["keywords"] = "" if arrays["keywords"] is None else arrays["keywords"]
+    # same as gpxpy's get_uphill_downhill().downhill, used until now
+    p["uphill"] = m["downhill"]
+    p["start"] = location(0)
+    starttime = EPOCH + timedelta(microseconds=int(time[time != NO_TIME][0] // 1000))
+    if localize:
+        tz = timezone_at(p["start"].latitude, p["start"].longitude)
+        p["startdatetime"] = starttime.astimezone(pytz.timezone(tz))
     else:
-        g = gpxpy.parse(filehandle)
-    p["distance"] = gpxpy.gpx.GPX.length_3d(g)
-    p["duration"] = gpxpy.gpx.GPX.get_duration(g) / 60  # pyright: ignore
-    p["keywords"] = "" if g.keywords is None else g.keywords
-    p["uphill"] = g.get_uphill_downhill().downhill
-    x = g.get_points_data()[0]
-    p["start"] = gpxpy.geo.Location(
-        latitude=x.point.latitude,
-        longitude=x.point.longitude,
-        elevation=x.point.elevation,
-    )
-    tf = TimezoneFinder()  # reuse
-    tz = tf.timezone_at(lng=x.point.longitude, lat=x.point.latitude)  #
-    p["startdatetime"] = g.get_time_bounds().start_time.astimezone(  # pyright: ignore
-        pytz.timezone(tz)
-    )
+        p["startdatetime"] = starttime.astimezone(pytz.utc)
     if weather:
-        wd = get_weather_dict(
-            p["startdatetime"], x.point.latitude, x.point.longitude, x.point.elevation
-        )
-        p = p | wd
-    p["date"] = p["startdatetime"].date()  # pyright: ignore
-    p["starttime"] = p["startdatetime"].time()  # pyright: ignore
-    p["starttimefloat"] = p["starttime"].hour + p["starttime"].minute / 60.0
-    p["month"] = p["date"].month
-    p["weekday"] = p["date"].strftime("%A")
-    p["season"] = season_of_date(p["date"])
-    x = g.get_points_data()[-1]
-    p["ende"] = gpxpy.geo.Location(
-        latitude=x.point.latitude,
-        longitude=x.point.longitude,
-        elevation=x.point.elevation,
-    )
-    p["distance_crow"] = p["ende"].distance_3d(p["start"])
-    route = list(
-        map(lambda x: [x.point.longitude, x.point.latitude], g.get_points_data())
-    )
-    p["route_inter"] = interpolateroutes(route)
+        start = p["start"]
+        wd = get_weather_batch(pd.Series([p["startdatetime"]]), [start.latitude], [start.longitude], [ele[0]])
+        p = p | wd[WEATHER_COLUMNS].to_dict("records")[0]
+    if localize:
+        p = p | date_features(pd.Series([p["startdatetime"]])).to_dict("records")[0]
+    p["ende"] = location(-1)
+    p["distance_crow"] = m["distance_crow"]
+    route = np.column_stack((lon, lat))
+    p["route_inter"] = resample_routes([route], smooth=True)[0] if resample else route
     p["speed"] = p["distance"]/1000/p["duration"]*60
     p["crowspeed"] = p["distance_crow"]/1000/p["duration"]*60
     return p
 
 
+def _read_gpx_file_safe(filename: Path, backend: str) -> tuple[Optional[dict], Optional[str]]:
+    """
+    read one gpx file without raising, to be used as worker function.
+    The timezones, the weather data and the resampled routes are added by the caller for all files at once
+    :return: tuple with the parsed dictionary and None or None and the error message
+    """
+    try:
+        if isinstance(filename, Path):
+            return read_gpx_file(filename, weather=False, backend=backend, localize=False, resample=False), None
+        with open_gpx(filename) as fh:
+            p = read_gpx_file(filename, filehandle=fh, weather=False, backend=backend, localize=False, resample=False)
+        return p, None
+    except Exception as e:
+        return None, f"{type(e).__name__}: {e}"
+
+
 def read_gpx_file_list(
-    filelist: list, delete: bool = False, weather: bool = True
+    filelist: list,
+    delete: bool = False,
+    weather: bool = True,
+    workers: Optional[int] = None,
+    backend: str = "iterparse",
+    progress: Optional[Callable[[str], None]] = None,
 ) -> pd.DataFrame:
     """
-    - Reads gpx files from a file list
+    - Reads gpx files from a file list, in parallel on a process pool
     - Deletes the files if delete option is set
     - Returns a result DataFrame with information for each GPX file
+    Files that cannot be parsed do not stop the batch, they are listed with the
+    error message in the error report in df.attrs["errors"]
+    :param workers: number of worker processes, default is the number of cores,
+                    with 1, the files are read in the calling process
+    :param backend: gpx reader backend, see read_gpx_file
+    :param weather: add the weather at the start of the rides, see get_weather.get_weather_batch
+    :param progress: function called with the file name, whenever a file is done
+    The file list can contain Path objects, gpx files in memory, .gpx.gz files and zip
+    archives, see gpx_sources. Compressed files are decompressed while they are parsed
     """
-    log.info(f"{len(filelist)} Dateien lesen")
+    compressed = [f for f in filelist if isinstance(f, Path) and is_compressed(f)]
+    filelist = expand_gpx_sources(filelist)
+    # files without the gpx suffix (in any case) are reported as errors, e.g. unreadable archives
+    isgpx = [f.name.lower().endswith(GPX_SUFFIXES[0]) for f in filelist]
+    errors = [{"filename": f.name, "error": "not a gpx file"} for f, ok in zip(filelist, isgpx) if not ok]
+    for e in errors:
+        log.error(f"could not parse {e['filename']}: {e['error']}")
+        if progress is not None:
+            progress(e["filename"])
+    filelist = [f for f, ok in zip(filelist, isgpx) if ok]
+    if workers is None:
+        workers = os.cpu_count() or 1
+    workers = max(1, min(workers, len(filelist)))
+    log.info(f"{len(filelist)} Dateien lesen, {workers} Prozesse")
     r = []
-    for f in (pbar := tqdm(filelist, colour="#ff00ff", desc="read GPX files")):
-        pbar.set_postfix_str(f.name[0:20])
-        if not str(f).endswith("gpx"):
-            continue
-        p = read_gpx_file(f, weather=weather)
-        if delete:
+    executor = None
+    if workers == 1:
+        results = map(_read_gpx_file_safe, filelist, repeat(backend))
+    else:
+        # spawn instead of fork, the dash app calls this from a thread
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+        results = executor.map(_read_gpx_file_safe, filelist, repeat(backend))
+    try:
+        # executor.map yields the results in the order of filelist
+        for f, (p, error) in (
+            pbar := tqdm(zip(filelist, results), total=len(filelist), colour="#ff00ff", desc="read GPX files")
+        ):
+            pbar.set_postfix_str(f.name[0:20])
+            if delete and isinstance(f, Path):
+                f.unlink()
+            if progress is not None:
+                progress(f.name)
+            if error is not None:
+                log.error(f"could not parse {f.name}: {error}")
+                errors.append({"filename": f.name, "error": error})
+                continue
+            r.append(p)
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+    if delete:
+        for f in compressed:
             f.unlink()
-        r.append(p)
-    df = pd.DataFrame(r).convert_dtypes()
+    if len(r) == 0:
+        df = pd.DataFrame()
+        df.attrs["errors"] = errors
+        return df
+    df = pd.DataFrame(r)
+    df["route_inter"] = list(resample_routes(list(df.route_inter), smooth=True))
+    df["startdatetime"] = localize_datetimes(
+        df.startdatetime, [x.latitude for x in df.start], [x.longitude for x in df.start]
+    )
+    if weather:
+        wd = get_weather_batch(
+            df.startdatetime,
+            [x.latitude for x in df.start],
+            [x.longitude for x in df.start],
+            [np.nan if x.elevation is None else x.elevation for x in df.start],
+        )
+        i = list(df.columns).index("startdatetime") + 1
+        df = pd.concat([df.iloc[:, :i], wd[WEATHER_COLUMNS], df.iloc[:, i:]], axis=1)
+    dates = date_features(df.startdatetime)
+    # same column order as in read_gpx_file
+    i = list(df.columns).index("ende")
+    df = pd.concat([df.iloc[:, :i], dates, df.iloc[:, i:]], axis=1)
+    df = df.convert_dtypes()
     df = df.astype(
         {
             "season": "category",
@@ -132,25 +240,14 @@ def read_gpx_file_list(
             "month": "category",
         }
     )
-    df["weekday"] = pd.Categorical(
-        df.weekday,
-        categories=[
-            "Monday",
-            "Tuesday",
-            "Wednesday",
-            "Thursday",
-            "Friday",
-            "Saturday",
-            "Sunday",
-        ],
-        ordered=True,
-    )
+    df["weekday"] = pd.Categorical(df.weekday, categories=WEEKDAYS, ordered=True)
+    df.attrs["errors"] = errors
     return df
 
 
-def read_gpx_from_folder(infolder: str) -> pd.DataFrame:
+def read_gpx_from_folder(infolder: str, workers: Optional[int] = None) -> pd.DataFrame:
     """read and parse all gpx files from a folder"""
-    return read_gpx_file_list(getfilelist(infolder, suffix="gpx", withpath=True))
+    return read_gpx_file_list(gpx_files_in(infolder), workers=workers)
 
 
 def update_pickle_from_list(
@@ -158,41 +255,120 @@ def update_pickle_from_list(
     mypickle: Path = Path("pickles/df.pickle"),
     delete: bool = False,
     weather: bool = True,
+    workers: Optional[int] = None,
+    progress: Optional[Callable[[str], None]] = None,
 ) -> tuple[pd.DataFrame, bool]:
-    """update a pickle file of gpx data with a list of gpx files"""
-    if not Path(mypickle).is_file():
+    """
+    update a pickle file of gpx data with a list of gpx files
+    Which files have to be parsed is decided by the ingest index next to the pickle
+    file: new files and files with a changed content are parsed, unchanged files and
+    duplicates of known files (also under another name) are skipped.
+    The lists of files are returned in d.attrs["ingest_report"]
+    The resampled routes are not part of the pickle file, they are written to
+    the RouteStore in the same folder and added to its RouteIndex. Parsed rides which are
+    the same ride as another one recorded twice are listed as pairs of filenames in
+    d.attrs["ingest_report"][NEAR_DUPLICATES]
+    :param workers: number of processes to parse the files, see read_gpx_file_list
+    :param progress: function called with the file name, whenever a file is parsed or skipped
+    """
+    mypickle = Path(mypickle)
+    compressed = [f for f in filelist if isinstance(f, Path) and is_compressed(f)]
+    filelist = expand_gpx_sources(filelist)
+    index = IngestIndex.load(mypickle.parents[0] / "ingest_index.json")
+    routes = RouteStore.open(mypickle.parents[0])
+    migrated = False
+    if not mypickle.is_file():
         log.info(f"{mypickle} doesn't exist, I create it")
         d = pd.DataFrame()
-        fl = filelist
+        index = IngestIndex(index.path)
     else:
         with open(mypickle, "rb") as f:
             d = pickle.load(f)
-        fl = [f for f in filelist if f.name not in list(d["filename"])]
+        if "route_inter" in d.columns:
+            # pickle files written before the route store existed
+            log.info(f"move the routes of {mypickle} to the route store")
+            routes.put(d.filename, np.stack(d.route_inter))
+            d = d.drop(columns="route_inter")
+            migrated = True
+        if len(index) == 0 and len(d) > 0:
+            # pickle files written before the ingest index existed
+            known = set(d["filename"])
+            adopted = index.classify([f for f in filelist if f.name in known])
+            index.register([f.name for f in adopted[NEW]])
+    report = index.classify(filelist)
+    fl = report[NEW] + report[CHANGED]
     log.info(f"{len(fl)} of {len(filelist)} have to be parsed")
+    for f in report[SKIPPED]:
+        if delete and isinstance(f, Path):
+            f.unlink()
+        if progress is not None:
+            progress(f.name)
+    errors = []
+    for f in report[REJECTED]:
+        errors.append({"filename": f.name, "error": "another file of the batch has the same name"})
+        if progress is not None:
+            progress(f.name)
     updated = len(fl) > 0
+    parsed = []
     if updated:
-        d = pd.concat(
-            [d, read_gpx_file_list(fl, delete=delete, weather=weather)], axis=0
-        )
-        d = d.reset_index(drop=True)
+        dnew = read_gpx_file_list(fl, delete=delete, weather=weather, workers=workers, progress=progress)
+        errors += dnew.attrs["errors"]
+        if len(dnew) > 0:
+            index.register(list(dnew.filename))
+            parsed = list(dnew.filename)
+            routes.put(dnew.filename, np.stack(dnew.route_inter))
+            dnew = dnew.drop(columns="route_inter")
+            d = d[~d.filename.isin(set(dnew.filename))] if len(d) > 0 else d
+            d = pd.concat([d, dnew], axis=0)
+            d = d.reset_index(drop=True)
+    if updated or migrated:
         mypickle.parents[0].mkdir(exist_ok=True)
         with open(mypickle, "wb") as f:
             pickle.dump(d, f)
+    index.save()
+    duplicates = update_route_index(mypickle.parents[0], d, routes, parsed)
+    if delete:
+        for f in compressed:
+            f.unlink()
+    d.attrs["errors"] = errors
+    d.attrs["ingest_report"] = {k: [f.name for f in v] for k, v in report.items()}
+    d.attrs["ingest_report"][NEAR_DUPLICATES] = duplicates
     return d
 
 
+def update_route_index(folder: Path, d: pd.DataFrame, routes: RouteStore, parsed: list) -> list[tuple[str, str]]:
+    """
+    add the parsed rides and the rides of sessions from before the index to the RouteIndex of a
+    session folder
+    :return: near duplicates of the parsed rides, see RouteIndex.near_duplicates
+    """
+    rindex = RouteIndex.open(folder)
+    add = set(parsed) | {fn for fn in d.get("filename", []) if fn not in rindex}
+    if len(add) == 0:
+        return []
+    dadd = d[d.filename.isin(add)]
+    rindex.put(dadd.filename, routes.get(dadd.filename), dadd.startdatetime)
+    rindex.save()
+    duplicates = rindex.near_duplicates(parsed)
+    for pair in duplicates:
+        log.warning(f"{pair[0]} and {pair[1]} are the same ride recorded twice")
+    return duplicates
+
+
 def update_pickle_from_folder(
     infolder: str,
     mypickle: Path = Path("pickles/df.pickle"),
     delete: bool = False,
     weather: bool = True,
+    workers: Optional[int] = None,
 ) -> tuple[pd.DataFrame, bool]:
-    """update a pickle file of gpx data with a folder containing gpx files"""
+    """update a pickle file of gpx data with a folder containing gpx files, .gpx.gz files or zip archives"""
     return update_pickle_from_list(
-        getfilelist(infolder, suffix="gpx", withpath=True),
+        gpx_files_in(infolder),
         mypickle=mypickle,
         delete=delete,
         weather=weather,
+        workers=workers,
     )
 
 
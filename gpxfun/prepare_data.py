@@ -41,9 +41,14 @@ def get_prepared_data(
     clustercounter = dr.cluster.value_counts().sort_values(ascending=False)
     imp_clusters = list(clustercounter[clustercounter >= minrecords].index)
     dr.cluster = dr.cluster.apply(lambda x: x if x in imp_clusters else "other")
-    dr["starttimenum"] = dr.starttime.apply(lambda x: x.hour + x.minute / 60.0)
+    dr["starttimenum"] = dr.starttimefloat.astype(float)
     dr["starttime"] = pd.cut(dr.starttimenum, 4)
-    dr["temp"] = pd.cut(dr.temp, 4)
+    if "temp" in dr.columns and dr.temp.notna().any():
+        dr["temp"] = pd.cut(dr.temp, 4)
+    else:
+        # the weather data is missing, e.g. the weather stage failed
+        log.warning("no temperatures, the feature temp is left out")
+        dr = dr.drop(columns="temp", errors="ignore")
     dr = exclude_outliers(dr, cols=[y_variable])
     return dr
 
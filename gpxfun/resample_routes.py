@@ -0,0 +1,82 @@
+"""
+Resample many routes at once to a fixed number of points, equally spaced along the route
+"""
+import logging
+from typing import Optional
+
+import numpy as np
+
+log = logging.getLogger("gpxfun." + __name__)
+
+N_SAMPLES = 1000
+# window (in samples) of the moving average of the smooth mode
+SMOOTHING_WINDOW = 25
+
+
+def _resample(routes: list, n_samples: int, out: np.ndarray):
+    """linear interpolation at equal arc length of all routes with one np.interp call per coordinate"""
+    params, points, constant = [], [], []
+    for i, r in enumerate(routes):
+        r = np.asarray(r, dtype=np.float64)
+        # consecutive duplicates have no arc length
+        keep = np.r_[True, np.any(np.diff(r, axis=0) != 0, axis=1)]
+        r = r[keep]
+        s = np.r_[0, np.cumsum(np.sqrt(np.sum(np.diff(r, axis=0) ** 2, axis=1)))]
+        if s[-1] == 0:
+            # all points are the same, the route isn't part of the interpolation
+            out[i] = r[0]
+            constant.append(i)
+            continue
+        s /= s[-1]
+        # shift each route to its own interval, so that one interpolation covers all routes
+        params.append(s + 2 * i)
+        points.append(r)
+    if len(params) == 0:
+        return
+    params = np.concatenate(params)
+    points = np.concatenate(points)
+    moving = np.setdiff1d(np.arange(len(routes)), constant)
+    alpha = (np.linspace(0, 1, n_samples)[None, :] + 2 * moving[:, None]).ravel()
+    for c in range(2):
+        out[moving, :, c] = np.interp(alpha, params, points[:, c]).reshape(len(moving), n_samples)
+
+
+def _moving_average(a: np.ndarray, window: int) -> np.ndarray:
+    """moving average along the samples of (n_routes, n_samples, 2) arrays, start and end stay fixed"""
+    half = window // 2
+    padded = np.pad(a.astype(np.float64), ((0, 0), (half, half), (0, 0)), mode="edge")
+    c = np.cumsum(padded, axis=1)
+    c = np.concatenate([np.zeros_like(c[:, :1]), c], axis=1)
+    smoothed = (c[:, window:] - c[:, :-window]) / window
+    smoothed[:, 0] = a[:, 0]
+    smoothed[:, -1] = a[:, -1]
+    return smoothed
+
+
+def resample_routes(
+    routes: list,
+    n_samples: int = N_SAMPLES,
+    smooth: bool = False,
+    out: Optional[np.ndarray] = None,
+) -> np.ndarray:
+    """
+    Resample routes to n_samples points equally spaced along the route
+    :param routes: list of arrays (or lists) of (lon, lat) points, one per route
+    :param n_samples: number of points of each resampled route
+    :param smooth: smooth the routes with a moving average and resample them again
+    :param out: preallocated float32 array of shape (len(routes), n_samples, 2) for the result
+    :return: float32 array of shape (len(routes), n_samples, 2)
+    """
+    if out is None:
+        out = np.empty((len(routes), n_samples, 2), dtype=np.float32)
+    assert out.shape == (len(routes), n_samples, 2)
+    if len(routes) == 0:
+        return out
+    log.debug(f"resample {len(routes)} routes to {n_samples} points{' with smoothing' if smooth else ''}")
+    if not smooth:
+        _resample(routes, n_samples, out)
+        return out
+    tmp = np.empty((len(routes), n_samples, 2), dtype=np.float64)
+    _resample(routes, n_samples, tmp)
+    _resample(list(_moving_average(tmp, SMOOTHING_WINDOW)), n_samples, out)
+    return out
@@ -0,0 +1,215 @@
+"""
+Index of compact sketches of the resampled routes of a session for nearest neighbour
+queries ("which of my rides followed this route?") without a distance matrix.
+The sketch of a route are the means of SKETCH_POINTS segments of its points in km, the
+distance of two sketches is the root mean square distance of the segment means
+"""
+import io
+import logging
+import os
+import pickle
+from pathlib import Path
+from typing import Iterable, Optional
+
+import numpy as np
+import pandas as pd
+from scipy.spatial import KDTree
+
+log = logging.getLogger("gpxfun." + __name__)
+
+ROUTE_INDEX_FILE = "route_index.npz"
+# the KDTree of the index, only written when it was rebuilt
+ROUTE_TREE_FILE = "route_index.tree"
+# number of segment means per route
+SKETCH_POINTS = 16
+KM_PER_DEGREE = 111.2
+# rides with sketches closer than this, which started within DUPLICATE_SECONDS, are
+# the same ride recorded twice
+DUPLICATE_RADIUS_KM = 0.05
+DUPLICATE_SECONDS = 600
+# the tree is rebuilt when the routes added or changed since it was built exceed this
+# fraction of the routes, until then they are searched linearly
+REBUILD_FRACTION = 0.1
+# key of the near duplicates in the ingest report, see parse_gpx.update_pickle_from_list
+NEAR_DUPLICATES = "near_duplicates"
+
+
+def route_sketches(routes: np.ndarray) -> np.ndarray:
+    """
+    sketches of routes: the means of SKETCH_POINTS segments of the points in km (lon scaled
+    with the cosine of the latitude), divided by the square root of SKETCH_POINTS
+    :param routes: array of shape (number of routes, n_samples, 2) with (lon, lat) points
+    :return: array of shape (number of routes, 2 * SKETCH_POINTS)
+    """
+    points = np.asarray(routes, dtype=np.float64)
+    n_samples = points.shape[1]
+    starts = np.linspace(0, n_samples, min(SKETCH_POINTS, n_samples) + 1).astype(int)[:-1]
+    means = np.add.reduceat(points, starts, axis=1) / np.diff(np.append(starts, n_samples))[:, None]
+    km = np.stack([means[..., 0] * np.cos(np.radians(means[..., 1])), means[..., 1]], axis=-1) * KM_PER_DEGREE
+    return km.reshape(len(points), -1) / np.sqrt(len(starts))
+
+
+def start_seconds(startdatetime: Iterable) -> np.ndarray:
+    """seconds since the epoch of the start times of rides, nan if unknown"""
+    utc = pd.to_datetime(pd.Series(list(startdatetime), dtype=object), utc=True)
+    return (utc - pd.Timestamp(0, tz="UTC")).dt.total_seconds().to_numpy(dtype=np.float64)
+
+
+class RouteIndex(object):
+    """
+    Sketches and start times of the routes of a session in route_index.npz, searched with a
+    KDTree in route_index.tree. Routes added or changed after the tree was built are searched
+    linearly until the tree is rebuilt, also across save and open
+    """
+
+    def __init__(self, folder: Optional[Path] = None):
+        self.folder = None if folder is None else Path(folder)
+        self.filenames: list[str] = []
+        self.sketches = np.zeros((0, 2 * SKETCH_POINTS))
+        self.starts = np.zeros(0)
+        self._rows: dict[str, int] = {}
+        self._tree: Optional[KDTree] = None
+        # number of rows of the tree, the tree is loaded on the first query
+        self._built = 0
+        # the tree was rebuilt since the last save
+        self._rebuilt = False
+        # rows of the tree which were changed after it was built
+        self._dirty: set[int] = set()
+
+    @classmethod
+    def open(cls, folder: Path) -> "RouteIndex":
+        """open the index of a session folder, an empty index if it doesn't exist yet"""
+        index = cls(folder)
+        if (index.folder / ROUTE_INDEX_FILE).is_file():
+            with np.load(index.folder / ROUTE_INDEX_FILE) as f:
+                index.filenames = [str(x) for x in f["filenames"]]
+                index.sketches, index.starts = f["sketches"], f["starts"]
+                if "built" in f:
+                    index._built, index._dirty = int(f["built"]), {int(r) for r in f["dirty"]}
+            index._rows = {fn: i for i, fn in enumerate(index.filenames)}
+        return index
+
+    def save(self):
+        self.folder.mkdir(parents=True, exist_ok=True)
+        buffer = io.BytesIO()
+        if self._rebuilt:
+            tmp = self.folder / (ROUTE_TREE_FILE + ".tmp")
+            tmp.write_bytes(pickle.dumps(self._tree))
+            os.replace(tmp, self.folder / ROUTE_TREE_FILE)
+            self._rebuilt = False
+        np.savez(
+            buffer,
+            filenames=np.array(self.filenames, dtype=str),
+            sketches=self.sketches,
+            starts=self.starts,
+            built=self._built,
+            dirty=np.array(sorted(self._dirty), dtype=np.int64),
+        )
+        tmp = self.folder / (ROUTE_INDEX_FILE + ".tmp")
+        tmp.write_bytes(buffer.getvalue())
+        os.replace(tmp, self.folder / ROUTE_INDEX_FILE)
+
+    def __len__(self) -> int:
+        return len(self.filenames)
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self._rows
+
+    def put(self, filenames: Iterable[str], routes: np.ndarray, startdatetime: Optional[Iterable] = None):
+        """
+        add routes, the sketches of known filenames are replaced
+        :param routes: array of shape (len(filenames), n_samples, 2)
+        :param startdatetime: start times of the rides, needed for near_duplicates
+        """
+        filenames = [str(fn) for fn in filenames]
+        if len(filenames) == 0:
+            return
+        sketches = route_sketches(routes)
+        starts = np.full(len(filenames), np.nan) if startdatetime is None else start_seconds(startdatetime)
+        known = np.array([fn in self._rows for fn in filenames], dtype=bool)
+        rows = np.array([self._rows[fn] for fn in np.array(filenames)[known]], dtype=np.int64)
+        self.sketches[rows], self.starts[rows] = sketches[known], starts[known]
+        self._dirty.update(int(r) for r in rows if r < self._built)
+        for fn in np.array(filenames)[~known]:
+            self._rows[str(fn)] = len(self.filenames)
+            self.filenames.append(str(fn))
+        self.sketches = np.concatenate([self.sketches, sketches[~known]])
+        self.starts = np.concatenate([self.starts, starts[~known]])
+        log.debug(f"route index: {known.sum()} routes updated, {(~known).sum()} added")
+
+    def sketches_for(self, filenames: Iterable[str]) -> np.ndarray:
+        """sketches of the routes of the given files"""
+        return self.sketches[np.array([self._rows[str(fn)] for fn in filenames], dtype=np.int64)]
+
+    def _load_tree(self):
+        """load the tree of the first _built rows from route_index.tree, built again if it doesn't fit"""
+        if self._tree is None and self._built > 0:
+            path = None if self.folder is None else self.folder / ROUTE_TREE_FILE
+            if path is not None and path.is_file():
+                self._tree = pickle.loads(path.read_bytes())
+            if self._tree is None or self._tree.n != self._built:
+                log.debug(f"route index: tree of {self._built} routes built again")
+                self._tree, self._dirty, self._rebuilt = KDTree(self.sketches[: self._built]), set(), True
+
+    def _searched_linearly(self) -> np.ndarray:
+        """rows which aren't in the tree, the tree is rebuilt if there are too many"""
+        if len(self) - self._built + len(self._dirty) > REBUILD_FRACTION * len(self):
+            self._tree, self._dirty, self._built, self._rebuilt = KDTree(self.sketches), set(), len(self), True
+        else:
+            self._load_tree()
+        return np.array(sorted(self._dirty) + list(range(self._built, len(self))), dtype=np.int64)
+
+    def _candidates(self, sketch: np.ndarray, k: Optional[int], radius: Optional[float]) -> tuple:
+        """rows and distances of the k nearest sketches or the sketches within radius"""
+        linear = self._searched_linearly()
+        tree = self._tree
+        rows, dists = [linear], [np.sqrt(((self.sketches[linear] - sketch) ** 2).sum(axis=1))]
+        if tree is not None and tree.n > 0:
+            if radius is None:
+                d, r = tree.query(sketch, k=min(k + len(self._dirty), tree.n))
+                d, r = np.atleast_1d(d), np.atleast_1d(r)
+            else:
+                r = np.array(tree.query_ball_point(sketch, radius), dtype=np.int64)
+                d = np.sqrt(((self.sketches[r] - sketch) ** 2).sum(axis=1))
+            valid = ~np.isin(r, list(self._dirty))
+            rows.append(r[valid])
+            dists.append(d[valid])
+        rows, dists = np.concatenate(rows), np.concatenate(dists)
+        if radius is not None:
+            rows, dists = rows[dists <= radius], dists[dists <= radius]
+        order = np.argsort(dists, kind="stable")[:k]
+        return rows[order], dists[order]
+
+    def query(self, route: np.ndarray, k: int = 5) -> list[tuple[str, float]]:
+        """
+        the k routes closest to a route
+        :param route: array of shape (n_samples, 2) with (lon, lat) points
+        :return: list of filenames and distances of the sketches in km, closest first
+        """
+        rows, dists = self._candidates(route_sketches(np.asarray(route)[None])[0], k, None)
+        return [(self.filenames[r], float(d)) for r, d in zip(rows, dists)]
+
+    def query_radius(self, route: np.ndarray, radius_km: float) -> list[tuple[str, float]]:
+        """the routes with a sketch within radius_km of the sketch of route, see query"""
+        rows, dists = self._candidates(route_sketches(np.asarray(route)[None])[0], None, radius_km)
+        return [(self.filenames[r], float(d)) for r, d in zip(rows, dists)]
+
+    def near_duplicates(
+        self,
+        filenames: Iterable[str],
+        radius_km: float = DUPLICATE_RADIUS_KM,
+        seconds: float = DUPLICATE_SECONDS,
+    ) -> list[tuple[str, str]]:
+        """
+        rides of the index which are the same ride as one of filenames recorded twice: the
+        sketches are within radius_km and the rides started within seconds
+        :return: sorted list of (filename, filename of the duplicate), each pair only once
+        """
+        pairs = set()
+        for fn in filenames:
+            row = self._rows[str(fn)]
+            rows, _ = self._candidates(self.sketches[row], None, radius_km)
+            for other in rows[np.abs(self.starts[rows] - self.starts[row]) <= seconds]:
+                if other != row:
+                    pairs.add(tuple(sorted((str(fn), self.filenames[other]))))
+        return sorted(pairs)
@@ -0,0 +1,101 @@
+"""
+Resampled routes of a session in a memory mapped float32 file instead of an
+object column of the DataFrame. The rows are addressed by the filename of the gpx file
+"""
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Iterable
+
+import numpy as np
+import pandas as pd
+
+from .resample_routes import N_SAMPLES
+
+log = logging.getLogger("gpxfun." + __name__)
+
+ROUTES_FILE = "routes.f32"
+ROUTES_INDEX = "routes.json"
+
+
+class RouteStore(object):
+    """
+    Array of shape (number of routes, n_samples, 2) with (lon, lat) points in the
+    file routes.f32, the filenames of the rows are kept in routes.json
+    """
+
+    def __init__(self, folder: Path, n_samples: int = N_SAMPLES):
+        self.folder = Path(folder)
+        self.n_samples = n_samples
+        self.filenames: list[str] = []
+        self._rows: dict[str, int] = {}
+
+    @classmethod
+    def open(cls, folder: Path) -> "RouteStore":
+        """open the store in a folder, an empty store if it doesn't exist yet"""
+        store = cls(folder)
+        if (store.folder / ROUTES_INDEX).is_file():
+            with open(store.folder / ROUTES_INDEX) as f:
+                meta = json.load(f)
+            store.n_samples = meta["n_samples"]
+            store.filenames = meta["filenames"]
+            store._rows = {fn: i for i, fn in enumerate(store.filenames)}
+        return store
+
+    def __len__(self) -> int:
+        return len(self.filenames)
+
+    def __contains__(self, filename: str) -> bool:
+        return filename in self._rows
+
+    def _memmap(self, mode: str = "r") -> np.memmap:
+        return np.memmap(
+            self.folder / ROUTES_FILE, dtype=np.float32, mode=mode, shape=(len(self), self.n_samples, 2)
+        )
+
+    def put(self, filenames: Iterable[str], routes: np.ndarray):
+        """
+        write routes, rows of known filenames are overwritten, the other ones are appended
+        :param routes: array of shape (len(filenames), n_samples, 2)
+        """
+        filenames = list(filenames)
+        routes = np.asarray(routes, dtype=np.float32)
+        assert routes.shape == (len(filenames), self.n_samples, 2)
+        known = np.array([fn in self._rows for fn in filenames], dtype=bool)
+        if known.any():
+            mm = self._memmap("r+")
+            mm[[self._rows[fn] for fn in np.array(filenames)[known]]] = routes[known]
+            mm.flush()
+            del mm
+        if not known.all():
+            self.folder.mkdir(parents=True, exist_ok=True)
+            with open(self.folder / ROUTES_FILE, "ab") as f:
+                f.write(np.ascontiguousarray(routes[~known]).tobytes())
+            for fn in np.array(filenames)[~known]:
+                self._rows[str(fn)] = len(self.filenames)
+                self.filenames.append(str(fn))
+        # readers only look at the rows listed in the index, so write it after the data
+        tmp = self.folder / (ROUTES_INDEX + ".tmp")
+        with open(tmp, "w") as f:
+            json.dump({"n_samples": self.n_samples, "filenames": self.filenames}, f)
+        os.replace(tmp, self.folder / ROUTES_INDEX)
+        log.debug(f"route store {self.folder}: {known.sum()} routes updated, {(~known).sum()} added")
+
+    def get(self, filenames: Iterable[str]) -> np.ndarray:
+        """
+        routes of the given files, a read only view of the memory map if the rows are
+        stored contiguously in the requested order, otherwise a copy
+        :return: float32 array of shape (len(filenames), n_samples, 2)
+        """
+        rows = np.array([self._rows[fn] for fn in filenames], dtype=np.int64)
+        if len(rows) == 0:
+            return np.empty((0, self.n_samples, 2), dtype=np.float32)
+        mm = self._memmap()
+        if np.all(np.diff(rows) == 1):
+            return mm[rows[0] : rows[-1] + 1]
+        return np.asarray(mm[rows])
+
+    def routes_for(self, df: pd.DataFrame) -> np.ndarray:
+        """routes of the rows of a DataFrame, in the same order"""
+        return self.get(df["filename"])
@@ -0,0 +1,222 @@
+"""
+Storage of the clustered data of a session in parquet files with plain typed columns,
+so that readers can load only the columns and clusters they need.
+
+Columns that arrow cannot store directly are converted on write and restored on read:
+- Location objects (start, ende) -> <col>_lat, <col>_lon, <col>_ele
+- datetimes with different timezones -> UTC datetimes and the timezone name in <col>_tz
+- categories (e.g. startendcluster with ints and "other") -> str categories, the original
+  categories and their dtype are restored on read
+
+The weather data is added later by the weather stage (see weather_stage) to a separate
+file, its columns are joined to the session data by filename on read
+"""
+import json
+import logging
+from pathlib import Path
+import pickle
+from typing import Optional
+
+from gpxpy.geo import Location
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from .route_store import RouteStore
+
+log = logging.getLogger("gpxfun." + __name__)
+
+SESSION_FILE = "df.parquet"
+CLUSTERS_FILE = "most_imp_clusters.parquet"
+WEATHER_FILE = "weather.parquet"
+# key of the conversion infos in the parquet schema metadata
+META_KEY = b"gpxfun"
+
+
+def _first_valid(s: pd.Series):
+    i = s.first_valid_index()
+    return None if i is None else s[i]
+
+
+def _to_table(df: pd.DataFrame) -> pa.Table:
+    """convert a DataFrame to an arrow table, the conversions are kept in the schema metadata"""
+    d = df.copy()
+    meta = {"columns": list(df.columns), "locations": [], "timezones": [], "categories": {}}
+    for c in df.columns:
+        first = _first_valid(df[c])
+        if df[c].dtype == object and hasattr(first, "latitude"):
+            for suffix, attr in (("lat", "latitude"), ("lon", "longitude"), ("ele", "elevation")):
+                if f"{c}_{suffix}" not in d.columns:
+                    d[f"{c}_{suffix}"] = np.array(
+                        [np.nan if x is None or getattr(x, attr) is None else getattr(x, attr) for x in df[c]],
+                        dtype=np.float64,
+                    )
+            d = d.drop(columns=c)
+            meta["locations"].append(c)
+        elif df[c].dtype == object and isinstance(first, pd.Timestamp) and first.tzinfo is not None:
+            d[c] = pd.to_datetime(df[c], utc=True)
+            d[f"{c}_tz"] = [None if pd.isna(x) else str(x.tzinfo) for x in df[c]]
+            meta["timezones"].append(c)
+        elif isinstance(df[c].dtype, pd.CategoricalDtype):
+            meta["categories"][c] = {
+                "categories": list(df[c].cat.categories),
+                "dtype": str(df[c].cat.categories.dtype),
+                "ordered": bool(df[c].cat.ordered),
+            }
+            d[c] = df[c].cat.rename_categories([str(x) for x in df[c].cat.categories])
+    table = pa.Table.from_pandas(d, preserve_index=False)
+    meta = json.dumps(meta, default=lambda x: x.item() if isinstance(x, np.generic) else str(x))
+    return table.replace_schema_metadata({**table.schema.metadata, META_KEY: meta})
+
+
+def _stored_columns(meta: dict, columns: list) -> list:
+    """columns of the parquet file needed to restore the given columns"""
+    stored = []
+    for c in columns:
+        if c in meta["locations"]:
+            stored += [f"{c}_lat", f"{c}_lon", f"{c}_ele"]
+        elif c in meta["timezones"]:
+            stored += [c, f"{c}_tz"]
+        else:
+            stored.append(c)
+    return list(dict.fromkeys(stored))
+
+
+def _restore(d: pd.DataFrame, meta: dict, columns: list) -> pd.DataFrame:
+    for c in meta["locations"]:
+        if c in columns:
+            d[c] = [
+                Location(lat, lon, None if np.isnan(ele) else ele)
+                for lat, lon, ele in zip(d[f"{c}_lat"], d[f"{c}_lon"], d[f"{c}_ele"])
+            ]
+    for c in meta["timezones"]:
+        if c in columns:
+            d[c] = pd.Series(
+                [x if pd.isna(x) else x.tz_convert(tz) for x, tz in zip(d[c], d[f"{c}_tz"])], index=d.index, dtype=object
+            )
+    for c, cat in meta["categories"].items():
+        if c in columns:
+            categories = pd.Index(cat["categories"], dtype=cat["dtype"])
+            codes = pd.Index([str(x) for x in categories]).get_indexer(d[c].astype(object).fillna("").astype(str))
+            d[c] = pd.Categorical.from_codes(codes, categories=categories, ordered=cat["ordered"])
+    return d[columns]
+
+
+def write_table(df: pd.DataFrame, path: Path):
+    """write a DataFrame to a parquet file"""
+    path = Path(path)
+    path.parents[0].mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(".tmp")
+    pq.write_table(_to_table(df), tmp)
+    # callbacks may read the file while a session is parsed again
+    tmp.replace(path)
+
+
+def _read_meta(path: Path) -> dict:
+    schema = pq.read_schema(path)
+    meta = json.loads((schema.metadata or {}).get(META_KEY, b'{"locations": [], "timezones": [], "categories": {}}'))
+    meta.setdefault("columns", schema.names)
+    return meta
+
+
+def table_columns(path: Path) -> list:
+    """columns of a DataFrame written by write_table"""
+    return _read_meta(path)["columns"]
+
+
+def read_table(path: Path, columns: Optional[list] = None, filters: Optional[list] = None) -> pd.DataFrame:
+    """
+    read a DataFrame written by write_table
+    :param columns: columns to read, all columns if None
+    :param filters: row filters in the format of pyarrow.parquet.read_table,
+            e.g. [("cluster", "in", ["0_1", "0_2"])]
+    """
+    meta = _read_meta(path)
+    if columns is None:
+        columns = meta["columns"]
+    d = pd.read_parquet(path, columns=_stored_columns(meta, columns), filters=filters)
+    return _restore(d, meta, columns)
+
+
+def write_session(folder: Path, df: pd.DataFrame, most_imp_clusters: pd.DataFrame):
+    """write the clustered data and the cluster infos of a session"""
+    log.debug(f"write session data to {folder}")
+    write_table(df, Path(folder) / SESSION_FILE)
+    write_table(most_imp_clusters, Path(folder) / CLUSTERS_FILE)
+
+
+def read_session(folder: Path, columns: Optional[list] = None, clusters: Optional[list] = None) -> pd.DataFrame:
+    """
+    read the clustered data of a session, including the weather columns if the weather
+    stage has written them
+    :param columns: columns to read, all columns if None
+    :param clusters: only read the rows of these route clusters
+    """
+    folder = Path(folder)
+    filters = None if clusters is None else [("cluster", "in", list(clusters))]
+    own = table_columns(folder / SESSION_FILE)
+    # sessions parsed with the weather data in the session file don't need the join
+    weather = [] if not (folder / WEATHER_FILE).is_file() else table_columns(folder / WEATHER_FILE)
+    weather = [c for c in weather if c not in own and c != "filename"]
+    if columns is None:
+        columns = own + weather
+    joined = [c for c in columns if c in weather]
+    if len(joined) == 0:
+        return read_table(folder / SESSION_FILE, columns=columns, filters=filters)
+    d = read_table(
+        folder / SESSION_FILE, columns=list(dict.fromkeys([c for c in columns if c in own] + ["filename"])), filters=filters
+    )
+    d = d.merge(read_table(folder / WEATHER_FILE, columns=["filename"] + joined), on="filename", how="left")
+    return d[columns]
+
+
+def write_weather(folder: Path, weather: pd.DataFrame):
+    """write the weather data of a session, a DataFrame with the column filename and the weather columns"""
+    log.debug(f"write weather data of {len(weather)} routes to {folder}")
+    write_table(weather, Path(folder) / WEATHER_FILE)
+
+
+def read_weather(folder: Path) -> Optional[pd.DataFrame]:
+    """weather data of a session written by write_weather, None if there is none yet"""
+    if not (Path(folder) / WEATHER_FILE).is_file():
+        return None
+    return read_table(Path(folder) / WEATHER_FILE)
+
+
+def read_most_imp_clusters(folder: Path, columns: Optional[list] = None) -> pd.DataFrame:
+    """read the infos on the start/end and route clusters of a session"""
+    return read_table(Path(folder) / CLUSTERS_FILE, columns=columns)
+
+
+def migrate_session(folder: Path) -> bool:
+    """
+    convert a session stored in df.pickle and most_imp_clusters.pickle to parquet files,
+    the routes are moved to the RouteStore of the session
+    :return: True if the session was migrated
+    """
+    folder = Path(folder)
+    if (folder / SESSION_FILE).is_file() or not (folder / "most_imp_clusters.pickle").is_file():
+        return False
+    log.info(f"migrate session {folder} to parquet")
+    with open(folder / "df.pickle", "rb") as f:
+        df = pickle.load(f)
+    with open(folder / "most_imp_clusters.pickle", "rb") as f:
+        most_imp_clusters = pickle.load(f)
+    if "route_inter" in df.columns:
+        RouteStore.open(folder).put(df.filename, np.stack([np.asarray(r) for r in df.route_inter]))
+        df = df.drop(columns="route_inter")
+    write_session(folder, df, most_imp_clusters)
+    return True
+
+
+if __name__ == "__main__":
+    import sys
+
+    from utils.mylog import get_log
+    from utils.utilities import getdirlist
+
+    log = get_log()
+    sessions = sys.argv[1] if len(sys.argv) > 1 else "sessions"
+    for s in getdirlist(sessions, withpath=True):
+        migrate_session(s)
@@ -0,0 +1,68 @@
+"""
+Process wide timezone lookup for start points of routes.
+The timezone data is loaded only once and the results are cached per grid cell
+"""
+from functools import lru_cache
+import logging
+
+import numpy as np
+import pandas as pd
+from timezonefinder import TimezoneFinder
+
+log = logging.getLogger("gpxfun." + __name__)
+
+# size of the grid cells in degrees (about 1 km), all points of a cell get the
+# timezone of the cell center
+CELL_DEGREES = 0.01
+
+
+@lru_cache(maxsize=None)
+def get_timezone_finder() -> TimezoneFinder:
+    """the TimezoneFinder of this process, created on first use"""
+    log.debug("load timezone data")
+    return TimezoneFinder()
+
+
+@lru_cache(maxsize=4096)
+def _timezone_of_cell(ilat: int, ilon: int) -> str:
+    lat = (ilat + 0.5) * CELL_DEGREES
+    lng = (ilon + 0.5) * CELL_DEGREES
+    tz = get_timezone_finder().timezone_at(lng=lng, lat=lat)
+    if tz is None:
+        log.warning(f"no timezone found for lat={lat:.3f}, lon={lng:.3f}, use UTC")
+        tz = "UTC"
+    return tz
+
+
+def timezone_at(lat: float, lon: float) -> str:
+    """name of the timezone of a location"""
+    return _timezone_of_cell(int(np.floor(lat / CELL_DEGREES)), int(np.floor(lon / CELL_DEGREES)))
+
+
+def timezones_at(lats, lons) -> np.ndarray:
+    """
+    timezone names for many locations at once, every grid cell is only looked up once
+    :param lats: array-like of latitudes
+    :param lons: array-like of longitudes
+    :return: array of timezone names
+    """
+    cells = np.floor(np.column_stack((lats, lons)).astype(np.float64) / CELL_DEGREES).astype(np.int64)
+    if len(cells) == 0:
+        return np.array([], dtype=object)
+    unique, inverse = np.unique(cells, axis=0, return_inverse=True)
+    tzs = np.array([_timezone_of_cell(int(ilat), int(ilon)) for ilat, ilon in unique], dtype=object)
+    return tzs[inverse.reshape(-1)]
+
+
+def localize_datetimes(dts: pd.Series, lats, lons) -> pd.Series:
+    """
+    convert timezone aware datetimes to the local time of the given locations
+    :param dts: Series of timezone aware datetimes, e.g. in UTC
+    :return: Series with dtype datetime64[ns, tz], if all locations are in the same
+            timezone, otherwise an object Series with the localized timestamps
+    """
+    tzs = timezones_at(lats, lons)
+    dts = pd.to_datetime(dts, utc=True)
+    if len(set(tzs)) == 1:
+        return dts.dt.tz_convert(tzs[0])
+    return pd.Series([dt.tz_convert(tz) for dt, tz in zip(dts, tzs)], index=dts.index, dtype=object)
@@ -0,0 +1,143 @@
+"""
+Vectorized metrics of a track given as point arrays, i.e. the numpy counterpart
+of GPX.length_3d, GPX.get_duration, GPX.get_moving_data, GPX.get_uphill_downhill
+and Location.distance_3d of gpxpy
+"""
+import logging
+import math
+from typing import Optional
+
+import numpy as np
+
+log = logging.getLogger("gpxfun." + __name__)
+
+# same constants as gpxpy.geo
+EARTH_RADIUS = 6378.137 * 1000
+ONE_DEGREE = (2 * math.pi * EARTH_RADIUS) / 360
+# timestamp of points without time in the int64 time arrays
+NO_TIME = np.iinfo(np.int64).min
+
+
+def pair_distances(
+    lat: np.ndarray, lon: np.ndarray, ele: Optional[np.ndarray] = None, haversine: bool = False
+) -> np.ndarray:
+    """
+    3D distance in meters from each point to its predecessor
+    :param ele: elevations, nan if missing. Pairs with missing elevation get the 2D distance
+    :param haversine: if False, the distance is calculated like gpxpy.geo.distance,
+            i.e. a flat approximation for points closer than 0.2 degrees and
+            the 2D haversine distance otherwise. If True, the haversine distance is
+            used for all points
+    :return: array with len(lat) - 1 distances
+    """
+    lat1, lat2 = lat[1:], lat[:-1]
+    lon1, lon2 = lon[1:], lon[:-1]
+    x = lat1 - lat2
+    far = np.ones(len(x), dtype=bool) if haversine else (np.abs(x) > 0.2) | (np.abs(lon1 - lon2) > 0.2)
+    y = (lon1 - lon2) * np.cos(np.radians(lat1))
+    d = np.sqrt(x * x + y * y) * ONE_DEGREE
+    if far.any():
+        rlat1, rlat2 = np.radians(lat1[far]), np.radians(lat2[far])
+        a = np.sin((rlat1 - rlat2) / 2) ** 2 + np.sin(np.radians(lon1[far] - lon2[far]) / 2) ** 2 * np.cos(
+            rlat1
+        ) * np.cos(rlat2)
+        d[far] = EARTH_RADIUS * 2 * np.arcsin(np.sqrt(a))
+    if ele is None:
+        return d
+    dz = ele[1:] - ele[:-1]
+    # gpxpy ignores the elevation for distant points, unless haversine is requested
+    with3d = ~np.isnan(dz) & (dz != 0) & (haversine | ~far)
+    d[with3d] = np.sqrt(d[with3d] ** 2 + dz[with3d] ** 2)
+    return d
+
+
+def climb(ele: np.ndarray, segment: Optional[np.ndarray] = None) -> tuple[float, float]:
+    """
+    Elevation gain and loss in meters. The elevations are smoothed with weights
+    0.3/0.4/0.3 within each segment first, like gpxpy.geo.calculate_uphill_downhill
+    :param ele: elevations, points with nan elevation are ignored
+    :param segment: segment number for each point
+    :return: tuple with uphill and downhill
+    """
+    valid = ~np.isnan(ele)
+    ele = ele[valid]
+    segment = np.zeros(len(ele), dtype=np.int32) if segment is None else segment[valid]
+    if len(ele) < 2:
+        return 0.0, 0.0
+    samesegment = segment[1:] == segment[:-1]
+    inner = np.zeros(len(ele), dtype=bool)
+    inner[1:-1] = samesegment[:-1] & samesegment[1:]
+    smoothed = ele.copy()
+    smoothed[1:-1] = np.where(inner[1:-1], ele[:-2] * 0.3 + ele[1:-1] * 0.4 + ele[2:] * 0.3, ele[1:-1])
+    dz = np.diff(smoothed)[samesegment]
+    return float(dz[dz > 0].sum()), float(-dz[dz < 0].sum())
+
+
+def _segment_bounds(segment: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """index of the first and the last point of each segment"""
+    bounds = np.flatnonzero(np.diff(segment)) + 1
+    return np.r_[0, bounds], np.r_[bounds - 1, len(segment) - 1]
+
+
+def segment_durations(time: np.ndarray, segment: np.ndarray) -> np.ndarray:
+    """
+    duration in seconds of each segment, nan if it cannot be determined.
+    Like gpxpy, the second (second last) point is used if the first (last) point has no time
+    """
+    first, last = _segment_bounds(segment)
+    t0 = time[first]
+    t0 = np.where((t0 == NO_TIME) & (first < last), time[np.minimum(first + 1, last)], t0)
+    t1 = time[last]
+    t1 = np.where((t1 == NO_TIME) & (first < last), time[np.maximum(last - 1, first)], t1)
+    durations = (t1 - t0) / 1e9
+    durations[(t0 == NO_TIME) | (t1 == NO_TIME) | (t1 < t0)] = np.nan
+    durations[first == last] = 0.0
+    return durations
+
+
+def track_metrics(
+    lat: np.ndarray,
+    lon: np.ndarray,
+    ele: Optional[np.ndarray] = None,
+    time: Optional[np.ndarray] = None,
+    segment: Optional[np.ndarray] = None,
+    stopped_speed_threshold: float = 1.0,
+    haversine: bool = False,
+) -> dict:
+    """
+    Calculate all metrics of a track in one vectorized pass over the points
+    :param lat: float64 array of latitudes
+    :param lon: float64 array of longitudes
+    :param ele: float64 array of elevations, nan if missing
+    :param time: int64 array of timestamps in nanoseconds since epoch, NO_TIME if missing
+    :param segment: segment number of each point, distances and times between
+            points of different segments are not counted
+    :param stopped_speed_threshold: speed in km/h, pairs of points below this
+            speed do not count as moving time (same default as gpxpy)
+    :param haversine: use the haversine formula for all distances, see pair_distances
+    :return: dictionary with distance, uphill, downhill, distance_crow [m] and
+            duration, moving_time [s]
+    """
+    n = len(lat)
+    if segment is None:
+        segment = np.zeros(n, dtype=np.int32)
+    if ele is None:
+        ele = np.full(n, np.nan)
+    samesegment = segment[1:] == segment[:-1]
+    d = pair_distances(lat, lon, ele, haversine=haversine)
+    d[~samesegment] = 0.0
+    m = dict(distance=float(d.sum()))
+    if time is None:
+        m["duration"] = m["moving_time"] = np.nan
+    else:
+        durations = segment_durations(time, segment)
+        m["duration"] = float(durations.sum())
+        withtime = samesegment & (time[1:] != NO_TIME) & (time[:-1] != NO_TIME)
+        seconds = np.where(withtime, (time[1:] - time[:-1]) / 1e9, 0.0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            speed_kmh = (d / 1000) / (seconds / 3600)
+        moving = withtime & (seconds > 0) & (d > 0) & (speed_kmh > stopped_speed_threshold)
+        m["moving_time"] = float(seconds[moving].sum())
+    m["uphill"], m["downhill"] = climb(ele, segment)
+    m["distance_crow"] = float(pair_distances(lat[[0, -1]], lon[[0, -1]], ele[[0, -1]], haversine=haversine)[0])
+    return m
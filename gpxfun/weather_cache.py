@@ -0,0 +1,164 @@
+"""
+Local SQLite cache of the hourly meteostat records, so that parsing the same rides again
+doesn't query meteostat again. The records are keyed by the location cell of the query
+(integer cell coordinates, see get_weather.WEATHER_CELL_DEGREES) and the UTC hour
+"""
+import logging
+from pathlib import Path
+import sqlite3
+import time
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+log = logging.getLogger("gpxfun." + __name__)
+
+WEATHER_CACHE_FILE = Path("pickles") / "weather.sqlite"
+# columns of meteostat.Hourly
+WEATHER_COLUMNS = ["temp", "dwpt", "rhum", "prcp", "snow", "wdir", "wspd", "wpgt", "pres", "tsun", "coco"]
+# records are fetched again after this time, meteostat revises recent data
+WEATHER_CACHE_TTL = pd.Timedelta(days=30)
+# the records fetched first are evicted when the cache grows beyond this number of hours
+WEATHER_CACHE_MAX_ROWS = 1_000_000
+# hours without a record are cached as missing only if they are older than this when
+# they are fetched, more recent records may still be added by meteostat
+WEATHER_CACHE_RECENT = pd.Timedelta(days=10)
+
+HOUR_NS = 3_600_000_000_000
+
+
+def to_hours(dts) -> np.ndarray:
+    """hours since the epoch of naive UTC datetimes"""
+    return np.asarray(pd.DatetimeIndex(dts).as_unit("ns").asi8, dtype=np.int64) // HOUR_NS
+
+
+class WeatherCache(object):
+    """
+    Hourly weather records of location cells in the table hourly of a SQLite file.
+    Hours without a meteostat record are stored with NULL values, so that they aren't
+    queried again. A connection is opened per call, the cache can be used from several threads
+    """
+
+    def __init__(
+        self,
+        path: Path = WEATHER_CACHE_FILE,
+        ttl: pd.Timedelta = WEATHER_CACHE_TTL,
+        max_rows: int = WEATHER_CACHE_MAX_ROWS,
+        offline: bool = False,
+    ):
+        """
+        :param path: SQLite file of the cache, ":memory:" is not supported
+        :param offline: only serve cached records, never query meteostat
+        """
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_rows = max_rows
+        self.offline = offline
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with self._connect() as con:
+            con.execute(
+                "CREATE TABLE IF NOT EXISTS hourly (ilat INTEGER, ilon INTEGER, hour INTEGER, fetched REAL, "
+                + ", ".join(f"{c} REAL" for c in WEATHER_COLUMNS)
+                + ", PRIMARY KEY (ilat, ilon, hour))"
+            )
+            con.execute("CREATE INDEX IF NOT EXISTS hourly_fetched ON hourly (fetched)")
+
+    def _connect(self) -> sqlite3.Connection:
+        con = sqlite3.connect(self.path, timeout=30)
+        con.execute("PRAGMA journal_mode=WAL")
+        return con
+
+    def _fresh(self) -> float:
+        return time.time() - self.ttl.total_seconds()
+
+    def __len__(self) -> int:
+        with self._connect() as con:
+            return con.execute("SELECT COUNT(*) FROM hourly").fetchone()[0]
+
+    def missing_hours(self, ilat: int, ilon: int, first_hour: int, last_hour: int) -> np.ndarray:
+        """hours of the range (both included) without a record that is younger than the ttl"""
+        with self._connect() as con:
+            cached = con.execute(
+                "SELECT hour FROM hourly WHERE ilat=? AND ilon=? AND hour BETWEEN ? AND ? AND fetched>=?",
+                (int(ilat), int(ilon), int(first_hour), int(last_hour), self._fresh()),
+            ).fetchall()
+        hours = np.arange(first_hour, last_hour + 1, dtype=np.int64)
+        return np.setdiff1d(hours, np.array([h for (h,) in cached], dtype=np.int64))
+
+    def get(self, ilat: int, ilon: int, first_hour: int, last_hour: int) -> pd.DataFrame:
+        """
+        cached records of a location cell, hours cached as missing are left out
+        :return: DataFrame with the column time (naive UTC) and the WEATHER_COLUMNS
+        """
+        with self._connect() as con:
+            rows = con.execute(
+                f"SELECT hour, {', '.join(WEATHER_COLUMNS)} FROM hourly "
+                "WHERE ilat=? AND ilon=? AND hour BETWEEN ? AND ? AND fetched>=? ORDER BY hour",
+                (int(ilat), int(ilon), int(first_hour), int(last_hour), self._fresh()),
+            ).fetchall()
+        wd = pd.DataFrame(rows, columns=["hour"] + WEATHER_COLUMNS).astype("float64")
+        wd = wd.dropna(how="all", subset=WEATHER_COLUMNS)
+        wd.insert(0, "time", pd.to_datetime(wd.pop("hour").astype(np.int64) * HOUR_NS))
+        return wd.reset_index(drop=True)
+
+    def put(self, ilat: int, ilon: int, hourly: pd.DataFrame, first_hour: int, last_hour: int):
+        """
+        store the result of a meteostat query of a location cell, hours of the range
+        without a record in hourly are stored as missing
+        :param hourly: DataFrame with the column time (naive UTC) and the WEATHER_COLUMNS
+        """
+        # numpy integers would be bound as blobs by sqlite3
+        first_hour, last_hour = int(first_hour), int(last_hour)
+        now = time.time()
+        records = pd.DataFrame(index=pd.RangeIndex(first_hour, last_hour + 1), columns=WEATHER_COLUMNS, dtype="float64")
+        if len(hourly) > 0:
+            h = hourly.set_axis(to_hours(hourly.time)).reindex(columns=WEATHER_COLUMNS)
+            h = h[(h.index >= first_hour) & (h.index <= last_hour)]
+            records.loc[h.index] = h.to_numpy(dtype=np.float64)
+        recent = to_hours([pd.Timestamp.utcnow().tz_localize(None) - WEATHER_CACHE_RECENT])[0]
+        records = records[records.notna().any(axis=1) | (records.index < recent)]
+        values = [
+            (int(ilat), int(ilon), int(hour), now, *[None if np.isnan(v) else float(v) for v in row])
+            for hour, row in zip(records.index, records.to_numpy())
+        ]
+        with self._connect() as con:
+            con.executemany(
+                f"INSERT OR REPLACE INTO hourly VALUES ({', '.join(['?'] * (4 + len(WEATHER_COLUMNS)))})", values
+            )
+        log.debug(f"weather cache: {len(values)} hours of cell ({ilat}, {ilon}) stored")
+        self.evict()
+
+    def evict(self):
+        """remove the records older than the ttl and the oldest records beyond max_rows"""
+        with self._connect() as con:
+            expired = con.execute("DELETE FROM hourly WHERE fetched<?", (self._fresh(),)).rowcount
+            surplus = con.execute("SELECT COUNT(*) FROM hourly").fetchone()[0] - self.max_rows
+            if surplus > 0:
+                con.execute(
+                    "DELETE FROM hourly WHERE rowid IN (SELECT rowid FROM hourly ORDER BY fetched LIMIT ?)",
+                    (surplus,),
+                )
+        if expired > 0 or surplus > 0:
+            log.info(f"weather cache: {expired} expired and {max(surplus, 0)} surplus hours evicted")
+
+    def clear(self):
+        with self._connect() as con:
+            con.execute("DELETE FROM hourly")
+
+
+_cache: Optional[WeatherCache] = None
+
+
+def get_weather_cache() -> WeatherCache:
+    """the cache used by get_weather if no other cache is given, see set_weather_cache"""
+    global _cache
+    if _cache is None:
+        _cache = WeatherCache()
+    return _cache
+
+
+def set_weather_cache(cache: WeatherCache):
+    """use another cache by default, e.g. WeatherCache(offline=True) to work without network"""
+    global _cache
+    _cache = cache
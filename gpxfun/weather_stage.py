@@ -0,0 +1,109 @@
+"""
+Weather enrichment of a session as a stage after parsing and clustering, so that the
+session can be used for the clustering and the maps before the weather data arrives
+"""
+import json
+import logging
+import os
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+import pandas as pd
+
+from .get_weather import WEATHER_WORKERS, get_weather_batch
+from .session_store import SESSION_FILE, WEATHER_FILE, read_session, read_weather, table_columns, write_weather
+from .weather_cache import WeatherCache
+
+log = logging.getLogger("gpxfun." + __name__)
+
+# marker of a running weather stage with the process id, in the session folder
+WEATHER_RUNNING = "weather.running"
+
+
+def add_weather(
+    folder: Path, cache: Optional[WeatherCache] = None, workers: int = WEATHER_WORKERS
+) -> Optional[pd.DataFrame]:
+    """
+    get the weather data of the routes of a session, which have none yet, and write it
+    to the weather file of the session. Routes without weather data, e.g. because the
+    queries failed, are tried again on the next call
+    :param folder: session folder
+    :param cache: weather cache, see get_weather.get_weather_batch
+    :param workers: number of concurrent meteostat queries
+    :return: DataFrame with the column filename and the weather data of all routes,
+            None for sessions with the weather data in the session file
+    """
+    folder = Path(folder)
+    if "temp" in table_columns(folder / SESSION_FILE):
+        log.debug(f"{folder} has the weather data in the session file")
+        return None
+    mark_weather_running(folder)
+    try:
+        return _add_weather(folder, cache, workers)
+    finally:
+        (folder / WEATHER_RUNNING).unlink(missing_ok=True)
+
+
+def _add_weather(folder: Path, cache: Optional[WeatherCache], workers: int) -> Optional[pd.DataFrame]:
+    d = read_session(folder, columns=["filename", "startdatetime", "start"])
+    known = read_weather(folder)
+    if known is not None:
+        known = known[known.filename.isin(set(d.filename)) & known.time.notna()]
+        d = d[~d.filename.isin(set(known.filename))]
+    log.info(f"weather data for {len(d)} routes of {folder}")
+    if len(d) == 0:
+        return known
+    wd = get_weather_batch(
+        d.startdatetime,
+        [x.latitude for x in d.start],
+        [x.longitude for x in d.start],
+        [np.nan if x.elevation is None else x.elevation for x in d.start],
+        cache=cache,
+        workers=workers,
+    )
+    wd.insert(0, "filename", d.filename.to_numpy())
+    weather = pd.concat([known, wd], ignore_index=True) if known is not None else wd.reset_index(drop=True)
+    write_weather(folder, weather)
+    return weather
+
+
+def mark_weather_running(folder: Path):
+    """mark the weather stage of a session as running in this process, see weather_state"""
+    with open(Path(folder) / WEATHER_RUNNING, "w") as f:
+        json.dump({"pid": os.getpid()}, f)
+
+
+def _pid_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def weather_state(folder: Path) -> str:
+    """
+    state of the weather data of a session, from the session folder so that every process
+    of the app sees the same state:
+    "ready" if the weather data of all routes is written, "running" if the weather stage of a
+    living process is running, "partial" if routes have no weather data yet (e.g. added later
+    or their queries failed) and "missing" if there is no weather data, e.g. if the weather
+    stage failed or the app was restarted
+    """
+    folder = Path(folder)
+    if "temp" in table_columns(folder / SESSION_FILE):
+        return "ready"
+    try:
+        with open(folder / WEATHER_RUNNING) as f:
+            if _pid_alive(json.load(f)["pid"]):
+                return "running"
+    except (FileNotFoundError, ValueError, KeyError):
+        pass
+    known = read_weather(folder)
+    if known is None:
+        return "missing"
+    filenames = set(read_session(folder, columns=["filename"]).filename)
+    return "ready" if filenames <= set(known.filename[known.time.notna()]) else "partial"
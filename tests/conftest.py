@@ -0,0 +1,28 @@
+import meteostat
+import pandas as pd
+import pytest
+
+from gpxfun import weather_cache
+
+
+class FakeHourly(object):
+    """stand-in for meteostat.Hourly without network, temp is the UTC hour of the record"""
+
+    calls = []
+
+    def __init__(self, loc, start, end, timezone=None, **kwargs):
+        FakeHourly.calls.append((loc._lat, loc._lon, start, end))
+        self.start, self.end = start, end
+
+    def fetch(self):
+        index = pd.date_range(pd.Timestamp(self.start).ceil("h"), self.end, freq="h", name="time")
+        return pd.DataFrame({"temp": index.hour.astype(float), "rhum": 50.0}, index=index)
+
+
+@pytest.fixture
+def fake_meteostat(monkeypatch, tmp_path):
+    """meteostat.Hourly replaced by FakeHourly and an empty weather cache"""
+    FakeHourly.calls = []
+    monkeypatch.setattr(weather_cache, "_cache", weather_cache.WeatherCache(tmp_path / "weather.sqlite"))
+    monkeypatch.setattr(meteostat, "Hourly", FakeHourly)
+    return FakeHourly
@@ -1,6 +1,27 @@
+import logging
+import threading
 
-from gpxfun.parse_gpx import read_gpx_from_folder
-from gpxfun.calc_dist_matrix import calc_dist_matrix
+import numpy as np
+import pandas as pd
+import pytest
+from scipy.spatial.distance import squareform
+import similaritymeasures
+
+from gpxfun import calc_dist_matrix as calc_dist_matrix_module
+from gpxfun.parse_gpx import read_gpx_file_list, read_gpx_from_folder
+from gpxfun.calc_dist_matrix import (
+    DP_MEASURES,
+    DistMatrixCancelled,
+    calc_dist_condensed,
+    calc_dist_matrix,
+    calc_dist_matrix_per_se_cluster,
+    dist_matrix_executor,
+    dp_distances,
+    prune_cutoff,
+    segment_bounds,
+)
+from gpxfun.cluster_it import RECUT_MAX_QUANTILE, calc_cluster_from_dist
+from utils.utilities import getfilelist
 
 def test_calc_dist_matrix():
     """
@@ -9,3 +30,151 @@ def test_calc_dist_matrix():
     df = read_gpx_from_folder("tests/data")
     dist = calc_dist_matrix(df, simmeasure="mae")
 
+
+
+def test_calc_dist_matrix_routes():
+    """routes passed as array give the same matrix as the route_inter column"""
+    df = read_gpx_file_list(getfilelist("tests/data", suffix="gpx", withpath=True), weather=False, workers=1)
+    routes = np.stack(df.route_inter)
+    dist = calc_dist_matrix(df.drop(columns="route_inter"), simmeasure="mae", routes=routes)
+    np.testing.assert_allclose(dist, calc_dist_matrix(df, simmeasure="mae"))
+    assert dist.shape == (len(df), len(df)) and (np.diag(dist) == 0).all()
+
+
+def test_calc_dist_matrix_blocks(monkeypatch):
+    """the block computation gives the values of similaritymeasures, also with several blocks"""
+    routes = np.cumsum(np.random.default_rng(1).normal(size=(23, 50, 2)), axis=1)
+    df = pd.DataFrame({"filename": [f"{i}.gpx" for i in range(len(routes))]})
+    monkeypatch.setattr(calc_dist_matrix_module, "BLOCK_ELEMENTS", 100 * 5**2)
+    for simmeasure, fun in (("mae", similaritymeasures.mae), ("mse", similaritymeasures.mse)):
+        dist = calc_dist_matrix(df, simmeasure=simmeasure, routes=routes)
+        expected = np.array([[fun(x, y) for y in routes] for x in routes])
+        np.testing.assert_allclose(dist, expected, rtol=1e-12)
+        assert (np.diag(dist) == 0).all() and (dist == dist.T).all()
+
+
+def test_calc_dist_matrix_parallel(monkeypatch, tmp_path):
+    """tiles on a process pool give the same matrix as in the calling process"""
+    routes = np.cumsum(np.random.default_rng(2).normal(size=(30, 20, 2)), axis=1)
+    df = pd.DataFrame({"filename": [f"{i}.gpx" for i in range(len(routes))]})
+    monkeypatch.setitem(calc_dist_matrix_module.TILE_ROUTES, "mae", 7)
+    monkeypatch.setitem(calc_dist_matrix_module.TILE_ROUTES, "area_comp", 12)
+    monkeypatch.setitem(calc_dist_matrix_module.TILE_ROUTES, "frechet", 9)
+    executor = dist_matrix_executor(2)
+    try:
+        for simmeasure in ("mae", "area_comp", "frechet"):
+            done = []
+            dist = calc_dist_matrix(
+                df, simmeasure=simmeasure, routes=routes, executor=executor, progress=lambda *x: done.append(x)
+            )
+            np.testing.assert_allclose(dist, calc_dist_matrix(df, simmeasure=simmeasure, routes=routes), rtol=1e-12)
+            assert done[-1][0] == done[-1][1] == len(done)
+        cutoff = np.quantile(squareform(calc_dist_matrix(df, routes=routes)), 0.3)
+        np.testing.assert_array_equal(
+            calc_dist_matrix(df, routes=routes, executor=executor, cutoff=cutoff),
+            calc_dist_matrix(df, routes=routes, cutoff=cutoff),
+        )
+        # the workers write to a memory mapped file
+        out = np.memmap(tmp_path / "dists.f32", dtype=np.float32, mode="w+", shape=(len(df) * (len(df) - 1) // 2,))
+        calc_dist_condensed(df, routes=routes, executor=executor, out=out)
+        np.testing.assert_allclose(squareform(out), calc_dist_matrix(df, routes=routes), rtol=1e-6)
+        cancel = threading.Event()
+        cancel.set()
+        with pytest.raises(DistMatrixCancelled):
+            calc_dist_matrix(df, simmeasure="mae", routes=routes, executor=executor, cancel=cancel)
+    finally:
+        executor.shutdown()
+
+
+def test_segment_bounds():
+    """the lower bounds are at most the distances"""
+    routes = np.cumsum(np.random.default_rng(3).normal(size=(12, 100, 2)), axis=1).reshape(12, -1)
+    for simmeasure, fun in (("mae", similaritymeasures.mae), ("mse", similaritymeasures.mse)):
+        bounds = segment_bounds(routes, simmeasure)
+        assert bounds.shape == (12, 2 * 32)
+        lower = calc_dist_matrix_module.BLOCK_MEASURES[simmeasure](bounds[:, None] - bounds[None, :]).sum(axis=-1)
+        expected = np.array([[fun(x.reshape(-1, 2), y.reshape(-1, 2)) for y in routes] for x in routes])
+        assert (lower <= expected + 1e-12).all() and (lower > 0.5 * expected).mean() > 0.5
+
+
+def test_pruned_clusters(caplog):
+    """pruned distances give the clusters of the exact distances, far pairs get a lower bound"""
+    rng = np.random.default_rng(4)
+    offsets = np.repeat(rng.normal(scale=10, size=(3, 1, 2)), 40, axis=0)
+    routes = offsets + np.cumsum(rng.normal(scale=0.1, size=(120, 50, 2)), axis=1)
+    df = pd.DataFrame(
+        {
+            "filename": [f"{i}.gpx" for i in range(len(routes))],
+            "route_inter": list(routes),
+            "startendcluster": pd.Categorical([0] * len(routes)),
+        }
+    )
+    cutoff = prune_cutoff(routes)
+    exact = calc_dist_matrix_per_se_cluster(df, workers=1, exact=True)[0]
+    with caplog.at_level(logging.INFO, logger="gpxfun"):
+        pruned = calc_dist_matrix_per_se_cluster(df, workers=1)[0]
+    assert f"{(exact > cutoff).sum()} route pairs with a lower bound above" in caplog.text
+    far = exact > cutoff
+    np.testing.assert_array_equal(pruned[~far], exact[~far])
+    assert (pruned[far] > cutoff).all() and (pruned[far] <= exact[far] * (1 + 1e-6)).all()
+    labels = [calc_cluster_from_dist(x, df.filename).cluster.to_numpy() for x in (exact, pruned)]
+    np.testing.assert_array_equal(*labels)
+
+
+def test_pruned_recut():
+    """pruned distances give the clusters of the exact distances at the largest recut quantile"""
+    rng = np.random.default_rng(1)
+    base = np.cumsum(rng.normal(scale=0.1, size=(1, 50, 2)), axis=1)
+    # a zigzag around the offset: the lower bound of the segment means is far below the distance
+    zigzag = np.zeros((1, 50, 2))
+    zigzag[0, :, 1] = 4 * (-1) ** np.arange(50)
+    groups = [(base, 60), (base + [2, 0], 20), (base + [0, 1.2] + zigzag, 20), (base + [40, 0], 4)]
+    routes = np.concatenate([np.repeat(g, n, axis=0) + rng.normal(scale=0.1, size=(n, 50, 2)) for g, n in groups])
+    df = pd.DataFrame(
+        {
+            "filename": [f"{i}.gpx" for i in range(len(routes))],
+            "route_inter": list(routes),
+            "startendcluster": pd.Categorical([0] * len(routes)),
+        }
+    )
+    exact = calc_dist_matrix_per_se_cluster(df, workers=1, exact=True)[0]
+    pruned = calc_dist_matrix_per_se_cluster(df, workers=1)[0]
+    assert (pruned < exact).any()
+    labels = [
+        calc_cluster_from_dist(x, df.filename, quantile=RECUT_MAX_QUANTILE).cluster.to_numpy() for x in (exact, pruned)
+    ]
+    np.testing.assert_array_equal(*labels)
+
+
+def _banded(x, y, window, frechet):
+    """dynamic programming of the measures cell by cell"""
+    n = len(x)
+    c = np.full((n + 1, n + 1), np.inf)
+    c[0, 0] = 0
+    for i in range(1, n + 1):
+        for j in range(max(1, i - window), min(n, i + window) + 1):
+            cost, best = np.hypot(*(x[i - 1] - y[j - 1])), min(c[i - 1, j], c[i, j - 1], c[i - 1, j - 1])
+            c[i, j] = max(cost, best) if frechet else cost + best
+    return c[n, n] if frechet else c[n, n] / n
+
+
+def test_dp_distances():
+    """frechet and dtw are the unconstrained measures of similaritymeasures and the banded ones"""
+    rng = np.random.default_rng(5)
+    x, y = np.cumsum(rng.normal(size=(2, 40, 30, 2)), axis=2)
+    np.testing.assert_allclose(
+        dp_distances(x, y, "frechet", window=30)[0], [similaritymeasures.frechet_dist(a, b) for a, b in zip(x, y)]
+    )
+    np.testing.assert_allclose(
+        dp_distances(x, y, "dtw", window=30)[0], [similaritymeasures.dtw(a, b)[0] / 30 for a, b in zip(x, y)]
+    )
+    for simmeasure in DP_MEASURES:
+        dist, abandoned = dp_distances(x, y, simmeasure, window=4)
+        np.testing.assert_allclose(dist, [_banded(a, b, 4, simmeasure == "frechet") for a, b in zip(x, y)])
+        assert not abandoned.any()
+        # early abandoning gives a lower bound above the threshold
+        threshold = np.median(dist)
+        pruned, abandoned = dp_distances(x, y, simmeasure, window=4, threshold=threshold)
+        assert abandoned.any() and (dist[abandoned] > threshold).all()
+        np.testing.assert_array_equal(pruned[~abandoned], dist[~abandoned])
+        assert (pruned[abandoned] > threshold).all() and (pruned[abandoned] <= dist[abandoned]).all()
@@ -1,4 +1,11 @@
-from callbacks import choose_analyzer
+from dash import no_update
+import numpy as np
+import pandas as pd
+
+from callbacks import choose_analyzer, recut as recut_callback, update_cluster_quantile_slider
+from gpxfun.linkage_store import LinkageStore
+from gpxfun.session_store import write_session
+
 # from dash.html import Div
 # from dash.dcc import Checklist, Input
 
@@ -8,3 +15,17 @@ def test_choose_analyzer():
     assert sty==[{'display': 'block'}, {'display': 'none'}]
 
 
+def test_recut_without_linkage(tmp_path, monkeypatch):
+    """the slider shows the stored cut, sessions without linkages disable it instead of failing"""
+    monkeypatch.chdir(tmp_path)
+    folder = tmp_path / "sessions" / "s1"
+    folder.mkdir(parents=True)
+    write_session(folder, pd.DataFrame({"filename": ["0.gpx"], "cluster": ["0_0"]}), pd.DataFrame({"cluster": ["0_0"]}))
+    assert update_cluster_quantile_slider(True, "s1") == (no_update, True)
+    assert recut_callback(0.2, True, "s1", 0) is no_update
+    linkages = LinkageStore(folder)
+    linkages.save(0, ["0.gpx", "1.gpx"], np.array([[0.0, 1.0, 0.5, 2.0]]), np.full(101, 0.5))
+    linkages.save_cut(0.2, 10)
+    assert update_cluster_quantile_slider(True, "s1") == (0.2, False)
+    # the slider set to the stored cut doesn't recut
+    assert recut_callback(0.2, True, "s1", 0) is no_update
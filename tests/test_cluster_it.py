@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+
+from gpxfun import cluster_it as cluster_it_module
+from gpxfun.calc_dist_matrix import calc_dist_matrix_per_se_cluster
+from gpxfun.cluster_it import calc_cluster_from_dist, calc_cluster_sparse, cluster_all, recut_clusters
+from gpxfun.linkage_store import LinkageStore
+from gpxfun.route_index import RouteIndex, route_sketches
+
+
+def _rides(seed=7):
+    """rides on three paths from the same start and three rides on paths of their own"""
+    rng = np.random.default_rng(seed)
+    steps = rng.normal(scale=1e-4, size=(6, 200, 2)) + rng.normal(scale=1e-4, size=(6, 1, 2))
+    paths = np.array([8.6, 50.1]) + np.cumsum(steps, axis=1)
+    path = np.array([0] * 30 + [1] * 20 + [2] * 10 + [3, 4, 5])
+    routes = paths[path] + rng.normal(scale=1e-5, size=(len(path), 200, 2))
+    d = pd.DataFrame(
+        {
+            "filename": [f"{i}.gpx" for i in range(len(path))],
+            "startendcluster": pd.Categorical([0] * len(path)),
+            "route_inter": list(routes),
+        }
+    )
+    return d, routes, path
+
+
+def test_calc_cluster_sparse():
+    """the paths are found on the sparse graph, the rides on paths of their own are left over"""
+    d, routes, path = _rides()
+    dfcluster = calc_cluster_sparse(route_sketches(routes), list(d.filename), "0", min_routes_per_cluster=3)
+    assert list(dfcluster.loc[d.filename, "cluster"]) == [f"0_{p}" if p < 3 else "0_other" for p in path]
+    dense = calc_cluster_from_dist(calc_dist_matrix_per_se_cluster(d, workers=1)[0], list(d.filename), "0", 3)
+    # average linkage cut at the quantile of the distances splits off single rides
+    assert (dense.loc[d.filename, "cluster"] == dfcluster.loc[d.filename, "cluster"]).mean() > 0.95
+
+
+def test_calc_cluster_sparse_duplicates():
+    """identical sketches of repeated rides share a cluster, the rides left over share <label>_other"""
+    rng = np.random.default_rng(1)
+    sketches = np.repeat(rng.normal(scale=10, size=(2, 32)), [5, 6], axis=0)
+    sketches = np.concatenate([sketches, rng.normal(scale=10, size=(3, 32))])
+    dfcluster = calc_cluster_sparse(sketches, [f"{i}.gpx" for i in range(14)], "0")
+    assert list(dfcluster.cluster) == ["0_1"] * 5 + ["0_0"] * 6 + ["0_other"] * 3
+    assert list(dfcluster.filename) == [f"{i}.gpx" for i in range(14)]
+
+
+def test_cluster_all_sparse(monkeypatch):
+    """large startendclusters are clustered with the route index"""
+    d, routes, path = _rides()
+    index = RouteIndex()
+    index.put(d.filename, routes)
+    se_clusters = pd.DataFrame({"startendcluster": pd.Categorical([0])})
+    monkeypatch.setattr(cluster_it_module, "SPARSE_MIN_ROUTES", 50)
+    dists = calc_dist_matrix_per_se_cluster(d, workers=1, max_routes=50)
+    assert dists[0] is None and dists["0_filenamen"] == list(d.filename)
+    clustered, clustercombis = cluster_all(d.drop(columns="route_inter"), dists, se_clusters, 3, index=index)
+    assert list(clustered.cluster) == [f"0_{p}" if p < 3 else "0_other" for p in path]
+    assert sorted(clustercombis.filename) == [3, 10, 20, 30]
+
+
+def test_recut_clusters(tmp_path):
+    """the stored linkage cut at another quantile gives the clusters of the distances"""
+    d, routes, path = _rides()
+    dists = calc_dist_matrix_per_se_cluster(d, workers=1)
+    se_clusters = pd.DataFrame({"startendcluster": pd.Categorical([0])})
+    linkages = LinkageStore(tmp_path)
+    clustered, _ = cluster_all(d.drop(columns="route_inter"), dists, se_clusters, 3, linkages=linkages)
+    assert linkages.cut() == {"quantile": 0.3, "min_routes_per_cluster": 3}
+    assert linkages.get(0)[0] == list(d.filename) and linkages.get(1) is None
+    for quantile in (0.05, 0.3, 0.42, 0.9):
+        recut = recut_clusters(clustered, linkages, quantile, 3)
+        expected = calc_cluster_from_dist(dists[0], list(d.filename), "0", 3, quantile=quantile)
+        assert list(recut.cluster) == list(expected.loc[d.filename, "cluster"])
+    assert recut.cluster.nunique() < clustered.cluster.nunique()
+    # rides added after the clustering aren't in the linkage
+    added = pd.concat([clustered, clustered.tail(1).assign(filename="new.gpx")], ignore_index=True)
+    assert recut_clusters(added, linkages, 0.3, 3).cluster.isna().tolist() == [False] * len(d) + [True]
+    linkages.remove_other([])
+    assert linkages.get(0) is None
@@ -0,0 +1,71 @@
+from gpxpy.geo import Location
+import numpy as np
+import pandas as pd
+
+from gpxfun.cluster_model import ClusterModel, stable_route_labels, stable_startend_labels
+from gpxfun.route_index import RouteIndex
+
+
+def _session(n=40, seed=8):
+    """rides from one start to one end on two paths, and rides from elsewhere"""
+    rng = np.random.default_rng(seed)
+    paths = np.array([8.6, 50.1]) + np.cumsum(rng.normal(scale=2e-4, size=(2, 100, 2)), axis=1)
+    paths[:, -1] = paths[0, -1]
+    path = rng.integers(0, 2, n)
+    routes = paths[path] + rng.normal(scale=1e-5, size=(n, 100, 2))
+    d = pd.DataFrame(
+        {
+            "filename": [f"{i}.gpx" for i in range(n)],
+            "start": [Location(r[0, 1], r[0, 0]) for r in routes],
+            "ende": [Location(r[-1, 1], r[-1, 0]) for r in routes],
+            "startendcluster": pd.Categorical([0] * n, categories=[0, "other"]),
+            "cluster": [f"0_{p}" for p in path],
+        }
+    )
+    d["start_lat"], d["start_lon"] = routes[:, 0, 1], routes[:, 0, 0]
+    d["ende_lat"], d["ende_lon"] = routes[:, -1, 1], routes[:, -1, 0]
+    se_clusters = d.groupby("startendcluster", observed=True)[["start_lat", "start_lon", "ende_lat", "ende_lon"]].mean()
+    return d, se_clusters.reset_index(), routes, paths
+
+
+def test_cluster_model(tmp_path):
+    """new rides are assigned to the nearest cluster, rides elsewhere are left out"""
+    d, se_clusters, routes, paths = _session()
+    index = RouteIndex()
+    index.put(d.filename, routes)
+    ClusterModel.fit(d, se_clusters, index).save(tmp_path)
+    model = ClusterModel.load(tmp_path)
+    assert len(model.routes) == 2 and model.unassigned_fraction == 0
+    rides = np.stack([paths[1], paths[0], paths[0] + 0.05, paths[1][::-1]]) + 1e-5
+    new = pd.DataFrame(
+        {
+            "filename": ["a.gpx", "b.gpx", "c.gpx", "d.gpx"],
+            "start": [Location(r[0, 1], r[0, 0]) for r in rides],
+            "ende": [Location(r[-1, 1], r[-1, 0]) for r in rides],
+        }
+    )
+    index.put(new.filename, rides)
+    assigned = model.assign(new, index.sketches_for(new.filename))
+    assert list(assigned.startendcluster) == [0, 0, "other", "other"]
+    assert list(assigned.cluster) == ["0_1", "0_0", "other_other", "other_other"]
+    assert model.added == 4 and model.added_unassigned == 2 and not model.needs_recluster()
+    model.assign(pd.concat([new.iloc[2:]] * 5), index.sketches_for(list(new.filename[2:]) * 5))
+    assert model.drift()["unassigned"] > 0.2 and model.needs_recluster()
+
+
+def test_stable_labels():
+    """a new clustering keeps the labels of the old one, new clusters get new numbers"""
+    d, se_clusters, _, _ = _session()
+    old = d.set_index("filename")
+    new = d.copy()
+    new["startendcluster"] = new.startendcluster.cat.rename_categories({0: 1})
+    se_clusters["startendcluster"] = se_clusters.startendcluster.cat.rename_categories({0: 1})
+    new, se_new = stable_startend_labels(new, se_clusters, old.startendcluster)
+    assert list(new.startendcluster.cat.categories) == [0, "other"] and list(se_new.startendcluster) == [0]
+    # the clusters swap their numbers, a part of 0_1 is a cluster of its own
+    new["cluster"] = new.cluster.map({"0_0": "0_1", "0_1": "0_0"})
+    new.loc[new.index[new.cluster == "0_0"][:3], "cluster"] = "0_2"
+    new.loc[new.index[-1], "cluster"] = "0_other"
+    renamed = stable_route_labels(new, old.cluster)
+    assert renamed == {"0_1": "0_0", "0_0": "0_1", "0_2": "0_2", "0_other": "0_other"}
+    assert (new.cluster.map(renamed)[:-1] == d.cluster[:-1]).mean() > 0.9
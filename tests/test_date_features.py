@@ -0,0 +1,27 @@
+import datetime
+
+import pandas as pd
+
+from gpxfun.date_features import date_features
+from utils.utilities import season_of_date
+
+
+def test_date_features():
+    utc = pd.Series(pd.to_datetime(["2022-09-04 12:59:53", "2022-12-31 23:30:00"], utc=True))
+    d = date_features(utc.dt.tz_convert("Europe/Berlin"))
+    assert list(d.date) == [datetime.date(2022, 9, 4), datetime.date(2023, 1, 1)]
+    assert list(d.starttime) == [datetime.time(14, 59, 53), datetime.time(0, 30)]
+    assert list(d.starttimefloat) == [14 + 59 / 60, 0.5]
+    assert list(d.month) == [9, 1]
+    assert list(d.weekday) == ["Sunday", "Sunday"]
+    assert list(d.season) == [season_of_date(x) for x in d.date]
+
+
+def test_date_features_mixed_timezones():
+    """each datetime gets the calendar fields of its own timezone"""
+    utc = pd.Timestamp("2022-12-31 23:30:00", tz="UTC")
+    dts = pd.Series([utc.tz_convert("Europe/Berlin"), utc.tz_convert("America/New_York")], dtype=object)
+    d = date_features(dts)
+    assert list(d.date) == [datetime.date(2023, 1, 1), datetime.date(2022, 12, 31)]
+    assert list(d.weekday) == ["Sunday", "Saturday"]
+    assert list(d.starttimefloat) == [0.5, 18.5]
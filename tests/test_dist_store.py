@@ -0,0 +1,88 @@
+import numpy as np
+import pandas as pd
+from scipy.spatial.distance import squareform
+
+from gpxfun import calc_dist_matrix as calc_dist_matrix_module
+from gpxfun.calc_dist_matrix import calc_dist_condensed, calc_dist_matrix, calc_dist_matrix_per_se_cluster
+from gpxfun.cluster_it import calc_cluster_from_dist
+from gpxfun.dist_store import DistStore
+
+
+def _routes(n, seed=3):
+    return np.cumsum(np.random.default_rng(seed).normal(size=(n, 30, 2)), axis=1)
+
+
+def test_condensed_float32():
+    routes = _routes(11)
+    df = pd.DataFrame({"filename": [f"{i}.gpx" for i in range(len(routes))]})
+    condensed = calc_dist_condensed(df, routes=routes)
+    assert condensed.dtype == np.float32 and condensed.shape == (55,)
+    np.testing.assert_allclose(squareform(condensed), calc_dist_matrix(df, routes=routes), rtol=1e-6)
+    # clusters of the condensed vector and of the square matrix
+    square = calc_cluster_from_dist(calc_dist_matrix(df, routes=routes), list(df.filename))
+    assert (calc_cluster_from_dist(condensed, list(df.filename)).cluster == square.cluster).all()
+
+
+def test_dist_store(tmp_path):
+    routes = _routes(9)
+    d = pd.DataFrame(
+        {
+            "filename": [f"{i}.gpx" for i in range(9)],
+            "startendcluster": pd.Categorical([0, 0, 1, 0, 1, 1, 0, 1, 0]),
+            "route_inter": list(routes),
+        }
+    )
+    store = DistStore(tmp_path)
+    dists = calc_dist_matrix_per_se_cluster(d, store=store, workers=1)
+    assert isinstance(dists[0], np.memmap)
+    for a in (0, 1):
+        filenames, stored = store.get(a, "mae")
+        assert filenames == dists[f"{a}_filenamen"] == list(d.filename[d.startendcluster == a])
+        np.testing.assert_array_equal(stored, calc_dist_matrix_per_se_cluster(d, workers=1)[a])
+    assert store.get(0, "area_comp") is None
+    assert store.get(2) is None
+    # pruned distances aren't used in the exact mode
+    assert store.cutoff(0) is None and store.get(0, exact=True) is not None
+    store.create(0, len(filenames))
+    store.save(0, filenames, "mae", cutoff=0.5)
+    assert store.cutoff(0) == 0.5 and store.get(0, exact=True) is None and store.get(0) is not None
+
+
+def test_incremental_update(tmp_path, monkeypatch):
+    """only the distances to new and changed routes are computed, the result is the same"""
+    routes = _routes(12)
+    d = pd.DataFrame(
+        {
+            "filename": [f"{i}.gpx" for i in range(12)],
+            "startendcluster": pd.Categorical([0] * 12),
+            "route_inter": list(routes),
+        }
+    )
+    store = DistStore(tmp_path)
+    calc_dist_matrix_per_se_cluster(d.head(8), store=store, workers=1)
+    # 4 new routes, one changed route and one removed route
+    d.at[3, "route_inter"] = routes[3] + 1.0
+    dnew = d.drop(index=5)
+    full = calc_dist_matrix(dnew)
+    computed = []
+    original = calc_dist_matrix_module.calc_dist_condensed
+    monkeypatch.setattr(
+        calc_dist_matrix_module,
+        "calc_dist_condensed",
+        lambda df, **kwargs: computed.append((len(df), kwargs["first_new"])) or original(df, **kwargs),
+    )
+    dists = calc_dist_matrix_per_se_cluster(dnew, store=store, workers=1, changed={"3.gpx"})
+    assert computed == [(11, 6)]
+    assert dists["0_filenamen"] == ["0.gpx", "1.gpx", "2.gpx", "4.gpx", "6.gpx", "7.gpx", "3.gpx"] + [
+        f"{i}.gpx" for i in range(8, 12)
+    ]
+    order = [list(dnew.filename).index(fn) for fn in dists["0_filenamen"]]
+    np.testing.assert_allclose(squareform(dists[0]), full[np.ix_(order, order)], rtol=1e-6)
+    # unchanged startendcluster, nothing is computed
+    calc_dist_matrix_per_se_cluster(dnew.set_index("filename", drop=False).loc[dists["0_filenamen"]], store=store)
+    assert len(computed) == 1
+    # new startendclusters, the distances are computed from scratch
+    dnew["startendcluster"] = pd.Categorical([1] * len(dnew))
+    calc_dist_matrix_per_se_cluster(dnew, store=store, workers=1)
+    assert computed[-1] == (11, 0)
+    assert store.get(0) is None
@@ -1,10 +1,11 @@
 import datetime
 
 from gpxpy.geo import Location
+import numpy as np
 import pandas as pd
 import pytz
 
-from gpxfun.get_weather import get_weather, get_weather_dict
+from gpxfun.get_weather import WEATHER_COLUMNS, get_weather, get_weather_batch, get_weather_dict
 
 
 def test_get_weather_dict():
@@ -61,3 +62,66 @@ def test_get_weather_smoke():
         8,
         100,
     )
+
+
+def test_get_weather_batch(fake_meteostat):
+    """one query per location cell and year, each ride gets the next full hour"""
+    dts = pd.Series(
+        pd.to_datetime(["2022-02-03 09:10", "2022-05-03 17:00", "2022-02-03 09:10"]).tz_localize("Europe/Berlin")
+    )
+    wd = get_weather_batch(dts, [50.11, 50.12, 48.1], [8.68, 8.69, 11.5], [100, 110, np.nan])
+    assert len(fake_meteostat.calls) == 2
+    assert list(wd.temp) == [9.0, 15.0, 9.0]
+    assert list(wd.time) == list(pd.to_datetime(["2022-02-03 09:00", "2022-05-03 15:00", "2022-02-03 09:00"]))
+    assert list(wd.columns) == ["time"] + WEATHER_COLUMNS
+    assert wd.snow.isna().all()
+
+
+def test_get_weather_cached(fake_meteostat):
+    """same shape as get_weather with meteostat, the second call is served from the cache"""
+    sd = pd.DataFrame(
+        {
+            "startdatetime": [pytz.timezone("Europe/Berlin").localize(datetime.datetime(2022, 2, 3, 9, 10))] * 2,
+            "start": [Location(50, 8, 100)] * 2,
+        }
+    )
+    wd = get_weather(sd)
+    assert wd.shape == (2, 14)
+    assert wd.iloc[0]["time"] == pd.Timestamp("2022-02-03 10:00", tz="Europe/Berlin")
+    assert wd.iloc[0]["temp"] == 9.0
+    assert len(fake_meteostat.calls) == 1
+    d = get_weather_dict(datetime.datetime(2022, 2, 3, 8, 40, tzinfo=pytz.utc), 50.01, 8.01, 100)
+    assert d["temp"] == 9.0
+    assert set(d) == set(WEATHER_COLUMNS)
+    assert len(fake_meteostat.calls) == 1
+
+
+def test_weather_at_dst_change(fake_meteostat):
+    """rides started in the ambiguous hour of the change to winter time"""
+    berlin = pytz.timezone("Europe/Berlin")
+    for is_dst, hour in ((True, 1), (False, 2)):
+        dt = berlin.localize(datetime.datetime(2022, 10, 30, 2, 30), is_dst=is_dst)
+        # the next full hour in UTC
+        assert get_weather_dict(dt, 50, 8, 100)["temp"] == hour
+    # naive wall times: the later of the ambiguous times, nonexistent times shifted to 03:00
+    dts = pd.Series([datetime.datetime(2022, 10, 30, 2, 30), datetime.datetime(2022, 3, 27, 2, 30)], dtype=object)
+    assert list(get_weather_batch(dts, [50, 50], [8, 8]).temp) == [2.0, 1.0]
+
+
+def test_get_weather_dedupe(fake_meteostat):
+    """identical rides are fetched once, the rows keep their index, order and timezone"""
+    berlin = pytz.timezone("Europe/Berlin").localize(datetime.datetime(2022, 2, 3, 9, 10))
+    sd = pd.DataFrame(
+        {
+            "startdatetime": [berlin, berlin.astimezone(pytz.timezone("Europe/London")), berlin, berlin],
+            "start": [Location(50, 8, 100), Location(51.5, 0, 10), Location(50, 8, 100), Location(50.01, 8.01, 120)],
+        },
+        index=[7, 3, 5, 1],
+    )
+    wd = get_weather(sd)
+    assert wd.shape == (4, 14)
+    assert list(wd.index) == [7, 3, 5, 1]
+    assert len(fake_meteostat.calls) == 2
+    assert list(wd.temp) == [9.0] * 4
+    assert [str(x.tzinfo) for x in wd.time] == ["Europe/Berlin", "Europe/London", "Europe/Berlin", "Europe/Berlin"]
+    assert wd.time.iloc[1] == pd.Timestamp("2022-02-03 09:00", tz="Europe/London")
@@ -0,0 +1,55 @@
+import gzip
+from pathlib import Path
+import zipfile
+
+from gpxfun.gpx_sources import GpxBytes, archive_gpx, expand_gpx_sources, gpx_files_in, open_gpx
+from utils.utilities import getfilelist
+
+
+def test_open_gpx():
+    f = Path("tests/data/20220904T145953000.gpx")
+    g = GpxBytes(f.name, f.read_bytes())
+    assert g.suffix == ".gpx" and str(g) == f.name
+    with open_gpx(f) as a, open_gpx(g) as b:
+        assert a.read() == b.read()
+
+
+def test_archive_gpx(tmp_path):
+    f = Path("tests/data/20220904T145953000.gpx")
+    archive_gpx([f, GpxBytes("upload.gpx", b"<gpx/>")], tmp_path / "archive")
+    assert gzip.decompress((tmp_path / "archive" / (f.name + ".gz")).read_bytes()) == f.read_bytes()
+    assert gzip.decompress((tmp_path / "archive" / "upload.gpx.gz").read_bytes()) == b"<gpx/>"
+
+
+def _zip(path, files):
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as z:
+        for f in files[:-1]:
+            z.write(f, "export/" + f.name)
+        z.write(files[-1], files[-1].name, compress_type=zipfile.ZIP_STORED)
+
+
+def test_expand_gpx_sources(tmp_path):
+    """members of archives and gzip files are read without extracting them"""
+    files = sorted(getfilelist("tests/data", suffix="gpx", withpath=True))
+    _zip(tmp_path / "export.zip", files[:3])
+    (tmp_path / "single.gpx.gz").write_bytes(gzip.compress(files[3].read_bytes()))
+    zipped = GpxBytes("upload.zip", (tmp_path / "export.zip").read_bytes())
+    expanded = expand_gpx_sources([tmp_path / "export.zip", tmp_path / "single.gpx.gz", zipped, files[4]])
+    names = [f.name for f in files[:3]]
+    assert [x.name for x in expanded] == names + ["single.gpx"] + names + [files[4].name]
+    assert expanded[-1] == files[4]
+    for x, f in zip(expanded, files[:4] + files[:3]):
+        with open_gpx(x) as fh:
+            assert fh.read() == f.read_bytes()
+    assert sorted(f.name for f in gpx_files_in(tmp_path)) == ["export.zip", "single.gpx.gz"]
+
+
+def test_zip_members_same_name(tmp_path):
+    """members with the same file name in different folders get unique names"""
+    f = sorted(getfilelist("tests/data", suffix="gpx", withpath=True))[0]
+    with zipfile.ZipFile(tmp_path / "years.zip", "w", zipfile.ZIP_DEFLATED) as z:
+        z.write(f, "2022/ride.gpx")
+        z.write(f, "2023/ride.gpx")
+        z.write(f, "2023/other.gpx")
+    expanded = expand_gpx_sources([tmp_path / "years.zip"])
+    assert [x.name for x in expanded] == ["2022_ride.gpx", "2023_ride.gpx", "other.gpx"]
@@ -0,0 +1,50 @@
+import os
+
+from gpxfun.ingest_index import CHANGED, NEW, REJECTED, SKIPPED, IngestIndex
+
+
+def test_ingest_index(tmp_path):
+    a = tmp_path / "a.gpx"
+    a.write_text("ride a")
+    b = tmp_path / "b.gpx"
+    b.write_text("ride b")
+    index = IngestIndex.load(tmp_path / "index.json")
+    report = index.classify([a, b])
+    assert report[NEW] == [a, b]
+    index.register(["a.gpx", "b.gpx"])
+    index.save()
+
+    index = IngestIndex.load(tmp_path / "index.json")
+    assert "a.gpx" in index and len(index) == 2
+    renamed = tmp_path / "renamed.gpx"
+    renamed.write_text("ride a")
+    b.write_text("ride b, changed")
+    os.utime(a, (0, 0))
+    report = index.classify([a, b, renamed])
+    assert report[SKIPPED] == [a, renamed]
+    assert report[CHANGED] == [b]
+    index.register(["b.gpx"])
+    assert index.hashes[index.files["b.gpx"]["hash"]] == "b.gpx"
+
+
+def test_ingest_index_duplicates_in_batch(tmp_path):
+    files = [tmp_path / f"{x}.gpx" for x in "abc"]
+    for f in files:
+        f.write_text("same ride")
+    report = IngestIndex(tmp_path / "index.json").classify(files)
+    assert report[NEW] == files[:1]
+    assert report[SKIPPED] == files[1:]
+
+
+def test_ingest_index_same_name_in_batch(tmp_path):
+    """the second file with the same name is rejected, registering a name twice doesn't fail"""
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    files = [tmp_path / "a" / "ride.gpx", tmp_path / "b" / "ride.gpx"]
+    files[0].write_text("ride a")
+    files[1].write_text("ride b")
+    index = IngestIndex(tmp_path / "index.json")
+    report = index.classify(files)
+    assert report[NEW] == files[:1] and report[REJECTED] == files[1:]
+    index.register(["ride.gpx", "ride.gpx"])
+    assert index.hashes[index.files["ride.gpx"]["hash"]] == "ride.gpx"
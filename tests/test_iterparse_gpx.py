@@ -0,0 +1,21 @@
+import numpy as np
+import pytest
+
+from gpxfun.iterparse_gpx import ExoticGpxError, read_gpx_arrays
+
+
+def test_read_gpx_arrays():
+    a = read_gpx_arrays("tests/data/20221212T171500000.gpx")
+    assert a["lat"].dtype == np.float64 and a["lat"].flags.c_contiguous
+    assert a["time"].dtype == np.int64
+    assert len(a["lat"]) == len(a["lon"]) == len(a["ele"]) == len(a["time"]) == 161
+    assert list(np.unique(a["segment"])) == [0, 1]
+    assert a["keywords"] == "Bike"
+    assert np.all(np.diff(a["time"]) > 0)
+
+
+def test_read_gpx_arrays_exotic(tmp_path):
+    f = tmp_path / "route.gpx"
+    f.write_text('<gpx version="1.1"><rte><rtept lat="50" lon="8"/><rtept lat="50.1" lon="8.1"/></rte></gpx>')
+    with pytest.raises(ExoticGpxError):
+        read_gpx_arrays(f)
@@ -0,0 +1,166 @@
+import gzip
+from pathlib import Path
+import shutil
+import zipfile
+
+import numpy as np
+import pytest
+
+from gpxfun.parse_gpx import read_gpx_file, read_gpx_file_list, update_pickle_from_list
+from gpxfun.gpx_sources import GpxBytes
+from gpxfun.route_index import NEAR_DUPLICATES, RouteIndex
+from gpxfun.route_store import RouteStore
+from utils.utilities import getfilelist
+
+
+def test_read_gpx_file_list_parallel():
+    """parallel ingest keeps the order of the file list"""
+    filelist = sorted(getfilelist("tests/data", suffix="gpx", withpath=True))
+    dseq = read_gpx_file_list(filelist, weather=False, workers=1)
+    dpar = read_gpx_file_list(filelist, weather=False, workers=2)
+    assert list(dpar.filename) == [f.name for f in filelist]
+    assert list(dpar.distance) == list(dseq.distance)
+    assert dpar.attrs["errors"] == []
+
+
+def test_read_gpx_file_list_errors(tmp_path):
+    """a broken file ends up in the error report, the other files are read"""
+    broken = tmp_path / "broken.gpx"
+    broken.write_text("<gpx><trk><trkseg><trkpt lat=")
+    filelist = [Path("tests/data/20220904T145953000.gpx"), broken]
+    d = read_gpx_file_list(filelist, weather=False, workers=2)
+    assert list(d.filename) == ["20220904T145953000.gpx"]
+    assert [e["filename"] for e in d.attrs["errors"]] == ["broken.gpx"]
+
+
+def _same_fields(a: dict, b: dict):
+    assert a.keys() == b.keys()
+    for k in b:
+        if k in ("start", "ende"):
+            assert (a[k].latitude, a[k].longitude, a[k].elevation) == (b[k].latitude, b[k].longitude, b[k].elevation)
+        elif isinstance(b[k], float):
+            assert a[k] == pytest.approx(b[k], rel=1e-9), k
+        elif k == "route_inter":
+            np.testing.assert_allclose(np.array(a[k]), np.array(b[k]), rtol=1e-9)
+        else:
+            assert a[k] == b[k], k
+
+
+@pytest.mark.parametrize("filename", sorted(getfilelist("tests/data", suffix="gpx", withpath=True)))
+def test_backends_agree(filename):
+    """the iterparse fast path gives the same results as gpxpy"""
+    _same_fields(
+        read_gpx_file(filename, weather=False, backend="iterparse"),
+        read_gpx_file(filename, weather=False, backend="gpxpy"),
+    )
+
+
+def test_iterparse_fallback(tmp_path):
+    """a trackpoint without time is left to gpxpy"""
+    txt = Path("tests/data/20220904T145953000.gpx").read_text()
+    exotic = tmp_path / "notime.gpx"
+    exotic.write_text(txt.replace("<time>2022-09-04T12:59:53Z</time>", "", 2))
+    with open(exotic, "rb") as fh:
+        p = read_gpx_file(exotic, filehandle=fh, weather=False, backend="iterparse")
+    _same_fields(p, read_gpx_file(exotic, weather=False, backend="gpxpy"))
+
+
+def test_read_gpx_file_list_localized():
+    """the timezones resolved for the whole list match the ones of single files"""
+    filelist = sorted(getfilelist("tests/data", suffix="gpx", withpath=True))
+    d = read_gpx_file_list(filelist, weather=False, workers=1)
+    single = [read_gpx_file(f, weather=False) for f in filelist]
+    assert list(d.columns) == list(single[0].keys())
+    for k in ("startdatetime", "date", "starttime", "weekday", "season", "month"):
+        assert list(d[k]) == [p[k] for p in single], k
+
+
+def test_update_pickle_from_list(tmp_path):
+    """only new and changed files are parsed, duplicates under another name are skipped"""
+    for f in getfilelist("tests/data", suffix="gpx", withpath=True)[:3]:
+        shutil.copy(f, tmp_path)
+    mypickle = tmp_path / "pickles" / "df.pickle"
+    d = update_pickle_from_list(sorted(tmp_path.glob("*.gpx")), mypickle=mypickle, weather=False, workers=1)
+    assert len(d) == 3 and len(d.attrs["ingest_report"]["new"]) == 3
+    assert "route_inter" not in d.columns
+    assert RouteStore.open(mypickle.parents[0]).routes_for(d).shape == (3, 1000, 2)
+    files = sorted(tmp_path.glob("*.gpx"))
+    shutil.copy(files[0], tmp_path / "renamed.gpx")
+    files[1].write_text(files[1].read_text().replace("110.", "120."))
+    d = update_pickle_from_list(sorted(tmp_path.glob("*.gpx")), mypickle=mypickle, weather=False, workers=1)
+    report = d.attrs["ingest_report"]
+    assert report["changed"] == [files[1].name]
+    assert sorted(report["skipped"]) == sorted([files[0].name, files[2].name, "renamed.gpx"])
+    assert len(d) == 3 and sorted(d.filename) == sorted(f.name for f in files)
+
+
+def test_read_gpx_file_list_in_memory(tmp_path):
+    """gpx files held in memory give the same results as the files on disk"""
+    filelist = sorted(getfilelist("tests/data", suffix="gpx", withpath=True))
+    sources = [GpxBytes(f.name, f.read_bytes()) for f in filelist]
+    done = []
+    d = update_pickle_from_list(sources, mypickle=tmp_path / "df.pickle", weather=False, workers=2, progress=done.append)
+    assert sorted(done) == sorted(f.name for f in filelist)
+    ddisk = read_gpx_file_list(filelist, weather=False, workers=1)
+    assert list(d.filename) == list(ddisk.filename)
+    assert list(d.distance) == list(ddisk.distance)
+    # the same content from disk is recognized as known
+    d = update_pickle_from_list(filelist, mypickle=tmp_path / "df.pickle", weather=False, workers=1)
+    assert len(d.attrs["ingest_report"]["skipped"]) == len(filelist)
+
+
+def test_same_name_in_batch(tmp_path):
+    """a second file with the same name is reported as error and counted as done"""
+    filelist = sorted(getfilelist("tests/data", suffix="gpx", withpath=True))[:2]
+    sources = [GpxBytes("ride.gpx", f.read_bytes()) for f in filelist]
+    done = []
+    d = update_pickle_from_list(sources, mypickle=tmp_path / "df.pickle", weather=False, workers=1, progress=done.append)
+    assert list(d.filename) == ["ride.gpx"] and done == ["ride.gpx", "ride.gpx"]
+    assert [e["filename"] for e in d.attrs["errors"]] == ["ride.gpx"]
+
+
+def test_suffixes(tmp_path):
+    """the gpx suffix in upper case is parsed, files without it are reported as errors"""
+    f = sorted(getfilelist("tests/data", suffix="gpx", withpath=True))[0]
+    sources = [GpxBytes("RIDE.GPX", f.read_bytes()), GpxBytes("notes.txt", b"no gpx")]
+    done = []
+    d = update_pickle_from_list(sources, mypickle=tmp_path / "df.pickle", weather=False, workers=1, progress=done.append)
+    assert list(d.filename) == ["RIDE.GPX"] and sorted(done) == ["RIDE.GPX", "notes.txt"]
+    assert d.attrs["errors"] == [{"filename": "notes.txt", "error": "not a gpx file"}]
+
+
+def test_zip_members_same_name(tmp_path):
+    """members of an archive with the same file name in different folders are parsed"""
+    filelist = sorted(getfilelist("tests/data", suffix="gpx", withpath=True))[:2]
+    with zipfile.ZipFile(tmp_path / "years.zip", "w", zipfile.ZIP_DEFLATED) as z:
+        z.write(filelist[0], "2022/ride.gpx")
+        z.write(filelist[1], "2023/ride.gpx")
+    d = update_pickle_from_list([tmp_path / "years.zip"], mypickle=tmp_path / "df.pickle", weather=False, workers=1)
+    assert sorted(d.filename) == ["2022_ride.gpx", "2023_ride.gpx"] and d.attrs["errors"] == []
+
+
+def test_read_gpx_file_list_compressed(tmp_path):
+    """gzip files and zip archives are parsed like the raw files and deleted afterwards"""
+    filelist = sorted(getfilelist("tests/data", suffix="gpx", withpath=True))
+    with zipfile.ZipFile(tmp_path / "export.zip", "w", zipfile.ZIP_DEFLATED) as z:
+        for f in filelist[:-1]:
+            z.write(f, f.name)
+    (tmp_path / (filelist[-1].name + ".gz")).write_bytes(gzip.compress(filelist[-1].read_bytes()))
+    d = read_gpx_file_list(sorted(tmp_path.iterdir()), weather=False, workers=2, delete=True)
+    assert sorted(d.filename) == [f.name for f in filelist]
+    ddisk = read_gpx_file_list(filelist, weather=False, workers=1)
+    assert list(d.sort_values("filename").distance) == list(ddisk.distance)
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_near_duplicates(tmp_path):
+    """the same ride recorded twice is reported, the rides are added to the route index"""
+    f = getfilelist("tests/data", suffix="gpx", withpath=True)[0]
+    shutil.copy(f, tmp_path)
+    mypickle = tmp_path / "pickles" / "df.pickle"
+    d = update_pickle_from_list([tmp_path / Path(f).name], mypickle=mypickle, weather=False, workers=1)
+    assert d.attrs["ingest_report"][NEAR_DUPLICATES] == []
+    (tmp_path / "watch.gpx").write_text(Path(f).read_text().replace("110.", "120."))
+    d = update_pickle_from_list(sorted(tmp_path.glob("*.gpx")), mypickle=mypickle, weather=False, workers=1)
+    assert d.attrs["ingest_report"][NEAR_DUPLICATES] == [tuple(sorted((Path(f).name, "watch.gpx")))]
+    assert len(RouteIndex.open(mypickle.parents[0])) == 2
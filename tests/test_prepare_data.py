@@ -0,0 +1,26 @@
+import numpy as np
+import pandas as pd
+
+from gpxfun.prepare_data import get_prepared_data
+
+
+def _data(temp):
+    n = 20
+    return pd.DataFrame(
+        {
+            "filename": [f"{i}.gpx" for i in range(n)],
+            "startendcluster": 0,
+            "cluster": ["0_0"] * 12 + ["0_1"] * 8,
+            "starttimefloat": np.linspace(7, 9, n),
+            "duration": np.linspace(20, 30, n),
+            "is_outlier": False,
+            "temp": temp,
+        }
+    )
+
+
+def test_get_prepared_data_without_temp():
+    """without weather data the feature temp is left out instead of failing"""
+    assert get_prepared_data(_data(np.linspace(0, 20, 20))).temp.dtype == "category"
+    assert "temp" not in get_prepared_data(_data(np.nan)).columns
+    assert "temp" not in get_prepared_data(_data(np.nan).drop(columns="temp")).columns
@@ -0,0 +1,36 @@
+import numpy as np
+
+from gpxfun.resample_routes import resample_routes
+
+
+def test_resample_routes():
+    square = [[0, 0], [1, 0], [1, 0], [1, 1]]
+    line = np.array([[0, 0], [0, 3]])
+    out = np.zeros((2, 7, 2), dtype=np.float32)
+    r = resample_routes([square, line], n_samples=7, out=out)
+    assert r is out and r.dtype == np.float32
+    np.testing.assert_allclose(r[0, :, 0], [0, 1 / 3, 2 / 3, 1, 1, 1, 1], atol=1e-6)
+    np.testing.assert_allclose(r[0, :, 1], [0, 0, 0, 0, 1 / 3, 2 / 3, 1], atol=1e-6)
+    np.testing.assert_allclose(r[1, :, 1], np.linspace(0, 3, 7), atol=1e-6)
+    for i, route in enumerate([np.array(square), line]):
+        np.testing.assert_allclose(resample_routes([route], n_samples=7)[0], r[i])
+
+
+def test_resample_routes_zero_length():
+    """a route without length is its constant point, not interpolated toward the next route"""
+    r = resample_routes([[[0, 0], [0, 0]], [[10, 10], [11, 11]], [[3, 4]]], n_samples=5)
+    np.testing.assert_array_equal(r[0], np.zeros((5, 2)))
+    np.testing.assert_allclose(r[1], np.linspace([10, 10], [11, 11], 5))
+    np.testing.assert_array_equal(r[2], np.full((5, 2), [3, 4]))
+    np.testing.assert_array_equal(resample_routes([[[2, 1], [2, 1]]], n_samples=3, smooth=True)[0], [[2, 1]] * 3)
+
+
+def test_resample_routes_smooth():
+    """smoothing keeps start and end point and the equal spacing"""
+    rng = np.random.default_rng(0)
+    route = np.column_stack((np.linspace(0, 1, 300), np.zeros(300))) + rng.normal(0, 1e-3, (300, 2))
+    r = resample_routes([route], n_samples=500, smooth=True)[0]
+    np.testing.assert_allclose(r[[0, -1]], route[[0, -1]], atol=1e-6)
+    steps = np.linalg.norm(np.diff(r, axis=0), axis=1)
+    assert steps.std() / steps.mean() < 0.01
+    assert np.abs(r[1:-1, 1]).mean() < np.abs(route[:, 1]).mean()
@@ -0,0 +1,80 @@
+import numpy as np
+import pandas as pd
+
+from gpxfun import route_index as route_index_module
+from gpxfun.route_index import RouteIndex, route_sketches
+
+
+def _routes(n, seed=6):
+    rng = np.random.default_rng(seed)
+    return np.array([8.6, 50.1]) + np.cumsum(rng.normal(scale=1e-3, size=(n, 100, 2)), axis=1)
+
+
+def _brute_force(routes, route):
+    dists = np.sqrt(((route_sketches(routes) - route_sketches(route[None])) ** 2).sum(axis=1))
+    return np.argsort(dists, kind="stable"), np.sort(dists)
+
+
+def test_route_sketches():
+    """the distance of the sketches is the rms distance of the segment means in km"""
+    routes = _routes(2)
+    shifted = routes[0] + [0, 0.01]
+    sketches = route_sketches(np.stack([routes[0], shifted]))
+    assert sketches.shape == (2, 32)
+    np.testing.assert_allclose(np.linalg.norm(sketches[0] - sketches[1]), 1.112, rtol=0.01)
+
+
+def test_route_index(tmp_path, monkeypatch):
+    """k nearest and radius queries, also for routes added or changed after the tree was built"""
+    monkeypatch.setattr(route_index_module, "REBUILD_FRACTION", 0.3)
+    routes = _routes(60)
+    index = RouteIndex(tmp_path)
+    index.put([f"{i}.gpx" for i in range(40)], routes[:40])
+    query = routes[45] + 1e-4
+    order, dists = _brute_force(routes[:40], query)
+    assert [fn for fn, _ in index.query(query, k=3)] == [f"{i}.gpx" for i in order[:3]]
+    # searched linearly until the tree is rebuilt
+    index.put([f"{i}.gpx" for i in range(40, 50)], routes[40:50])
+    index.put(["3.gpx"], routes[50:51])
+    assert len(index._searched_linearly()) == 11
+    routes[3] = routes[50]
+    order, dists = _brute_force(routes[:50], query)
+    result = index.query(query, k=5)
+    assert [fn for fn, _ in result] == [f"{i}.gpx" for i in order[:5]]
+    np.testing.assert_allclose([d for _, d in result], dists[:5])
+    radius = dists[7]
+    assert [fn for fn, _ in index.query_radius(query, radius)] == [f"{i}.gpx" for i in order[:8]]
+    index.save()
+    stored = RouteIndex.open(tmp_path)
+    assert stored.filenames == index.filenames and len(stored) == 50 and "3.gpx" in stored
+    assert stored.query(query, k=5) == result
+
+
+def test_reopened_index(tmp_path, monkeypatch):
+    """the tree is saved with the index, routes added after reopening are searched linearly"""
+    routes = _routes(45)
+    index = RouteIndex(tmp_path)
+    index.put([f"{i}.gpx" for i in range(40)], routes[:40])
+    index.query(routes[0], k=1)
+    index.save()
+    built = []
+    monkeypatch.setattr(route_index_module, "KDTree", lambda *args: built.append(1))
+    for i in range(40, 43):
+        index = RouteIndex.open(tmp_path)
+        index.put([f"{i}.gpx"], routes[i : i + 1])
+        index.put(["0.gpx"], routes[44:45])
+        assert [fn for fn, _ in index.query(routes[i], k=1)] == [f"{i}.gpx"]
+        assert [fn for fn, _ in index.query(routes[44], k=1)] == ["0.gpx"]
+        index.save()
+    assert built == [] and len(index._searched_linearly()) == 4
+
+
+def test_near_duplicates():
+    """same route and start time, rides on the same route at another time are no duplicates"""
+    routes = _routes(3)
+    starts = pd.to_datetime(["2022-09-04 14:59", "2022-09-05 07:22", "2022-09-05 07:25"]).tz_localize("UTC")
+    index = RouteIndex()
+    index.put(["a.gpx", "b.gpx", "c.gpx"], np.stack([routes[0], routes[0], routes[1]]), starts)
+    index.put(["d.gpx"], routes[:1] + 1e-5, starts[1:2].tz_convert("Europe/Berlin"))
+    assert index.near_duplicates(["d.gpx"]) == [("b.gpx", "d.gpx")]
+    assert index.near_duplicates(["b.gpx", "d.gpx", "c.gpx"]) == [("b.gpx", "d.gpx")]
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from gpxfun.route_store import RouteStore
+
+
+def _routes(n, n_samples=10, offset=0.0):
+    return np.random.default_rng(0).random((n, n_samples, 2)).astype(np.float32) + offset
+
+
+def test_put_get(tmp_path):
+    store = RouteStore(tmp_path, n_samples=10)
+    r = _routes(3)
+    store.put(["a.gpx", "b.gpx", "c.gpx"], r)
+    store = RouteStore.open(tmp_path)
+    assert len(store) == 3 and "b.gpx" in store
+    contiguous = store.get(["b.gpx", "c.gpx"])
+    assert isinstance(contiguous, np.memmap)
+    np.testing.assert_array_equal(contiguous, r[1:])
+    np.testing.assert_array_equal(store.get(["c.gpx", "a.gpx"]), r[[2, 0]])
+    np.testing.assert_array_equal(store.routes_for(pd.DataFrame({"filename": ["a.gpx"]})), r[:1])
+    with pytest.raises(KeyError):
+        store.get(["x.gpx"])
+
+
+def test_put_overwrites_known_files(tmp_path):
+    store = RouteStore(tmp_path, n_samples=10)
+    r = _routes(2)
+    store.put(["a.gpx", "b.gpx"], r)
+    new = _routes(2, offset=5.0)
+    store.put(["b.gpx", "c.gpx"], new)
+    store = RouteStore.open(tmp_path)
+    assert store.filenames == ["a.gpx", "b.gpx", "c.gpx"]
+    assert (tmp_path / "routes.f32").stat().st_size == 3 * 10 * 2 * 4
+    np.testing.assert_array_equal(store.get(["a.gpx", "b.gpx", "c.gpx"]), np.concatenate([r[:1], new]))
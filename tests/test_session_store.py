@@ -0,0 +1,66 @@
+import datetime
+import pickle
+
+from gpxpy.geo import Location
+import numpy as np
+import pandas as pd
+
+from gpxfun.route_store import RouteStore
+from gpxfun.session_store import migrate_session, read_most_imp_clusters, read_session, read_table, write_table
+
+
+def _session_df():
+    ts = pd.Timestamp("2023-03-21 18:01:02", tz="UTC")
+    d = pd.DataFrame(
+        {
+            "filename": ["a.gpx", "b.gpx", "c.gpx"],
+            "duration": [20.5, 22.0, 31.0],
+            "start": [Location(50.1, 8.6, 110.0), Location(50.2, 8.7, None), Location(50.3, 8.8, 120.0)],
+            "startdatetime": pd.Series([ts, ts.tz_convert("Europe/Berlin"), ts], dtype=object),
+            "date": [datetime.date(2023, 3, 21)] * 3,
+            "starttime": [datetime.time(18, 1, 2)] * 3,
+            "month": [3, 3, 4],
+        }
+    ).convert_dtypes()
+    d["month"] = d.month.astype("category")
+    d["startendcluster"] = pd.Categorical([0, "other", 0], categories=[0, "other"])
+    d["cluster"] = pd.Categorical(["0_0", "other_other", "0_1"])
+    return d
+
+
+def test_roundtrip(tmp_path):
+    d = _session_df()
+    write_table(d, tmp_path / "df.parquet")
+    r = read_table(tmp_path / "df.parquet")
+    assert list(r.columns) == list(d.columns)
+    assert (r.dtypes == d.dtypes).all()
+    assert [(x.latitude, x.longitude, x.elevation) for x in r.start] == [
+        (x.latitude, x.longitude, x.elevation) for x in d.start
+    ]
+    assert list(r.startdatetime) == list(d.startdatetime)
+    assert [str(x.tzinfo) for x in r.startdatetime] == ["UTC", "Europe/Berlin", "UTC"]
+    for c in ("filename", "duration", "date", "starttime", "month", "startendcluster", "cluster"):
+        assert r[c].equals(d[c]), c
+
+
+def test_projection_and_cluster_filter(tmp_path):
+    write_table(_session_df(), tmp_path / "df.parquet")
+    r = read_session(tmp_path, columns=["filename", "start", "startendcluster"], clusters=["0_0", "0_1"])
+    assert list(r.columns) == ["filename", "start", "startendcluster"]
+    assert list(r.filename) == ["a.gpx", "c.gpx"]
+    assert list(r.startendcluster.cat.categories) == [0, "other"]
+
+
+def test_migrate_session(tmp_path):
+    d = _session_df()
+    d["route_inter"] = [np.full((1000, 2), i).tolist() for i in range(3)]
+    clusters = d[["startendcluster", "cluster"]].drop_duplicates()
+    with open(tmp_path / "df.pickle", "wb") as f:
+        pickle.dump(d, f)
+    with open(tmp_path / "most_imp_clusters.pickle", "wb") as f:
+        pickle.dump(clusters, f)
+    assert migrate_session(tmp_path)
+    assert not migrate_session(tmp_path)
+    assert "route_inter" not in read_session(tmp_path).columns
+    assert read_most_imp_clusters(tmp_path).cluster.equals(clusters.cluster)
+    assert RouteStore.open(tmp_path).get(["c.gpx"])[0, 0, 0] == 2
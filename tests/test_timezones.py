@@ -0,0 +1,26 @@
+import datetime
+
+import pandas as pd
+import pytz
+
+from gpxfun.timezones import localize_datetimes, timezone_at, timezones_at
+
+
+def test_timezone_at():
+    assert timezone_at(50.11, 8.68) == "Europe/Berlin"
+    assert timezone_at(40.71, -74.0) == "America/New_York"
+
+
+def test_timezones_at():
+    tzs = timezones_at([50.11, 50.1101, 40.71], [8.68, 8.6801, -74.0])
+    assert list(tzs) == ["Europe/Berlin", "Europe/Berlin", "America/New_York"]
+
+
+def test_localize_datetimes():
+    dt = datetime.datetime(2022, 9, 4, 12, 0, tzinfo=pytz.utc)
+    s = localize_datetimes(pd.Series([dt, dt]), [50.11, 50.12], [8.68, 8.69])
+    assert str(s.dtype) == "datetime64[ns, Europe/Berlin]"
+    assert s.iloc[0].hour == 14
+    s = localize_datetimes(pd.Series([dt, dt]), [50.11, 40.71], [8.68, -74.0])
+    assert [x.hour for x in s] == [14, 8]
+    assert all(x == dt for x in s)
@@ -0,0 +1,58 @@
+import gpxpy
+import numpy as np
+import pytest
+
+from gpxfun.parse_gpx import _read_track_gpxpy
+from gpxfun.track_metrics import NO_TIME, track_metrics
+from utils.utilities import getfilelist
+
+
+def _gpxpy_metrics(g) -> dict:
+    points = g.get_points_data()
+    return dict(
+        distance=g.length_3d(),
+        duration=g.get_duration(),
+        moving_time=g.get_moving_data().moving_time,
+        uphill=g.get_uphill_downhill().uphill,
+        downhill=g.get_uphill_downhill().downhill,
+        distance_crow=points[-1].point.distance_3d(points[0].point),
+    )
+
+
+@pytest.mark.parametrize("filename", sorted(getfilelist("tests/data", suffix="gpx", withpath=True)))
+def test_track_metrics_like_gpxpy(filename):
+    with open(filename) as fh:
+        g = gpxpy.parse(fh)
+    a = _read_track_gpxpy(filename)
+    m = track_metrics(a["lat"], a["lon"], a["ele"], a["time"], a["segment"])
+    for k, v in _gpxpy_metrics(g).items():
+        assert m[k] == pytest.approx(v, rel=1e-9, abs=1e-9), k
+
+
+def test_track_metrics_missing_values():
+    """missing elevations and times are ignored like in gpxpy"""
+    g = gpxpy.gpx.GPX()
+    g.tracks.append(gpxpy.gpx.GPXTrack())
+    for s in range(2):
+        seg = gpxpy.gpx.GPXTrackSegment()
+        for i in range(6):
+            seg.points.append(
+                gpxpy.gpx.GPXTrackPoint(
+                    50 + 0.001 * i + s,
+                    8 + 0.002 * i,
+                    elevation=None if i == 2 else 100 + (i % 3) * 5,
+                    time=None if i == 0 else gpxpy.gpxfield.parse_time(f"2022-01-0{s + 1}T10:00:{i * 7:02d}Z"),
+                )
+            )
+        g.tracks[0].segments.append(seg)
+    totime = lambda p: NO_TIME if p.time is None else int(p.time.timestamp()) * 10**9
+    pts = [(si, p) for si, seg in enumerate(g.tracks[0].segments) for p in seg.points]
+    m = track_metrics(
+        np.array([p.latitude for _, p in pts]),
+        np.array([p.longitude for _, p in pts]),
+        np.array([np.nan if p.elevation is None else p.elevation for _, p in pts]),
+        np.array([totime(p) for _, p in pts], dtype=np.int64),
+        np.array([si for si, _ in pts]),
+    )
+    for k, v in _gpxpy_metrics(g).items():
+        assert m[k] == pytest.approx(v, rel=1e-9, abs=1e-9), k
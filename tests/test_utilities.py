@@ -1,6 +1,6 @@
 from utils.utilities import safe_int_list_cast
 from utils.utilities import getfilelist
-from utils.utilities import season_of_date
+from utils.utilities import season_of_date, season_of_dates
 import datetime
 
 
@@ -36,3 +36,9 @@ def test_season_of_date():
     assert season_of_date(datetime.date(2020, 6, 21)) == "summer"
     assert season_of_date(datetime.date(2020, 9, 23)) == "autumn"
     assert season_of_date(datetime.date(2020, 12, 21)) == "winter"
+
+
+def test_season_of_dates():
+    """the vectorized seasons match season_of_date for every day of a leap year and a normal year"""
+    dates = [datetime.date(2020, 1, 1) + datetime.timedelta(days=i) for i in range(366 + 365)]
+    assert list(season_of_dates(dates)) == [season_of_date(d) for d in dates]
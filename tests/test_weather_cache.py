@@ -0,0 +1,57 @@
+import datetime
+
+import pandas as pd
+import pytz
+
+from gpxfun.get_weather import get_weather_batch, get_weather_dict
+from gpxfun.weather_cache import WeatherCache, to_hours
+
+
+def _rides(*dts):
+    return pd.Series(pd.to_datetime(list(dts)).tz_localize("UTC"))
+
+
+def test_cache_hit_and_gap(fake_meteostat, tmp_path):
+    cache = WeatherCache(tmp_path / "w.sqlite")
+    first = get_weather_batch(_rides("2021-06-01 08:30", "2021-06-02 08:30"), [50.1] * 2, [8.6] * 2, cache=cache)
+    assert len(fake_meteostat.calls) == 1
+    again = get_weather_batch(_rides("2021-06-01 08:30", "2021-06-02 08:30"), [50.1] * 2, [8.6] * 2, cache=cache)
+    pd.testing.assert_frame_equal(first, again)
+    assert len(fake_meteostat.calls) == 1
+    # only the hours after the cached ones are queried
+    get_weather_batch(_rides("2021-06-01 08:30", "2021-06-05 08:30"), [50.1] * 2, [8.6] * 2, cache=cache)
+    assert len(fake_meteostat.calls) == 2
+    assert fake_meteostat.calls[1][2] == datetime.datetime(2021, 6, 2, 10)
+
+
+def test_cache_offline(fake_meteostat, tmp_path):
+    cache = WeatherCache(tmp_path / "w.sqlite", offline=True)
+    wd = get_weather_batch(_rides("2021-06-01 08:30"), [50.1], [8.6], cache=cache)
+    assert wd.time.isna().all() and wd.temp.isna().all()
+    assert get_weather_dict(datetime.datetime(2021, 6, 1, 8, 30, tzinfo=pytz.utc), 50.1, 8.6, 0, cache=cache) == {}
+    assert len(fake_meteostat.calls) == 0
+    cache.offline = False
+    get_weather_batch(_rides("2021-06-01 08:30"), [50.1], [8.6], cache=cache)
+    cache.offline = True
+    wd = get_weather_batch(_rides("2021-06-01 08:30", "2021-07-01 08:30"), [50.1] * 2, [8.6] * 2, cache=cache)
+    assert list(wd.temp.isna()) == [False, True]
+    assert len(fake_meteostat.calls) == 1
+
+
+def test_cache_eviction(tmp_path):
+    cache = WeatherCache(tmp_path / "w.sqlite", max_rows=5)
+    hours = pd.date_range("2020-01-01", periods=4, freq="h")
+    hourly = pd.DataFrame({"time": hours, "temp": [1.0, 2.0, 3.0, 4.0]})
+    first = to_hours(hours[:1])[0]
+    cache.put(0, 0, hourly, first, first + 3)
+    cache.put(1, 0, hourly, first, first + 3)
+    assert len(cache) == 5
+    assert len(cache.get(0, 0, first, first + 3)) == 1
+    assert list(cache.get(1, 0, first, first + 3).temp) == [1.0, 2.0, 3.0, 4.0]
+    # hours without a record are cached as missing
+    cache.put(2, 0, hourly.head(2), first, first + 3)
+    assert len(cache.missing_hours(2, 0, first, first + 3)) == 0
+    assert len(cache.get(2, 0, first, first + 3)) == 2
+    cache.ttl = pd.Timedelta(0)
+    cache.evict()
+    assert len(cache) == 0
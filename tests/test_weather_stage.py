@@ -0,0 +1,94 @@
+import pandas as pd
+from gpxpy.geo import Location
+
+from gpxfun import get_weather
+from gpxfun.get_weather import WEATHER_COLUMNS, get_weather_batch
+from dash_app.app_data_functions import wait_for_weather
+from gpxfun.session_store import WEATHER_FILE, read_session, write_session
+from gpxfun.weather_stage import WEATHER_RUNNING, add_weather, mark_weather_running, weather_state
+
+
+def _write_session(folder, n=3):
+    d = pd.DataFrame(
+        {
+            "filename": [f"{i}.gpx" for i in range(n)],
+            "startdatetime": pd.Series(
+                [pd.Timestamp("2021-06-01 08:30", tz="Europe/Berlin") + pd.Timedelta(days=i) for i in range(n)],
+                dtype=object,
+            ),
+            "start": [Location(50.1 + i, 8.6, 100.0) for i in range(n)],
+            "cluster": pd.Categorical(["0_0"] * n),
+        }
+    )
+    write_session(folder, d, pd.DataFrame({"cluster": ["0_0"]}))
+    return d
+
+
+def test_add_weather(fake_meteostat, tmp_path):
+    d = _write_session(tmp_path)
+    assert "temp" not in read_session(tmp_path).columns
+    weather = add_weather(tmp_path, workers=2)
+    assert (tmp_path / WEATHER_FILE).is_file()
+    assert len(weather) == len(d) and weather.time.notna().all()
+    r = read_session(tmp_path, columns=["cluster", "temp"], clusters=["0_0"])
+    assert list(r.columns) == ["cluster", "temp"]
+    assert list(r.temp) == [7.0, 7.0, 7.0]
+    assert list(read_session(tmp_path).columns) == list(d.columns) + ["time"] + WEATHER_COLUMNS
+    # only new routes are fetched
+    ncalls = len(fake_meteostat.calls)
+    _write_session(tmp_path, n=4)
+    assert len(add_weather(tmp_path)) == 4
+    assert len(fake_meteostat.calls) == ncalls + 1
+
+
+def test_weather_state(fake_meteostat, tmp_path):
+    """the state is read from the session folder, stages of dead processes are missing"""
+    _write_session(tmp_path)
+    assert weather_state(tmp_path) == "missing"
+    mark_weather_running(tmp_path)
+    assert weather_state(tmp_path) == "running"
+    # a process id which doesn't exist, e.g. of a worker before a restart
+    (tmp_path / WEATHER_RUNNING).write_text('{"pid": 2147483647}')
+    assert weather_state(tmp_path) == "missing"
+    add_weather(tmp_path)
+    assert weather_state(tmp_path) == "ready" and not (tmp_path / WEATHER_RUNNING).exists()
+    # a route added to the session has no weather data yet
+    _write_session(tmp_path, n=4)
+    assert weather_state(tmp_path) == "partial"
+
+
+def test_wait_for_weather(fake_meteostat, tmp_path, monkeypatch):
+    """routes without weather data, e.g. of a second upload, are fetched before the analyzers run"""
+    monkeypatch.chdir(tmp_path)
+    folder = tmp_path / "sessions" / "s1"
+    folder.mkdir(parents=True)
+    _write_session(folder)
+    add_weather(folder)
+    _write_session(folder, n=4)
+    assert wait_for_weather("s1", timeout=10)
+    assert weather_state(folder) == "ready" and len(read_session(folder).temp.dropna()) == 4
+
+
+def test_retry(fake_meteostat, monkeypatch):
+    failures = []
+
+    class FlakyHourly(fake_meteostat):
+        def fetch(self):
+            if len(failures) < 2:
+                failures.append(1)
+                raise ConnectionError("flaky")
+            return super().fetch()
+
+    monkeypatch.setattr(get_weather.meteostat, "Hourly", FlakyHourly)
+    monkeypatch.setattr(get_weather, "WEATHER_BACKOFF", 0.0)
+    dts = pd.Series([pd.Timestamp("2021-06-01 08:30", tz="UTC")])
+    assert list(get_weather_batch(dts, [50.1], [8.6]).temp) == [9.0]
+    assert len(fake_meteostat.calls) == 3
+
+
+def test_concurrent_queries(fake_meteostat):
+    dts = pd.Series(pd.to_datetime(["2021-06-01 08:30", "2021-06-01 10:30", "2022-01-01 12:00"] * 4).tz_localize("UTC"))
+    lats = [50.1 + i // 3 for i in range(12)]
+    wd = get_weather_batch(dts, lats, [8.6] * 12, workers=4)
+    assert len(fake_meteostat.calls) == 8
+    assert list(wd.temp) == [9.0, 11.0, 12.0] * 4
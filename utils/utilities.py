@@ -5,6 +5,7 @@ import datetime
 import logging
 from pathlib import Path
 
+import numpy as np
 import pandas as pd
 
 log = logging.getLogger("gpxfun." + __name__)
@@ -95,6 +96,21 @@ def season_of_date(date: datetime.date) -> str:
         return "winter"
 
 
+def season_of_dates(dates) -> np.ndarray:
+    """
+    Seasons of many dates at once, the same seasons as season_of_date
+    :param dates: array-like of dates or datetimes, convertible by pd.to_datetime
+    :return: array with the names of the seasons
+    """
+    dates = pd.DatetimeIndex(pd.to_datetime(dates))
+    # day of the year as month * 100 + day, so that leap years need no special treatment
+    monthday = np.asarray(dates.month * 100 + dates.day)
+    seasons = np.full(len(monthday), "winter", dtype=object)
+    seasons[(monthday >= 321) & (monthday <= 620)] = "spring"
+    seasons[(monthday >= 621) & (monthday <= 922)] = "summer"
+    seasons[(monthday >= 923) & (monthday <= 1220)] = "autumn"
+    return seasons
+
 
 def convert_bytes(num):
     """